@@ -9,6 +9,7 @@ python manage.py migrate users
 python manage.py migrate auth
 python manage.py migrate
 python manage.py collectstatic --noinput
+python manage.py create_minio_bucket
 service cron start
 
 if grep -Fxq "PLUGINS_ENABLED+=[\"globus\"]" /code/shub/settings/config.py
@@ -8,17 +8,111 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 """
 
+import errno
 import os
 import shutil
 import uuid
 
 import django_rq
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 
 from shub.logger import bot
-from shub.settings import MEDIA_ROOT
+from shub.settings import MEDIA_ROOT, UPLOAD_BACKGROUND_COPY_MB
 from sregistry.utils import parse_image_name
 
+# A copy of a large upload (to another filesystem) can take longer than the
+# default job timeout
+STORE_UPLOAD_TIMEOUT = -1
+
+# Errors from copy_file_range (or sendfile) when they can't copy the files
+COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+
+
+def is_same_filesystem(source, dest):
+    """determine if a file can be renamed to dest (a file, or directory,
+    that may not exist yet)
+    """
+    while not os.path.isdir(dest):
+        dest = os.path.dirname(dest)
+    return os.stat(source).st_dev == os.stat(dest).st_dev
+
+
+def copy_file_range(src, dst, size):
+    """copy size bytes of an open file to another in the kernel, without
+    reading them: with copy_file_range (which can also clone the data, or
+    copy on the server for NFS), or sendfile, and otherwise read and write.
+    Returns the number of bytes copied.
+    """
+    offset = 0
+    for name in ["copy_file_range", "sendfile"]:
+        if not hasattr(os, name):
+            continue
+        try:
+            while offset < size:
+                if name == "copy_file_range":
+                    copied = os.copy_file_range(src, dst, size - offset, offset, offset)
+                else:
+                    os.lseek(dst, offset, os.SEEK_SET)
+                    copied = os.sendfile(dst, src, offset, size - offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRORS:
+                raise
+        if offset >= size:
+            return offset
+
+    os.lseek(src, offset, os.SEEK_SET)
+    os.lseek(dst, offset, os.SEEK_SET)
+    with open(src, "rb", closefd=False) as fsrc, open(dst, "wb", closefd=False) as fdst:
+        shutil.copyfileobj(fsrc, fdst, 4 * 1024 * 1024)
+    return os.fstat(dst).st_size
+
+
+def copy_file(source, dest):
+    """copy a file in the kernel (see copy_file_range), beside dest, and
+    then move it over dest, so dest is always a complete file.
+    """
+    tmp = os.path.join(os.path.dirname(dest), ".%s.tmp" % uuid.uuid4().hex)
+    try:
+        with open(source, "rb") as src, open(tmp, "wb") as dst:
+            size = os.fstat(src.fileno()).st_size
+            if copy_file_range(src.fileno(), dst.fileno(), size) != size:
+                raise OSError("incomplete copy of %s" % source)
+        shutil.copymode(source, tmp)
+        os.replace(tmp, dest)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def move_file(source, dest):
+    """move a file, with a rename on the same filesystem. Otherwise the file
+    is copied (without reading it in userspace) and the source removed.
+    """
+    try:
+        os.rename(source, dest)
+        return dest
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    copy_file(source, dest)
+    os.remove(source)
+    return dest
+
+
+def is_background_move(source, dest):
+    """determine if moving an upload to storage is a copy (to another
+    filesystem) large enough to run in a worker (see store_upload)
+    """
+    if not UPLOAD_BACKGROUND_COPY_MB:
+        return False
+    if is_same_filesystem(source, dest):
+        return False
+    return os.path.getsize(source) >> 20 >= UPLOAD_BACKGROUND_COPY_MB
+
 
 def move_upload_to_storage(collection, upload_id):
     """moving an uploaded *UploadImage* to storage means:
@@ -39,11 +133,16 @@ def move_upload_to_storage(collection, upload_id):
     # Rename the file, moving from ImageUpload to Storage
     filename = os.path.basename(instance.file.path)
     new_path = os.path.join(image_home, filename.replace(".part", ".sif"))
-    shutil.move(instance.file.path, new_path)
+
+    # A large copy is left to a worker, the file is used where it is
+    if is_background_move(instance.file.path, new_path):
+        return instance, new_path
+
+    move_file(instance.file.path, new_path)
     print("%s --> %s" % (instance.file.path, new_path))
     instance.file.name = new_path
     instance.save()
-    return instance
+    return instance, None
 
 
 def generate_nginx_storage_path(collection, source, dest):
@@ -76,23 +175,73 @@ def move_nginx_upload_to_storage(collection, source, dest):
         os.makedirs(image_home)
 
     new_path = os.path.join(image_home, os.path.basename(dest))
-    shutil.move(source, new_path)
+    move_file(source, new_path)
     return new_path
 
 
 def calculate_version(cid):
-    """calculate version is run as a separate task after a container upload.
-    Instead of using md5 provided by nginx we calculate sha256 sum and
-    then include as the version variable.
+    """calculate version is run as a separate task after a container upload,
+    only when the sha256 sum wasn't calculated as the file was received
+    (e.g., nginx sent only an md5). We calculate the sha256 sum and then
+    include as the version variable.
     """
+    from shub.apps.api.dedup import deduplicate_image
+    from shub.apps.api.hashes import get_file_digest
     from shub.apps.main.views import get_container
-    from sregistry.utils import get_file_hash
 
     print("Calculating version for upload.")
     container = get_container(cid)
-    version = "sha256.%s" % get_file_hash(container.image.datafile.path, "sha256")
-    container.version = version
+    digest = get_file_digest(container.image.datafile.path, "sha256")
+    container.version = "sha256.%s" % digest
     container.save()
+    deduplicate_image(container.image, digest)
+
+
+def store_upload(cid, dest):
+    """store_upload is run as a separate task after a container upload, when
+    moving the image to storage is a large copy (to another filesystem). The
+    container is pending, and its image is used where it is until the copy
+    is complete. Then we calculate the sha256 sum (if needed), or link the
+    image to an identical image.
+    """
+    from shub.apps.api.dedup import deduplicate_image
+    from shub.apps.api.models import ImageFile
+    from shub.apps.main.models import Container
+    from shub.apps.main.query import container_cache
+
+    try:
+        container = Container.objects.select_related("image").get(id=cid)
+    except Container.DoesNotExist:
+        bot.warning("Container %s was deleted before it was stored." % cid)
+        return
+
+    image = container.image
+    if image is None or not container.metadata.get("pending"):
+        return
+
+    source = image.datafile.path
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    copy_file(source, dest)
+    print("%s --> %s" % (source, dest))
+
+    # The image may have been replaced while it was copied
+    if not ImageFile.objects.filter(id=image.id, datafile=image.datafile.name).update(
+        datafile=dest
+    ):
+        os.remove(dest)
+        return
+    image.datafile.name = dest
+    os.remove(source)
+
+    # Update the row directly, saving would change the container secret
+    container.metadata.pop("pending", None)
+    Container.objects.filter(id=cid).update(metadata=container.metadata)
+    container_cache.clear_collection(container.collection_id)
+
+    if not (container.version or "").startswith("sha256."):
+        calculate_version(cid)
+    else:
+        deduplicate_image(image, container.version[len("sha256.") :])
 
 
 def upload_container(cid, user, name, version, upload_id, size=None):
@@ -105,7 +254,9 @@ def upload_container(cid, user, name, version, upload_id, size=None):
     upload_id: the upload_id to find the container (for web UI upload)
                if it exists as a file, an ImageUpload is created instead.
     name: the requested name for the container
-    version: the md5 sum of the file
+    version: the version of the file, sha256.<sum> if calculated as it was
+             received (otherwise an md5 sum, and the sha256 is calculated)
+    size: the size of the file in bytes, if known (e.g., from nginx)
 
     Returns
     =======
@@ -115,6 +266,7 @@ def upload_container(cid, user, name, version, upload_id, size=None):
              error / success codes.
     """
 
+    from shub.apps.api.dedup import deduplicate_image
     from shub.apps.api.models import ImageFile, ImageUpload
     from shub.apps.main.models import Collection, Container
 
@@ -136,14 +288,20 @@ def upload_container(cid, user, name, version, upload_id, size=None):
             return message
 
         # If the path exists, it's a file from nginx module, move to storage
+        # A large copy is left to a worker, the file is used where it is
+        pending = None
         if os.path.exists(upload_id):
-            # If name is too long, will return OSError on move to storage
-            new_path = move_nginx_upload_to_storage(collection, upload_id, storage)
+            if is_background_move(upload_id, new_path):
+                pending = new_path
+                new_path = upload_id
+            else:
+                # If name is too long, will return OSError on move to storage
+                new_path = move_nginx_upload_to_storage(collection, upload_id, storage)
             instance = ImageUpload.objects.create(
                 file=new_path, upload_id=str(uuid.uuid4())
             )
         else:
-            instance = move_upload_to_storage(collection, upload_id)
+            instance, pending = move_upload_to_storage(collection, upload_id)
 
         # A collection name can have a slash (or not)
         container_uri = names["uri"]
@@ -158,68 +316,87 @@ def upload_container(cid, user, name, version, upload_id, size=None):
                 )
             container_name = collection.name
 
-        image = ImageFile.objects.create(
-            collection=collection,
-            tag=names["tag"],
-            name=container_uri,
-            owner_id=user.id,
-            datafile=instance.file,
-        )
-
-        # Get a container, if it exists (and the user is re-using a name)
-        # Filter by negative id so we get the more recent container first.
-        collection_set = collection.containers
-        containers = collection_set.filter(
-            tag=names["tag"], name=container_name
-        ).order_by("-id")
-
-        # If one exists, we check if it's frozen
-        create_new = True
-
-        if containers:
-            # If we already have a container, it might be frozen
-            container = containers[0]
-
-            # If it's not frozen, overwrite the same file
-            if container.frozen is False:
-                container.delete()
-                create_new = False
-
-        # Container doesn't already exist / or old version isn't frozen
-        if create_new is True:
-            try:
-                container = Container.objects.create(
-                    collection=collection,
-                    name=container_name,
-                    tag=names["tag"],
-                    image=image,
-                    version=names["version"],
-                )
-
-            # Catches when container is frozen, and version already exists
-            except IntegrityError:
-                message = "%s already exists." % container_uri
-                bot.error(message)
-                delete_file_instance(instance)
-                return message
-
-        # Otherwise, use the same container object, but update version
-        else:
-            container.image = image
-            container.version = names["version"]
-
-        container.save()
+        # The image, container, version and size are saved together
+        with transaction.atomic():
+            image = ImageFile.objects.create(
+                collection=collection,
+                tag=names["tag"],
+                name=container_uri,
+                owner_id=user.id,
+                datafile=instance.file,
+            )
 
-        # Save the size
-        if size is None:
-            size = os.path.getsize(instance.file.path) >> 20
-        container.metadata["size_mb"] = size
+            # Get a container, if it exists (and the user is re-using a name)
+            # Filter by negative id so we get the more recent container first.
+            collection_set = collection.containers
+            containers = collection_set.filter(
+                tag=names["tag"], name=container_name
+            ).order_by("-id")
+
+            # If one exists, we check if it's frozen
+            create_new = True
+
+            if containers:
+                # If we already have a container, it might be frozen
+                container = containers[0]
+
+                # If it's not frozen, overwrite the same file
+                if container.frozen is False:
+                    container.delete()
+                    create_new = False
+
+            # Container doesn't already exist / or old version isn't frozen
+            if create_new is True:
+                try:
+                    with transaction.atomic():
+                        container = Container.objects.create(
+                            collection=collection,
+                            name=container_name,
+                            tag=names["tag"],
+                            image=image,
+                            version=names["version"],
+                        )
+
+                # Catches when container is frozen, and version already exists
+                except IntegrityError:
+                    message = "%s already exists." % container_uri
+                    bot.error(message)
+                    delete_file_instance(instance)
+                    return message
+
+            # Otherwise, use the same container object, but update version
+            else:
+                container.image = image
+                container.version = names["version"]
+
+            # Save the size
+            if size is None:
+                size = os.path.getsize(instance.file.path)
+            container.size_bytes = int(size)
+            if pending is not None:
+                container.metadata["pending"] = True
+            container.save()
 
         # Once the container is saved, delete the intermediate file object
         delete_file_instance(instance)
 
-        # Run a task to calculate the sha256 sum
-        django_rq.enqueue(calculate_version, cid=container.id)
+        # Run a task to move the image to storage (and then calculate the
+        # sha256 sum, or deduplicate it)
+        if pending is not None:
+            django_rq.get_queue("default").enqueue(
+                store_upload,
+                cid=container.id,
+                dest=pending,
+                job_timeout=STORE_UPLOAD_TIMEOUT,
+            )
+
+        # Run a task to calculate the sha256 sum, if not calculated on upload
+        elif not (container.version or "").startswith("sha256."):
+            django_rq.enqueue(calculate_version, cid=container.id)
+
+        # Otherwise link the image to an identical image, if there is one
+        else:
+            deduplicate_image(container.image, container.version[len("sha256.") :])
 
 
 def delete_file_instance(instance):
@@ -10,7 +10,7 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from ratelimit.decorators import ratelimit
 
-from shub.apps.api.utils import validate_request
+from shub.apps.api.utils import get_auth_context, validate_request
 from shub.logger import bot
 from shub.settings import VIEW_RATE_LIMIT as rl_rate
 from shub.settings import VIEW_RATE_LIMIT_BLOCK as rl_block
@@ -21,7 +21,7 @@ from sregistry.main.registry.auth import generate_timestamp
 def delete_container(request, container):
     """delete a container only given authentication to do so"""
 
-    auth = request.META.get("HTTP_AUTHORIZATION", None)
+    auth = get_auth_context(request)
 
     if auth is None:
         bot.debug("authentication is invalid.")
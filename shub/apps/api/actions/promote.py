@@ -0,0 +1,116 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+import re
+
+from django.db import transaction
+
+from shub.logger import bot
+
+################################################################################
+# PROMOTION
+################################################################################
+
+# A container is promoted (e.g., from :rc to :latest, or from a staging
+# collection to production) by adding a container for the new tag that
+# references the same image, without uploading it again:
+#
+# - an image in minio is referenced by its digest (see add_storage_reference).
+#   An object with the legacy layout is copied to its content addressed path
+#   first, server side, once.
+# - a local image (ImageFile) is shared, it's only deleted when no container
+#   uses it (see shub.apps.main.models.signals)
+# - a remote build keeps the url of its image in the metadata
+#
+# A container replaced by the promotion (an existing tag that isn't frozen)
+# is deleted. A legacy object it leaves in minio is removed by gc.
+
+name_regex = re.compile("^[a-zA-Z0-9][a-zA-Z0-9._-]*$")
+
+
+def promote_container(container, collection, name, tag):
+    """add a container with the image of an existing container to a
+    collection (the same or another) as name:tag, replacing the container
+    with that tag unless it's frozen. The containers are updated in one
+    transaction.
+
+    Parameters
+    ==========
+    container: the container to promote
+    collection: the collection to add the container to
+    name: the name of the new container
+    tag: the tag of the new container
+
+    Returns
+    =======
+    (container, message): the new container and None, or None and an error
+                          message to show to the user.
+    """
+    from shub.apps.library.views.minio import add_storage_reference, store_by_digest
+    from shub.apps.main.models import Container
+
+    # A collection name with a slash is also the container name
+    if "/" in collection.name:
+        name = collection.name
+    elif not name_regex.match(name):
+        return None, "%s is not a valid name." % name
+    if not name_regex.match(tag):
+        return None, "%s is not a valid tag." % tag
+
+    if (container.collection_id, container.name, container.tag) == (
+        collection.id,
+        name,
+        tag,
+    ):
+        return container, None
+
+    metadata = {
+        key: value
+        for key, value in container.metadata.items()
+        if key not in ["storage", "upload_storage"]
+    }
+
+    # An image in minio needs to be stored by digest to be shared
+    in_minio = container.image is None and not metadata.get("image")
+    if in_minio and not store_by_digest(container):
+        message = "%s has no image to promote." % container.get_uri()
+        bot.error(message)
+        return None, message
+
+    with transaction.atomic():
+        existing = (
+            Container.objects.select_for_update()
+            .filter(collection=collection, name=name, tag=tag)
+            .first()
+        )
+        if existing is not None:
+            if existing.frozen:
+                return None, "%s:%s exists, and is frozen." % (name, tag)
+            existing.delete()
+
+        promoted = Container.objects.create(
+            collection=collection,
+            name=name,
+            tag=tag,
+            image=container.image,
+            version=container.version,
+            size_bytes=container.size_bytes,
+            arch=container.arch,
+            metadata=metadata,
+        )
+        # Without the stored object, the promoted container couldn't be pulled
+        if in_minio and not add_storage_reference(promoted):
+            message = "%s has no image to promote." % container.get_uri()
+            bot.error(message)
+            transaction.set_rollback(True)
+            return None, message
+
+    bot.info("Promoted %s to %s" % (container.get_uri(), promoted.get_uri()))
+    return promoted, None
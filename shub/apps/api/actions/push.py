@@ -17,7 +17,12 @@ from django.views.decorators.csrf import csrf_exempt
 from ratelimit.decorators import ratelimit
 from rest_framework.exceptions import PermissionDenied
 
-from shub.apps.api.utils import get_request_user, has_permission, validate_request
+from shub.apps.api.utils import (
+    get_auth_context,
+    get_request_user,
+    has_permission,
+    validate_request,
+)
 from shub.apps.main.models import Collection
 from shub.apps.main.utils import format_collection_name
 from shub.settings import DISABLE_BUILDING
@@ -36,7 +41,7 @@ def collection_auth_check(request):
     if DISABLE_BUILDING:
         raise PermissionDenied(detail="Push is disabled.")
 
-    auth = request.META.get("HTTP_AUTHORIZATION", None)
+    auth = get_auth_context(request)
 
     # Load the body, which is json with variables
     body_unicode = request.body.decode("utf-8")
@@ -47,7 +52,7 @@ def collection_auth_check(request):
     name = body.get("name")
     collection_name = format_collection_name(body.get("collection"))
 
-    print(tag, name, collection_name, auth, body)
+    print(tag, name, collection_name, body)
 
     # Authentication always required for push
     if auth is None:
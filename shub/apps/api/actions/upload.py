@@ -9,17 +9,31 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """
 
 import os
+import re
+import uuid
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import JsonResponse
+from django.db import transaction
+from django.http import HttpResponseNotAllowed, JsonResponse
+from django.middleware.csrf import CsrfViewMiddleware
 from django.shortcuts import redirect
+from django.utils.timezone import now
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.views.generic.base import TemplateView
 from ratelimit.decorators import ratelimit
 from rest_framework.exceptions import PermissionDenied
 
-from shub.apps.api.utils import get_request_user, has_permission, validate_request
+from shub.apps.api.hashes import HASH_BLOCK_SIZE, upload_hashes
+from shub.apps.api.models import ImageUpload, get_upload_to
+from shub.apps.api.utils import (
+    get_auth_context,
+    get_request_user,
+    has_permission,
+    validate_request,
+)
 from shub.apps.main.models import Collection
 from shub.settings import DISABLE_BUILDING
 from shub.settings import VIEW_RATE_LIMIT as rl_rate
@@ -42,7 +56,7 @@ def upload_complete(request):
         filename = request.POST.get("file1.name")
         name = request.POST.get("name")
         version = request.POST.get("file1.md5")
-        auth = request.META.get("HTTP_AUTHORIZATION", None)
+        auth = get_auth_context(request)
         tag = request.POST.get("tag")
         csrftoken = request.META.get("CSRF_COOKIE")
 
@@ -84,7 +98,15 @@ def upload_complete(request):
         if tag is not None:
             name = "%s:%s" % (name, tag)
 
-        # Expected params are upload_id, name, md5, and cid
+        # nginx calculates the sha256 as the file is received (if configured).
+        # It's only used when the upload module passed the request (the internal
+        # location sets SREGISTRY_UPLOAD_MODULE), otherwise it's calculated
+        from_nginx = request.META.get("SREGISTRY_UPLOAD_MODULE") == "on"
+        sha256 = request.POST.get("file1.sha256", "")
+        if from_nginx and sha256_regex.match(sha256):
+            version = "sha256.%s" % sha256
+
+        # Expected params are upload_id, name, version, and cid
         message = upload_container(
             cid=collection.id,
             user=owner,
@@ -106,10 +128,271 @@ def upload_complete(request):
     return redirect("collections")
 
 
+sha256_regex = re.compile("^[0-9a-f]{64}$")
+
+
+def get_upload_user(request, collection, signed=None):
+    """return the user uploading to a collection, or None. A terminal client
+    authenticates like an upload (the collection, name and tag are signed),
+    and the web interface with the session (and csrf token). The name and
+    tag signed can be given (signed), by default they are the ones posted.
+    """
+    auth = get_auth_context(request)
+    if auth is not None:
+        timestamp = generate_timestamp()
+        name, tag = signed or (request.POST.get("name"), request.POST.get("tag"))
+        payload = "upload|%s|%s|%s|%s|" % (collection.name, timestamp, name, tag)
+        if validate_request(auth, payload, "upload", timestamp):
+            return get_request_user(auth)
+        return None
+
+    # The web interface must send the csrf token
+    if request.user.is_authenticated:
+        csrf = CsrfViewMiddleware(lambda request: None)
+        if csrf.process_view(request, None, (), {}) is None:
+            return request.user
+    return None
+
+
+@ratelimit(key="ip", rate=rl_rate, block=rl_block)
+@csrf_exempt
+@require_POST
+def upload_existing(request):
+    """add a container to a collection from an image that is already stored,
+    without uploading it. Before an upload, a client can send the sha256 of
+    the image (with the collection, name and tag, authenticated like an
+    upload). If the image is stored, and the user can pull a container with
+    it, the container is added. Otherwise the response is a 404, and the
+    client uploads the image.
+    """
+    from shub.apps.api.actions.create import upload_container
+    from shub.apps.api.dedup import get_stored_blob, link_blob
+
+    if DISABLE_BUILDING:
+        return JsonResponse({"message": "Uploading is disabled."}, status=403)
+
+    try:
+        collection = Collection.objects.get(id=request.POST.get("collection"))
+    except (Collection.DoesNotExist, ValueError):
+        return JsonResponse({"message": "Collection not found."}, status=404)
+
+    user = get_upload_user(request, collection)
+    if user is None or not collection.owners.filter(id=user.id).exists():
+        return JsonResponse({"message": "Unauthorized"}, status=403)
+
+    name = request.POST.get("name")
+    tag = request.POST.get("tag")
+    digest = request.POST.get("sha256", "")
+    if not name or not sha256_regex.match(digest):
+        return JsonResponse({"message": "A name and sha256 are required."}, status=400)
+
+    blob = get_stored_blob(digest, user)
+    if blob is None:
+        return JsonResponse({"message": "Image not found."}, status=404)
+
+    # If tag is provided, add to name
+    if tag:
+        name = "%s:%s" % (name, tag)
+
+    # The stored image is linked to a new upload, and added like one
+    path = link_blob(blob)
+    message = upload_container(
+        cid=collection.id,
+        user=user,
+        version="sha256.%s" % digest,
+        upload_id=path,
+        name=name,
+        size=os.path.getsize(path),
+    )
+    if message is not None:
+        if os.path.exists(path):
+            os.remove(path)
+        return JsonResponse({"message": message}, status=400)
+
+    return JsonResponse(
+        {"message": "Upload Complete", "url": collection.get_absolute_url()}
+    )
+
+
+# Chunked Upload
+
+content_range_regex = re.compile(r"^bytes (?P<start>\d+)-(?P<end>\d+)/(\d+|\*)$")
+
+
+def get_chunked_upload(request, upload_id, signed=None):
+    """return the unfinished chunked upload with an upload_id, or None if it
+    doesn't exist, or the request isn't from the user that started it. A
+    terminal client signs the upload_id (as the name, with an empty tag) to
+    send chunks, and the name and tag to complete the upload (signed).
+    """
+    try:
+        upload = ImageUpload.objects.get(upload_id=upload_id, completed_on__isnull=True)
+        collection = Collection.objects.get(id=upload.collection_id)
+    except (ImageUpload.DoesNotExist, Collection.DoesNotExist):
+        return None
+
+    user = get_upload_user(request, collection, signed or (upload_id, ""))
+    if user is None or user.id != upload.user_id:
+        return None
+    return upload
+
+
+def upload_response(upload, status=200, message=None):
+    """the state of a chunked upload, the offset is where the next chunk starts"""
+    response = {"upload_id": upload.upload_id, "offset": upload.offset}
+    if message is not None:
+        response["message"] = message
+    return JsonResponse(response, status=status)
+
+
+@ratelimit(key="ip", rate=rl_rate, block=rl_block)
+@csrf_exempt
+@require_POST
+def chunked_upload_start(request):
+    """start a chunked upload of a container to a collection. A terminal
+    client authenticates like an upload, and the web interface with the
+    session. The upload_id returned is used to send chunks, resume,
+    and complete the upload.
+    """
+    if DISABLE_BUILDING:
+        return JsonResponse({"message": "Uploading is disabled."}, status=403)
+
+    try:
+        collection = Collection.objects.get(id=request.POST.get("collection"))
+    except (Collection.DoesNotExist, ValueError):
+        return JsonResponse({"message": "Collection not found."}, status=404)
+
+    # Only owners can upload to a collection
+    user = get_upload_user(request, collection)
+    if user is None or not collection.owners.filter(id=user.id).exists():
+        return JsonResponse({"message": "Unauthorized"}, status=403)
+
+    upload = ImageUpload(
+        upload_id=str(uuid.uuid4()),
+        user=user,
+        collection_id=collection.id,
+        filename=request.POST.get("filename", ""),
+    )
+    upload.file.name = get_upload_to(upload, upload.filename)
+    os.makedirs(os.path.dirname(upload.file.path), exist_ok=True)
+    open(upload.file.path, "wb").close()
+    upload.save()
+    return upload_response(upload, status=201)
+
+
+@csrf_exempt
+def chunked_upload(request, upload_id):
+    """GET returns the offset of a chunked upload, to resume. PUT appends
+    a chunk (the request body), with a Content-Range that must start at the
+    offset. The upload hashes are updated as the chunk is received.
+    """
+    upload = get_chunked_upload(request, upload_id)
+    if upload is None:
+        return JsonResponse({"message": "Upload not found."}, status=404)
+
+    if request.method == "GET":
+        return upload_response(upload)
+
+    if request.method != "PUT":
+        return HttpResponseNotAllowed(["GET", "PUT"])
+
+    match = content_range_regex.match(request.META.get("HTTP_CONTENT_RANGE", ""))
+    if not match:
+        return upload_response(upload, 400, "A Content-Range header is required.")
+    start, end = int(match.group("start")), int(match.group("end"))
+
+    # Only one chunk is appended to an upload at once
+    with transaction.atomic():
+        upload = ImageUpload.objects.select_for_update().get(id=upload.id)
+        if start != upload.offset:
+            return upload_response(upload, 409, "The chunk must start at the offset.")
+
+        md5, sha256 = upload_hashes.get(upload.upload_id, upload.file.path, start)
+
+        # Bytes after the offset are from a chunk that didn't finish
+        received = 0
+        with open(upload.file.path, "r+b") as fd:
+            fd.seek(start)
+            fd.truncate()
+            while True:
+                block = request.read(HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                fd.write(block)
+                md5.update(block)
+                sha256.update(block)
+                received += len(block)
+
+        if received != end - start + 1:
+            upload_hashes.clear(upload.upload_id)
+            return upload_response(upload, 400, "The chunk is incomplete.")
+
+        upload.offset += received
+        upload.save(update_fields=["offset"])
+        upload_hashes.set(upload.upload_id, upload.offset, md5, sha256)
+
+    return upload_response(upload)
+
+
+@ratelimit(key="ip", rate=rl_rate, block=rl_block)
+@csrf_exempt
+@require_POST
+def chunked_upload_complete(request, upload_id):
+    """complete a chunked upload, adding the container to the collection.
+    The file is moved (renamed) to storage, and the hashes calculated as
+    chunks were received are used for the version. An md5 can be sent to
+    verify the upload.
+    """
+    from shub.apps.api.actions.create import upload_container
+
+    name = request.POST.get("name")
+    tag = request.POST.get("tag")
+    upload = get_chunked_upload(request, upload_id, signed=(name, tag))
+    if upload is None:
+        return JsonResponse({"message": "Upload not found."}, status=404)
+
+    if not name:
+        return upload_response(upload, 400, "A container name is required.")
+
+    md5, sha256 = upload_hashes.get(upload.upload_id, upload.file.path, upload.offset)
+    upload_hashes.clear(upload.upload_id)
+
+    if request.POST.get("md5") not in [None, md5.hexdigest()]:
+        return upload_response(upload, 400, "The md5 of the upload does not match.")
+
+    upload.md5sum = md5.hexdigest()
+    upload.sha256sum = sha256.hexdigest()
+    upload.completed_on = now()
+    upload.save()
+
+    # If tag is provided, add to name
+    if tag:
+        name = "%s:%s" % (name, tag)
+
+    message = upload_container(
+        cid=upload.collection_id,
+        user=upload.user,
+        version="sha256.%s" % upload.sha256sum,
+        upload_id=upload.upload_id,
+        name=name,
+        size=upload.offset,
+    )
+
+    # If the function doesn't return a message (None), indicates success
+    if message is not None:
+        return JsonResponse({"message": message}, status=400)
+
+    collection = Collection.objects.get(id=upload.collection_id)
+    return JsonResponse(
+        {"message": "Upload Complete", "url": collection.get_absolute_url()}
+    )
+
+
 class UploadUI(LoginRequiredMixin, TemplateView):
     template_name = "routes/upload.html"
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["collection"] = Collection.objects.get(id=context["cid"])
+        context["chunk_size"] = settings.UPLOAD_CHUNK_SIZE_MB << 20
         return context
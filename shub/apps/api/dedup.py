@@ -0,0 +1,157 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+import fcntl
+import os
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from shub.apps.api.models import ImageBlob, ImageFile
+from shub.logger import bot
+from shub.settings import IMAGE_DEDUPLICATION
+
+################################################################################
+# DEDUPLICATION
+################################################################################
+
+# An image is kept once per (sha256) digest, in IMAGE_BLOB_ROOT, and each
+# ImageFile with the same digest is a link to it: a reflink (copy on write)
+# where the filesystem supports it (e.g., btrfs, xfs), and otherwise a
+# hardlink. An ImageBlob counts the ImageFiles linked to it, and the blob is
+# removed when the last one is released (see shub.apps.main.models.signals).
+
+# Clone a file (reflink), from linux/fs.h
+FICLONE = 0x40049409
+
+
+def reflink(source, dest):
+    """clone source to a new file dest, sharing its data (copy on write)"""
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def link_file(source, dest):
+    """make dest the same file as source, with a reflink, or a hardlink if
+    the filesystem doesn't support it. The link is made beside dest, and then
+    moved over it, so dest is always a complete file.
+    """
+    dirname = os.path.dirname(dest)
+    os.makedirs(dirname, exist_ok=True)
+    tmp = os.path.join(dirname, ".%s.tmp" % uuid.uuid4().hex)
+    try:
+        try:
+            reflink(source, tmp)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            os.link(source, tmp)
+        os.replace(tmp, dest)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def deduplicate_image(image_file, digest):
+    """link an ImageFile to the ImageBlob for its digest: an image already
+    stored replaces the file, and otherwise the file is stored. The digest
+    must be calculated by the server (by the nginx upload module, as chunks
+    are received, or by calculate_version), never sent by a client.
+    Returns True if the ImageFile is now linked.
+
+    Parameters
+    ==========
+    image_file: the ImageFile of the uploaded container
+    digest: the sha256 digest of the image
+    """
+    if not IMAGE_DEDUPLICATION or image_file is None or image_file.digest:
+        return False
+
+    path = image_file.datafile.path
+    with transaction.atomic():
+        blob, _ = ImageBlob.objects.select_for_update().get_or_create(digest=digest)
+        blob_path = blob.get_abspath()
+        try:
+            if not os.path.exists(blob_path):
+                link_file(path, blob_path)
+            elif os.path.getsize(blob_path) != os.path.getsize(path):
+                raise OSError("size is different from %s" % blob_path)
+            elif not os.path.samefile(blob_path, path):
+                link_file(blob_path, path)
+        except OSError as e:
+            bot.warning("Cannot deduplicate %s: %s" % (path, e))
+            transaction.set_rollback(True)
+            return False
+
+        ImageBlob.objects.filter(id=blob.id).update(refcount=F("refcount") + 1)
+        ImageFile.objects.filter(id=image_file.id).update(digest=digest)
+        image_file.digest = digest
+    return True
+
+
+def release_image(image_file):
+    """release the ImageBlob an ImageFile is linked to (when the ImageFile or
+    its file is deleted), and remove the blob when it's no longer linked.
+    The digest is cleared first, so a reference is only released once.
+    Returns True if the blob was removed.
+    """
+    digest = image_file.digest
+    if not digest:
+        return False
+
+    with transaction.atomic():
+        cleared = ImageFile.objects.filter(id=image_file.id, digest=digest).update(
+            digest=None
+        )
+        if not cleared and ImageFile.objects.filter(id=image_file.id).exists():
+            return False
+        image_file.digest = None
+
+        ImageBlob.objects.filter(digest=digest, refcount__gt=0).update(
+            refcount=F("refcount") - 1
+        )
+        blob = ImageBlob.objects.filter(digest=digest, refcount=0).first()
+        if blob is None:
+            return False
+        path = blob.get_abspath()
+        blob.delete()
+
+    bot.info("Deleting %s, no longer used." % path)
+    transaction.on_commit(lambda: os.path.exists(path) and os.remove(path))
+    return True
+
+
+def get_stored_blob(digest, user):
+    """return the ImageBlob for a digest, if it's stored and the user can pull
+    a container with it (so a digest doesn't reveal a private container),
+    otherwise None.
+    """
+    from shub.apps.main.query import visible_containers
+
+    blob = ImageBlob.objects.filter(digest=digest, refcount__gt=0).first()
+    if (
+        blob is None
+        or not os.path.exists(blob.get_abspath())
+        or not visible_containers(user).filter(image__digest=digest).exists()
+    ):
+        return None
+    return blob
+
+
+def link_blob(blob):
+    """link a stored image to a new file in UPLOAD_PATH, to add it like an
+    upload. Returns the path of the file.
+    """
+    path = os.path.join(settings.UPLOAD_PATH, "%s.sif" % uuid.uuid4())
+    link_file(blob.get_abspath(), path)
+    return path
@@ -0,0 +1,101 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+import hashlib
+import mmap
+from collections import OrderedDict
+from threading import Lock
+
+# Files are read (and hashed) in blocks of this size
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class UploadHashes:
+    """the md5 and sha256 of a chunked upload, updated as chunks arrive.
+    Hash state can't be saved, so each worker keeps the hashes of the
+    uploads it has seen (up to size). A worker that doesn't have the hashes
+    up to a chunk's offset reads the bytes it missed from the partial file,
+    so each worker reads an upload at most once.
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, upload_id, path, offset):
+        """return (md5, sha256) hashes for the first offset bytes of an upload"""
+        with self.lock:
+            entry = self.entries.pop(upload_id, None)
+
+        # Start over if we don't have hashes, or they are past the offset
+        if entry is None or entry[0] > offset:
+            entry = (0, hashlib.md5(), hashlib.sha256())
+
+        hashed, md5, sha256 = entry
+        if hashed < offset:
+            update_file_hashes(path, [md5, sha256], start=hashed, end=offset)
+        return md5, sha256
+
+    def set(self, upload_id, offset, md5, sha256):
+        """save the hashes for an upload at an offset"""
+        with self.lock:
+            self.entries[upload_id] = (offset, md5, sha256)
+            self.entries.move_to_end(upload_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self, upload_id):
+        with self.lock:
+            self.entries.pop(upload_id, None)
+
+
+upload_hashes = UploadHashes()
+
+
+def update_file_hashes(path, hashes, start=0, end=None):
+    """update one or more hashes with the bytes of a file from start to end
+    (exclusive, defaults to the end of the file), reading large blocks.
+    """
+    with open(path, "rb") as fd:
+        fd.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            size = (
+                HASH_BLOCK_SIZE
+                if remaining is None
+                else min(HASH_BLOCK_SIZE, remaining)
+            )
+            block = fd.read(size)
+            if not block:
+                break
+            for hash_object in hashes:
+                hash_object.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return hashes
+
+
+def get_file_digest(path, algorithm="sha256"):
+    """return the hex digest of a file, hashed from a memory map of the file
+    (the whole file in one update), or with large reads if it can't be
+    mapped (e.g., an empty file).
+    """
+    try:
+        hash_object = hashlib.new(algorithm)
+        with open(path, "rb") as fd:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                hash_object.update(mapped)
+    except (ValueError, OSError):
+        hash_object = hashlib.new(algorithm)
+        update_file_hashes(path, [hash_object])
+    return hash_object.hexdigest()
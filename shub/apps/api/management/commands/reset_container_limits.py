@@ -10,18 +10,17 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from django.core.management.base import BaseCommand
 
-from shub.apps.main.models import Collection, Container
+from shub.apps.main.limits import reset_get_counts
 
 
 def reset_limits():
-    containers = Container.objects.all()
-    containers.update(get_count=0)
-    collections = Collection.objects.all()
-    collections.update(get_count=0)
+    reset_get_counts()
 
 
 class Command(BaseCommand):
-    """scheduled to run once a week on Monday, reset get_count to 0."""
+    """GET counts roll over to a new window each week (Monday), this resets
+    the counts for the current week.
+    """
 
     help = "Reset container get counts to 0"
 
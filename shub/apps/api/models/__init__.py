@@ -66,6 +66,9 @@ class ImageFile(models.Model):
     owner_id = models.CharField(max_length=200, null=True)
     datafile = models.FileField(upload_to=get_upload_folder, max_length=255)
 
+    # The sha256 digest of a deduplicated image, linked to an ImageBlob
+    digest = models.CharField(max_length=64, null=True, blank=True)
+
     def get_label(self):
         return "imagefile"
 
@@ -76,6 +79,24 @@ class ImageFile(models.Model):
         app_label = "api"
 
 
+class ImageBlob(models.Model):
+    """An ImageBlob is an image kept once (by sha256 digest) in IMAGE_BLOB_ROOT,
+    with a count of the ImageFiles that are linked to it (see shub.apps.api.dedup)
+    """
+
+    digest = models.CharField(max_length=64, null=False, blank=False, unique=True)
+    refcount = models.PositiveIntegerField(null=False, blank=False, default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def get_abspath(self):
+        return os.path.join(
+            settings.IMAGE_BLOB_ROOT, self.digest[:2], "%s.sif" % self.digest
+        )
+
+    class Meta:
+        app_label = "api"
+
+
 ################################################################################
 # UPLOADS
 ################################################################################
@@ -93,8 +114,22 @@ class ImageUpload(models.Model):
     created_on = models.DateTimeField(auto_now_add=True)
     completed_on = models.DateTimeField(null=True, blank=True)
 
+    # A chunked upload is started by a user for a collection. The collection
+    # is kept by id, since main already depends on api (a foreign key would
+    # be a circular migration dependency)
+    user = models.ForeignKey(
+        "users.User", null=True, blank=True, on_delete=models.CASCADE
+    )
+    collection_id = models.IntegerField(null=True, blank=True)
+
+    # Hashes are calculated as chunks are received, and saved on complete
+    md5sum = models.CharField(max_length=32, null=True, blank=True)
+    sha256sum = models.CharField(max_length=64, null=True, blank=True)
+
     @property
     def md5(self):
+        if self.md5sum is not None:
+            return self.md5sum
         if getattr(self, "_md5", None) is None:
             md5 = hashlib.md5()
             for chunk in self.file.chunks():
@@ -12,6 +12,7 @@ from django.conf import settings
 from django.urls import re_path
 from rest_framework import serializers, viewsets
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
 from shub.apps.api.utils import ObjectOnlyPermissions
@@ -93,14 +94,18 @@ class CollectionSearch(APIView):
     a general search to look across all fields for one term
     """
 
+    pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
+
     def get_object(self, query):
         collections = collection_query(query.lower())
-        return collections
+        return collections.prefetch_related("containers__collection")
 
     def get(self, request, query):
         collections = self.get_object(query)
-        serializer = CollectionSerializer(collections)
-        return Response(serializer.data)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(collections, request, view=self)
+        serializer = CollectionSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 
 ################################################################################
@@ -16,8 +16,10 @@ from rest_framework.exceptions import NotFound, PermissionDenied
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from shub.apps.api.utils import has_permission, validate_request
+from shub.apps.api.utils import get_auth_context, has_permission, validate_request
 from shub.apps.logs.mixins import LoggingMixin
+from shub.apps.logs.utils import increment_container_downloads
+from shub.apps.main.limits import get_limit_reached
 from shub.apps.main.models import Container
 from sregistry.main.registry.auth import generate_timestamp
 
@@ -59,6 +61,9 @@ class SingleContainerSerializer(serializers.ModelSerializer):
             "add_date",
             "metrics",
             "version",
+            "size_bytes",
+            "digest",
+            "arch",
             "tag",
             "frozen",
             "metadata",
@@ -94,6 +99,9 @@ class ContainerSerializer(serializers.HyperlinkedModelSerializer):
             "add_date",
             "metrics",
             "version",
+            "size_bytes",
+            "digest",
+            "arch",
             "tag",
             "frozen",
             "metadata",
@@ -215,10 +223,7 @@ def _container_get(request, container, name=None, tag=None):
         tag = container.tag
 
     # The user isn't allowed to get more than the limit
-    if container.get_count >= container.get_limit:
-        return Response(429)
-
-    if container.collection.get_count >= container.collection.get_limit:
+    if get_limit_reached(container):
         return Response(429)
 
     # All public images are pull-able
@@ -226,11 +231,12 @@ def _container_get(request, container, name=None, tag=None):
     is_private = container.collection.private
 
     if not is_private:
+        increment_container_downloads(container.id)
         serializer = SingleContainerSerializer(container)
         return Response(serializer.data)
 
     # Determine if user has permission to get if private
-    auth = request.META.get("HTTP_AUTHORIZATION")
+    auth = get_auth_context(request)
 
     if auth is None:
         print("Auth is None")
@@ -246,6 +252,7 @@ def _container_get(request, container, name=None, tag=None):
     payload = "pull|%s|%s|%s|%s|" % (container.collection.name, timestamp, name, tag)
 
     if validate_request(auth, payload, "pull", timestamp):
+        increment_container_downloads(container.id)
         serializer = SingleContainerSerializer(container)
         return Response(serializer.data)
 
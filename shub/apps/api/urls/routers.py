@@ -13,7 +13,14 @@ from django.urls import include, re_path
 from rest_framework import routers
 
 from shub.apps.api.actions.push import collection_auth_check
-from shub.apps.api.actions.upload import UploadUI, upload_complete
+from shub.apps.api.actions.upload import (
+    UploadUI,
+    chunked_upload,
+    chunked_upload_complete,
+    chunked_upload_start,
+    upload_complete,
+    upload_existing,
+)
 from shub.apps.api.urls.collections import CollectionViewSet
 from shub.apps.api.urls.containers import ContainerViewSet
 
@@ -32,4 +39,16 @@ urlpatterns = [
     ),
     re_path(r"^upload/(?P<cid>.+?)/?$", UploadUI.as_view(), name="chunked_upload"),
     re_path(r"^uploads/complete/?$", upload_complete, name="terminal_upload_complete"),
+    re_path(r"^uploads/existing/?$", upload_existing, name="upload_existing"),
+    re_path(r"^uploads/chunked/?$", chunked_upload_start, name="chunked_upload_start"),
+    re_path(
+        r"^uploads/chunked/(?P<upload_id>[0-9a-f-]+)/complete/?$",
+        chunked_upload_complete,
+        name="chunked_upload_complete",
+    ),
+    re_path(
+        r"^uploads/chunked/(?P<upload_id>[0-9a-f-]+)/?$",
+        chunked_upload,
+        name="chunked_upload_chunk",
+    ),
 ]
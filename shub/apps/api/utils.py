@@ -12,9 +12,13 @@ import base64
 import hashlib
 import hmac
 import re
+from functools import cached_property
 
+from rest_framework.authtoken.models import Token
 from rest_framework.permissions import SAFE_METHODS, DjangoObjectPermissions
 
+from shub.apps.main.models import CollectionPermission
+from shub.apps.main.models.permissions import EDIT_LEVELS, VIEW_LEVELS
 from shub.apps.users.models import User
 from shub.logger import bot
 from shub.settings import USER_COLLECTIONS
@@ -39,29 +43,125 @@ def _parse_header(auth):
     return values
 
 
+class AuthContext:
+    """the authentication of one request: the SREGISTRY-HMAC-SHA256 header is
+    parsed once, and the user is loaded with its token in one (joined) query.
+    Permissions are checked against the ids of collection owners and
+    contributors, loaded once per collection (in one query).
+
+    Parameters
+    ==========
+    auth: the challenge from the header
+    """
+
+    def __init__(self, auth):
+        self.auth = auth
+        try:
+            self.values = _parse_header(auth)
+        except ValueError:
+            self.values = {"header": None}
+
+        self.kind = self.username = self.timestamp = None
+        if "Credential" in self.values:
+            try:
+                kind, username, self.timestamp = self.values["Credential"].split("/")
+                self.username = base64.b64decode(username).decode("utf-8")
+                self.kind = kind
+            except ValueError:
+                pass
+        self.members = {}
+
+    @cached_property
+    def user(self):
+        if self.username is None:
+            return None
+        user = (
+            User.objects.select_related("auth_token")
+            .filter(username=self.username)
+            .first()
+        )
+        if user is None:
+            bot.debug("%s is not a valid user, request invalid." % self.username)
+        return user
+
+    @cached_property
+    def token(self):
+        """the key of the user token (created if the user doesn't have one)"""
+        try:
+            return self.user.auth_token.key
+        except Token.DoesNotExist:
+            return self.user.token
+
+    def get_member_ids(self, collection):
+        """return the ids of the owners, and of the owners and contributors,
+        of a collection
+        """
+        if collection.id not in self.members:
+            owner_ids, member_ids = set(), set()
+            for user_id, level in CollectionPermission.objects.filter(
+                collection_id=collection.id, level__in=VIEW_LEVELS
+            ).values_list("user_id", "level"):
+                member_ids.add(user_id)
+                if level in EDIT_LEVELS:
+                    owner_ids.add(user_id)
+            self.members[collection.id] = (owner_ids, member_ids)
+        return self.members[collection.id]
+
+    def has_permission(self, collection=None, pull_permission=True):
+        """determine if the user can pull from (view), or push to (own)
+        a collection, see has_pull_permission and has_push_permission
+        """
+        user = self.user
+        if user is None:
+            return False
+
+        if user.is_superuser or user.is_staff:
+            return True
+
+        # A new collection is pushable for a regular user if USER_COLLECTIONS True
+        if collection is None:
+            return False if pull_permission else USER_COLLECTIONS
+
+        # All public collections are viewable
+        if pull_permission and not collection.private:
+            return True
+
+        owner_ids, member_ids = self.get_member_ids(collection)
+        if pull_permission:
+            return user.id in member_ids
+        return user.id in owner_ids
+
+
+def get_auth_context(request):
+    """return the auth context of a request (saved with the request, so it's
+    only created once), or None if there is no authorization header. An auth
+    context, or header, is also accepted.
+    """
+    if request is None or isinstance(request, AuthContext):
+        return request
+    if isinstance(request, str):
+        return AuthContext(request)
+
+    if not hasattr(request, "_sregistry_auth"):
+        auth = request.META.get("HTTP_AUTHORIZATION")
+        request._sregistry_auth = AuthContext(auth) if auth else None
+    return request._sregistry_auth
+
+
 def get_request_user(auth, user=None):
     """get the user for the request from an authorization object
 
     Parameters
     ==========
-    auth: the authentication object
+    auth: the authentication object (header, or auth context)
     user: will return as None if not able to obtain from auth
 
     """
-    values = _parse_header(auth)
-
-    if "Credential" not in values:
+    context = get_auth_context(auth)
+    if context is None or context.username is None:
         bot.debug("Headers missing, request is invalid.")
         return user
-
-    _, username, _ = values["Credential"].split("/")
-    username = base64.b64decode(username).decode("utf-8")
-
-    try:
-        user = User.objects.get(username=username)
-    except Exception:
-        bot.debug("%s is not a valid user, request invalid." % username)
-    return user
+    return context.user or user
 
 
 def has_push_permission(user, collection=None):
@@ -83,10 +183,7 @@ def has_push_permission(user, collection=None):
         return USER_COLLECTIONS
 
     # Otherwise, only owners can push to an existing
-    if user in collection.owners.all():
-        return True
-
-    return False
+    return collection.has_edit_permission(user)
 
 
 def has_pull_permission(user, collection=None):
@@ -120,18 +217,15 @@ def has_permission(auth, collection=None, pull_permission=True):
 
     Parameters
     ==========
-    auth: the challenge from the header
+    auth: the challenge from the header (or auth context)
     collection: the collection instance to check for
     pull_permission: if True, the user is asking to pull. If False, push
 
     """
-    user = get_request_user(auth)
-    if user is None:
+    context = get_auth_context(auth)
+    if context is None:
         return False
-
-    if pull_permission is True:
-        return has_pull_permission(user, collection)
-    return has_push_permission(user, collection)
+    return context.has_permission(collection, pull_permission=pull_permission)
 
 
 def validate_request(auth, payload, sender="push", timestamp=None, superuser=True):
@@ -139,7 +233,7 @@ def validate_request(auth, payload, sender="push", timestamp=None, superuser=Tru
 
     Parameters
     ==========
-    auth: the Authorization header content
+    auth: the Authorization header content (or auth context)
     payload: the payload to assess
     timestamp: the timestamp associated with the request
     superuser: if the user must be superuser for validity
@@ -149,36 +243,32 @@ def validate_request(auth, payload, sender="push", timestamp=None, superuser=Tru
     True if the request is valid, False if not
 
     """
-    values = _parse_header(auth)
+    context = get_auth_context(auth)
+    values = context.values
 
     if values["header"] != "SREGISTRY-HMAC-SHA256":
         print("Invalid SREGISTRY Authentication scheme, request invalid.")
         return False
 
-    if "Credential" not in values or "Signature" not in values:
+    if context.username is None or "Signature" not in values:
         print("Headers missing, request is invalid.")
         return False
 
-    kind, username, ts = values["Credential"].split("/")
-    username = base64.b64decode(username).decode("utf-8")
-    if kind != sender:
-        print("Mismatch: type (%s) sender (%s) invalid." % (kind, sender))
+    if context.kind != sender:
+        print("Mismatch: type (%s) sender (%s) invalid." % (context.kind, sender))
         return False
 
     if timestamp is not None:
-        if ts != timestamp:
-            bot.debug("%s is expired, must be %s." % (ts, timestamp))
+        if context.timestamp != timestamp:
+            bot.debug("%s is expired, must be %s." % (context.timestamp, timestamp))
             return False
 
-    try:
-        user = User.objects.get(username=username)
-    except Exception:
-        print("%s is not a valid user, request invalid." % username)
+    if context.user is None:
+        print("%s is not a valid user, request invalid." % context.username)
         return False
 
     request_signature = values["Signature"]
-    secret = user.token
-    return validate_secret(secret, payload, request_signature)
+    return validate_secret(context.token, payload, request_signature)
 
 
 def encode(item):
@@ -8,6 +8,8 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 """
 
+from django.conf import settings
+from django.core.paginator import Paginator
 from django.shortcuts import render
 from ratelimit.decorators import ratelimit
 
@@ -17,6 +19,14 @@ from shub.settings import VIEW_RATE_LIMIT_BLOCK as rl_block
 # Search Pages #################################################################
 
 
+def get_search_page(request, query):
+    """return the requested page of (ranked) collections for a query"""
+    from shub.apps.main.query import collection_query
+
+    paginator = Paginator(collection_query(query), settings.SEARCH_PAGE_SIZE)
+    return paginator.get_page(request.GET.get("page"))
+
+
 @ratelimit(key="ip", rate=rl_rate, block=rl_block)
 def search_view(request):
     context = {"active": "share"}
@@ -26,12 +36,10 @@ def search_view(request):
 @ratelimit(key="ip", rate=rl_rate, block=rl_block)
 def search_query(request, query=None):
     """query is a post, and results returned immediately"""
-    from shub.apps.main.query import collection_query
-
     context = {"submit_result": "anything"}
     if query is not None:
-        results = collection_query(query)
-        context["results"] = results
+        context["results"] = get_search_page(request, query)
+        context["q"] = query
 
     return render(request, "search/search_single_page.html", context)
 
@@ -41,12 +49,10 @@ def container_search(request):
     """container_search is the ajax driver to show results for a container search.
     by default we search container collection name.
     """
-    from shub.apps.main.query import collection_query
-
-    if request.is_ajax():
+    if request.headers.get("x-requested-with") == "XMLHttpRequest":
         q = request.GET.get("q")
         if q is not None:
-            results = collection_query(q)
-            context = {"results": results, "submit_result": "anything"}
+            results = get_search_page(request, q)
+            context = {"results": results, "q": q, "submit_result": "anything"}
 
             return render(request, "search/result.html", context)
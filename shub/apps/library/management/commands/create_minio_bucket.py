@@ -0,0 +1,54 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shub.apps.library.views.minio import create_bucket
+from shub.logger import bot
+from shub.settings import MINIO_BUCKET
+
+
+class Command(BaseCommand):
+    """create the minio bucket if it doesn't exist. This is run once on
+    startup (run_uwsgi.sh), so workers don't check for the bucket when
+    they start. Minio may still be starting, so the check is retried.
+    """
+
+    help = "Create the minio storage bucket if it doesn't exist"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--wait",
+            dest="wait",
+            default=60,
+            type=int,
+            help="Seconds to wait for minio to be available (default 60).",
+        )
+
+    def handle(self, *args, **options):
+        deadline = time.monotonic() + options["wait"]
+        while True:
+            try:
+                created = create_bucket()
+                break
+            except Exception as e:
+                if time.monotonic() >= deadline:
+                    raise CommandError(
+                        "Cannot create bucket %s: %s" % (MINIO_BUCKET, e)
+                    )
+                bot.warning("Minio is not available, retrying: %s" % e)
+                time.sleep(2)
+
+        if created:
+            bot.info("Created bucket %s." % MINIO_BUCKET)
+        else:
+            bot.info("Bucket %s exists." % MINIO_BUCKET)
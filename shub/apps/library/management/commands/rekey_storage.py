@@ -0,0 +1,90 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+
+from shub.apps.library.views.minio import (
+    add_storage_reference,
+    get_digest,
+    get_minio_client,
+    get_s3_client,
+    object_exists,
+)
+from shub.apps.main.models import Container, StorageObject
+from shub.logger import bot
+from shub.settings import MINIO_BUCKET
+
+
+class Command(BaseCommand):
+    """move containers pushed with the legacy storage layout (one object per
+    collection, name and version) to the content addressed layout (one object
+    per digest). Each object is copied on the server (in parts, for a large
+    object) if its digest isn't stored yet, and then the legacy object is
+    removed. Run once after upgrading, it's safe to run again.
+    """
+
+    help = "Move pushed containers to content addressed storage"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            dest="dry_run",
+            default=False,
+            action="store_true",
+            help="Show the objects that would be moved.",
+        )
+        parser.add_argument(
+            "--keep",
+            dest="keep",
+            default=False,
+            action="store_true",
+            help="Don't remove the legacy objects after they are copied.",
+        )
+
+    def handle(self, *args, **options):
+        containers = (
+            Container.objects.filter(image__isnull=True, version__startswith="sha256.")
+            .exclude(metadata__has_key="storage")
+            .select_related("collection")
+        )
+
+        # Containers with the same name and version share a legacy object
+        legacy = defaultdict(list)
+        for container in containers.iterator():
+            if get_digest(container.version) is not None:
+                legacy[container.get_storage()].append(container)
+
+        client = get_minio_client()
+        moved = 0
+        for storage, group in legacy.items():
+            if not object_exists(storage):
+                bot.warning("%s is not in storage, skipping." % storage)
+                continue
+
+            digest = get_digest(group[0].version)
+            destination = StorageObject(digest=digest).get_storage()
+            bot.info("%s -> %s" % (storage, destination))
+            if options["dry_run"]:
+                continue
+
+            if not object_exists(destination):
+                get_s3_client().copy(
+                    {"Bucket": MINIO_BUCKET, "Key": storage}, MINIO_BUCKET, destination
+                )
+
+            for container in group:
+                add_storage_reference(container)
+            if not options["keep"]:
+                client.remove_object(MINIO_BUCKET, storage)
+            moved += 1
+
+        bot.info("Moved %s of %s objects." % (moved, len(legacy)))
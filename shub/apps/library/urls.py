@@ -24,6 +24,11 @@ urlpatterns = [
     ),
     # url(r'^v1/images/(?P<username>.+?)/(?P<collection>.+?)/(?P<name>.+?)$', views.PushImageView.as_view()),
     re_path(r"^v1/images/(?P<name>.+?)/?$", views.GetImageView.as_view()),
+    re_path(
+        r"^v1/digests/sha256[.](?P<digest>[0-9a-f]{64})/?$",
+        views.DigestView.as_view(),
+        name="library_digest",
+    ),  # is an image stored (a push can skip the upload)
     re_path(
         r"^v1/imagefile/(?P<name>.+?)/?$",
         views.DownloadImageView.as_view(),
@@ -65,6 +70,11 @@ urlpatterns = [
     re_path(
         r"^v1/tags/(?P<collection_id>.+?)/?$", views.GetCollectionTagsView.as_view()
     ),
+    re_path(
+        r"^v1/promote/(?P<container_id>[0-9]+)/?$",
+        views.PromoteImageView.as_view(),
+        name="library_promote",
+    ),  # add a tag for an image without uploading it
     re_path(r"^v1/$", views.LibraryBaseView.as_view()),
 ]
 
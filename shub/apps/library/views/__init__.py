@@ -4,11 +4,13 @@ from .images import (
     CollectionsView,
     CompletePushImageFileView,
     ContainersView,
+    DigestView,
     DownloadImageView,
     GetCollectionTagsView,
     GetImageView,
     GetNamedCollectionView,
     GetNamedContainerView,
+    PromoteImageView,
     PushImageView,
     RequestMultiPartAbortView,
     RequestMultiPartCompleteView,
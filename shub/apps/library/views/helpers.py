@@ -10,10 +10,14 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import re
 
+from django.db.models import Prefetch
 from rest_framework.authtoken.models import Token
 
-from shub.apps.logs.models import APIRequestCount
-from shub.apps.main.models import Collection
+from shub.apps.logs.utils import get_download_counts
+from shub.apps.main.models import Collection, Container
+from shub.apps.main.query import resolve_container
+from shub.apps.users.models import User
+from shub.apps.users.utils import get_cached_token
 
 # shared date time format string
 formatString = "%Y-%m-%dT%X.%fZ"
@@ -21,23 +25,52 @@ formatString = "%Y-%m-%dT%X.%fZ"
 # regular expression for temporary dummy tag
 uuid_regex = "[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}"
 tag_regex = "DUMMY-%s" % uuid_regex
+dummy_tag = re.compile(tag_regex)
 
 # Tokens
 
+# strip the (any case) bearer prefix from an authorization header
+bearer_regex = re.compile("bearer", flags=re.IGNORECASE)
+
+
+def get_token_key(request):
+    """return the token key from the request authorization header, or None"""
+    token = request.META.get("HTTP_AUTHORIZATION")
+    if token:
+        return bearer_regex.sub("", token).strip()
+
+
+def get_request_token(request):
+    """resolve the token for a request once, and save it with the request so
+    that repeated calls to validate_token and get_token (and checks of
+    token.user) don't go back to the cache or database. The lookup itself
+    is done by get_cached_token, which loads the user in the same query.
+    """
+    if not hasattr(request, "_sregistry_token"):
+        token = None
+
+        # Coming from HTTP, look for authorization as bearer token
+        key = get_token_key(request)
+        if key:
+            token = get_cached_token(key)
+
+        # Next attempt - try to get token via user session
+        elif request.user.is_authenticated and not request.user.is_anonymous:
+            try:
+                token = Token.objects.select_related("user").get(user=request.user)
+            except Token.DoesNotExist:
+                pass
+
+        request._sregistry_token = token
+    return request._sregistry_token
+
 
 def validate_token(request):
     """validate a token from the request header. If valid, return
     True. Otherwise return False
     """
-    token = request.META.get("HTTP_AUTHORIZATION")
-    if token:
-        try:
-            Token.objects.get(
-                key=re.sub("bearer", "", token, flags=re.IGNORECASE).strip()
-            )
-            return True
-        except Token.DoesNotExist:
-            pass
+    if get_token_key(request):
+        return get_request_token(request) is not None
     return False
 
 
@@ -45,23 +78,7 @@ def get_token(request):
     """The same as validate_token, but return the token object to check the
     associated user.
     """
-    # Coming from HTTP, look for authorization as bearer token
-    token = request.META.get("HTTP_AUTHORIZATION")
-
-    if token:
-        try:
-            return Token.objects.get(
-                key=re.sub("bearer", "", token, flags=re.IGNORECASE).strip()
-            )
-        except Token.DoesNotExist:
-            pass
-
-    # Next attempt - try to get token via user session
-    elif request.user.is_authenticated and not request.user.is_anonymous:
-        try:
-            return Token.objects.get(user=request.user)
-        except Token.DoesNotExist:
-            pass
+    return get_request_token(request)
 
 
 # Downloads
@@ -69,19 +86,18 @@ def get_token(request):
 
 def get_collection_downloads(collection):
     """get downloads for a collection (downloads for all containers within)"""
-    downloads = 0
-    for container in collection.containers.all():
-        downloads += get_container_downloads(container)
+    container_ids = collection.containers.values_list("id", flat=True)
+    return sum(get_download_counts(container_ids).values())
 
 
 def get_container_downloads(container):
     """return downloads for a container"""
-    path = "images/%s/%s:%s" % (
-        container.collection.name,
-        container.name,
-        container.tag,
-    )
-    return APIRequestCount.objects.filter(method="get", path__contains=path).count()
+    return get_download_counts([container.id])[container.id]
+
+
+def get_containers_downloads(containers):
+    """return a lookup of downloads for a list of containers, by container id"""
+    return get_download_counts([container.id for container in containers])
 
 
 # Users
@@ -136,30 +152,35 @@ def generate_collections_list(user):
         return {"collections": collections}
 
 
+def get_collection_owners(collection):
+    """return the list of collection owners, ordered by id so the first is
+    the same as collection.owners.first(). Uses prefetched owners if present.
+    """
+    return sorted(collection.owners.all(), key=lambda owner: owner.id)
+
+
 def generate_collection_metadata(collection, user=None):
     """given a collection, generate a metadata response for it. This does
     not include metadata about container tag
     (see generate_collection_containers_metadata)
     """
+    owners = get_collection_owners(collection)
     if not user:
-        user = collection.owners.first()
+        user = owners[0]
 
-    # Sylabs listing is inconsistent between None and []
-    containers = []
-    if not collection.private:
-        containers = collection.containers.all() or []
+    # Only need the ids, but as strings
+    container_ids = [str(x) for x in collection.containers.values_list("id", flat=True)]
 
+    # Sylabs listing is inconsistent between None and []
     # Only owners can see private containers
-    elif collection.private and user in collection.owners.all():
-        containers = collection.containers.all() or []
-
-    # Only need the ids, but as strings
-    containers = [str(c.id) for c in containers]
+    containers = []
+    if not collection.private or user in owners:
+        containers = container_ids
 
     data = {
         "containers": containers,
         "createdAt": collection.add_date.strftime(formatString),
-        "createdBy": str(collection.owners.first().id),
+        "createdBy": str(owners[0].id),
         "customData": "",
         "deleted": False,  # never going to be True :)
         "deletedAt": "0001-01-01T00:00:00Z",
@@ -170,7 +191,7 @@ def generate_collection_metadata(collection, user=None):
         "name": collection.name,
         "owner": str(user.id),
         "private": collection.private,
-        "size": collection.containers.count(),  # Possibly MB?
+        "size": len(container_ids),  # Possibly MB?
         "updatedAt": collection.modify_date.strftime(formatString),
         "updatedBy": str(user.id),
     }
@@ -188,13 +209,14 @@ def generate_collection_tags(collection):
     latest. Technically, collections should be namespaced
     consistently, and we assume this.
     """
-    unique_tags = {
-        c.tag for c in collection.containers.all() if not re.search(tag_regex, c.tag)
-    }
     tags = {}
 
-    for tag in unique_tags:
-        tags[tag] = str(collection.containers.filter(tag=tag).last().id)
+    # Ordered by id, so the newest container for each tag is kept
+    for tag, container_id in collection.containers.order_by("id").values_list(
+        "tag", "id"
+    ):
+        if not dummy_tag.search(tag):
+            tags[tag] = str(container_id)
 
     return tags
 
@@ -210,15 +232,10 @@ def generate_collection_details(collection, containers, user=None):
     a collection (e.g., linux) down to a submit (e.g., ubuntu) and
     then returning the corresponding tags (e.g., 14.04).
     """
-    if not user:
-        user = collection.owners.first()
+    containers = [c for c in containers if not dummy_tag.search(c.tag)]
+    tags = {c.tag: str(c.id) for c in containers}
+    images = [c.version for c in containers]
 
-    tags = {}
-    for container in containers:
-        if not re.search(tag_regex, container.tag):
-            tags[container.tag] = str(container.id)
-
-    images = [c.version for c in containers if not re.search(tag_regex, container.tag)]
     data = generate_collection_metadata(collection, user)
 
     updates = {
@@ -230,7 +247,7 @@ def generate_collection_details(collection, containers, user=None):
         "imageTags": tags,
         "images": images,
         "readOnly": False,
-        "stars": collection.star_set.count(),
+        "stars": collection.star_count,
     }
 
     data.update(updates)
@@ -242,84 +259,91 @@ def generate_collection_details(collection, containers, user=None):
 
 def generate_container_metadata(container):
     """given a container, return a metadata object"""
-    # Get other tags
-    tags = [
-        c.tag
-        for c in container.collection.containers.all()
-        if not re.search(tag_regex, c.tag)
-    ]
+    return generate_containers_metadata([container])[0]
 
-    # Downloads
-    downloads = get_container_downloads(container)
 
-    # Container name might have /
-    container_name = container.name
-    collection_name = container.collection.name
-    if "/" in container_name:
-        container_name = container_name.split("/")[-1]
+def generate_containers_metadata(containers):
+    """given a list of containers, return a list of metadata objects. The
+    number of queries does not depend on the number of containers (or the
+    number of tags in their collections):
 
-    if "/" in collection_name:
-        collection_name = collection_name.split("/")[0]
+    1. collections (with their star counts)
+    2. owners for the collections
+    3. tags for the collections
+    4. downloads for the containers (and one redis call)
+    """
+    containers = list(containers)
+    collection_ids = {c.collection_id for c in containers}
 
-    arch = container.metadata.get("arch", "amd64")
+    collections = (
+        Collection.objects.filter(id__in=collection_ids)
+        .prefetch_related(Prefetch("owners", queryset=User.objects.order_by("id")))
+        .in_bulk()
+    )
 
-    data = {
-        "deleted": False,  # 2019-03-15T19:02:24.015Z
-        "createdBy": str(container.collection.owners.first().id),
-        "createdAt": container.add_date.strftime(
-            formatString
-        ),  # No idea what their format is...
-        "updatedBy": str(container.collection.owners.first()),
-        "owner": str(container.collection.owners.first().id),
-        "id": str(container.id),
-        "hash": container.version,
-        "description": "%s Collection" % container.collection.name.capitalize(),
-        "container": container.version,
-        "arch": arch,
-        "fingerprints": [],
-        "customData": "",
-        "size": container.metadata.get("size_mb"),
-        "entity": str(container.collection.owners.first().id),
-        "entityName": container.collection.owners.first().username,
-        "collection": str(container.collection.id),
-        "collectionName": collection_name,
-        "containerName": container_name,
-        "tags": tags,
-        "containerStars": container.collection.star_set.count(),
-        "containerDownloads": downloads,
-    }
+    # Other tags in each collection, without the temporary dummy tags
+    tags = {cid: [] for cid in collection_ids}
+    for cid, tag in (
+        Container.objects.filter(collection_id__in=collection_ids)
+        .order_by("name")
+        .values_list("collection_id", "tag")
+    ):
+        if not dummy_tag.search(tag):
+            tags[cid].append(tag)
 
-    return data
+    downloads = get_containers_downloads(containers)
+
+    metadata = []
+    for container in containers:
+        collection = collections[container.collection_id]
+        owner = collection.owners.all()[0]
+
+        # Container name might have /
+        container_name = container.name
+        collection_name = collection.name
+        if "/" in container_name:
+            container_name = container_name.split("/")[-1]
+
+        if "/" in collection_name:
+            collection_name = collection_name.split("/")[0]
+
+        arch = container.arch
+
+        data = {
+            "deleted": False,  # 2019-03-15T19:02:24.015Z
+            "createdBy": str(owner.id),
+            "createdAt": container.add_date.strftime(
+                formatString
+            ),  # No idea what their format is...
+            "updatedBy": str(owner),
+            "owner": str(owner.id),
+            "id": str(container.id),
+            "hash": container.version,
+            "description": "%s Collection" % collection.name.capitalize(),
+            "container": container.version,
+            "arch": arch,
+            "fingerprints": [],
+            "customData": "",
+            "size": container.get_size_mb(),
+            "entity": str(owner.id),
+            "entityName": owner.username,
+            "collection": str(collection.id),
+            "collectionName": collection_name,
+            "containerName": container_name,
+            "tags": tags[container.collection_id],
+            "containerStars": collection.star_count,
+            "containerDownloads": downloads[container.id],
+        }
+        metadata.append(data)
+
+    return metadata
 
 
 def get_container(names):
     """a helper function to take a parsed uri names, and return
-    an associated container
+    an associated container. See resolve_container for details.
     """
-    container = None
-
-    # The user can provide the username (a username) that owns the container
-    # We don't actually need it - namespace doesn't include username
-    if names["registry"]:
-        if names["registry"] in names["url"]:
-            names["url"] = re.sub("^%s/" % names["registry"], "", names["url"])
-
-    collection = get_collection(names["url"])
-
-    # A hash can be given to the API too
-    if names["tag"].startswith("sha256"):
-        names["version"] = names["tag"]
-        names["tag"] = None
-
-    # If we have a collection, next look for the tag or version
-    if collection is not None:
-        containers = collection.containers.filter(name=names["image"])
-        if containers and names["version"] is not None:
-            container = containers.filter(version=names["version"]).first()
-        elif containers and names["tag"] is not None:
-            container = containers.filter(tag=names["tag"]).first()
-
-    return container
+    return resolve_container(names)
 
 
 def get_collection(name, retry=True):
@@ -11,9 +11,7 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import json
 import uuid
 from datetime import timedelta
-from urllib.parse import urlparse
 
-import django_rq
 from django.conf import settings
 from django.shortcuts import redirect, reverse
 from ratelimit.mixins import RatelimitMixin
@@ -22,13 +20,15 @@ from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from shub.apps.logs.utils import generate_log
+from shub.apps.logs.utils import generate_log, increment_container_downloads
+from shub.apps.main.limits import TokenBucketMixin
 from shub.apps.main.models import Collection, Container
+from shub.apps.main.models.containers import DEFERRED_FIELDS
+from shub.apps.main.query import container_cache
 from shub.apps.main.utils import format_collection_name
 from shub.settings import (
     MINIO_BUCKET,
     MINIO_MULTIPART_UPLOAD,
-    MINIO_REGION,
     MINIO_SIGNED_URL_EXPIRE_MINUTES,
 )
 from sregistry.utils import parse_image_name
@@ -44,11 +44,17 @@ from .helpers import (
     validate_token,
 )
 from .minio import (
+    complete_upload,
     delete_minio_container,
-    minioExternalClient,
-    s3,
-    s3_external,
-    sregistry_presign_v4,
+    digest_is_stored,
+    get_container_storage,
+    get_download_url,
+    get_minio_client,
+    get_part_size,
+    get_s3_client,
+    get_upload_storage,
+    link_stored_object,
+    presign_upload_parts,
 )
 from .parsers import EmptyParser
 
@@ -70,13 +76,24 @@ class CompletePushImageFileView(RatelimitMixin, APIView):
     def put(self, request, container_id, format=None):
         print("PUT CompletePushImageFileView")
 
+        if not validate_token(request):
+            print("Token not valid")
+            return Response(status=403)
+
         try:
             container = Container.objects.get(id=container_id)
-            print(container.tag)
-            return Response(status=200)
         except Container.DoesNotExist:
             return Response(status=404)
 
+        # check user permission
+        token = get_token(request)
+        if token.user not in container.collection.owners.all():
+            return Response(status=403)
+
+        # The upload is complete, it's checked and then stored by digest
+        complete_upload(container)
+        return Response(status=200)
+
 
 class RequestMultiPartAbortView(RatelimitMixin, APIView):
     """Currently this view returns 404 to default to v2 RequestPushImageFileView
@@ -145,16 +162,23 @@ class RequestMultiPartCompleteView(RatelimitMixin, APIView):
         except Container.DoesNotExist:
             return Response(status=404)
 
+        # check user permission
+        token = get_token(request)
+        if token.user not in container.collection.owners.all():
+            return Response(status=403)
+
         # Complete the multipart upload
-        res = s3.complete_multipart_upload(
+        res = get_s3_client().complete_multipart_upload(
             Bucket=MINIO_BUCKET,
-            Key=container.get_storage(),
+            Key=get_upload_storage(container),
             MultipartUpload={"Parts": parts},
             UploadId=body.get("uploadID"),
             # RequestPayer='requester'
         )
 
         print(res)
+        complete_upload(container)
+
         # Currently this response data is empty
         # https://github.com/sylabs/scs-library-client/blob/master/client/response.go#L97
         return Response(status=200, data={})
@@ -192,9 +216,7 @@ class RequestMultiPartPushImageFileView(APIView):
         # Get the request body
         body = json.loads(request.body.decode("utf-8"))
         upload_id = body.get("uploadID")
-        storage = container.get_storage()
-        sha256 = body.get("sha256sum")
-        content_size = body.get("partSize")
+        storage = get_upload_storage(container)
 
         # partSize: int64
         # uploadID: string
@@ -205,48 +227,26 @@ class RequestMultiPartPushImageFileView(APIView):
         if upload_id != container.metadata.get("upload_id"):
             return Response(status=404)
 
+        # A client can ask for urls for many parts at once, with
+        # parts: [{"partNumber": int, "sha256sum": string (optional)}]
+        if "parts" in body:
+            parts = [(int(x["partNumber"]), x.get("sha256sum")) for x in body["parts"]]
+            urls = presign_upload_parts(storage, upload_id, parts)
+            data = {
+                "presignedURLs": [
+                    {"partNumber": number, "presignedURL": url}
+                    for number, url in urls.items()
+                ]
+            }
+            return Response(data={"data": data}, status=200)
+
         # The part number gets the presigned url
         part_number = int(body.get("partNumber"))
-
-        # Generate pre-signed URLS for external client (lookup by part number)
-        # We don't technically need this function, but it's preserved here in
-        # case a future implementation can support providing a sha256sum to be included
-        signed_url = s3_external.generate_presigned_url(
-            ClientMethod="upload_part",
-            HttpMethod="PUT",
-            Params={
-                "Bucket": MINIO_BUCKET,
-                "Key": storage,
-                "UploadId": upload_id,
-                "PartNumber": part_number,
-                "ContentLength": content_size,
-            },
-            ExpiresIn=timedelta(minutes=MINIO_SIGNED_URL_EXPIRE_MINUTES).seconds,
-        )
-
-        # Split the url to only include UploadID and PartNumber parameters
-        parsed = urlparse(signed_url)
-        params = {
-            x.split("=")[0]: x.split("=")[1]
-            for x in parsed.query.split("&")
-            if not x.startswith("X-Amz")
-        }
-        new_url = parsed.scheme + "://" + parsed.netloc + parsed.path
-
-        # Derive headers in the same way that Minio does, but include the sha256sum
-        signed_url = sregistry_presign_v4(
-            "PUT",
-            new_url,
-            region=MINIO_REGION,
-            content_hash_hex=sha256,
-            credentials=minioExternalClient._credentials,
-            expires=str(timedelta(minutes=MINIO_SIGNED_URL_EXPIRE_MINUTES).seconds),
-            headers={"X-Amz-Content-Sha256": sha256},
-            response_headers=params,
-        )
+        sha256 = body.get("sha256sum")
+        urls = presign_upload_parts(storage, upload_id, [(part_number, sha256)])
 
         # Return the presigned url
-        data = {"presignedURL": signed_url}
+        data = {"presignedURL": urls[part_number]}
         return Response(data={"data": data}, status=200)
 
     def post(self, request, upload_id):
@@ -274,28 +274,26 @@ class RequestMultiPartPushImageFileView(APIView):
         if "filesize" not in body:
             return Response(status=400)
 
-        # Filesize in bytes to calculate how to upload by (max size ~0.5 GB)
+        # Filesize in bytes to calculate the part size and number of parts
         filesize = body.get("filesize")
-        max_size = 500 * 1024 * 1024
-        upload_by = int(filesize / max_size) + 1
+        max_size, total_parts = get_part_size(filesize)
 
         # Key is the path in storage, MUST be encoded and quoted!
-        storage = container.get_storage()
+        storage = get_upload_storage(container)
 
         # Create the multipart upload
-        res = s3.create_multipart_upload(Bucket=MINIO_BUCKET, Key=storage)
+        res = get_s3_client().create_multipart_upload(Bucket=MINIO_BUCKET, Key=storage)
         upload_id = res["UploadId"]
         print("Start multipart upload %s" % upload_id)
 
-        # Calculate the total number of parts needed
-        total_parts = len(range(1, upload_by + 1))
-
         # Save parameters with container
         container.metadata["upload_id"] = upload_id
         container.metadata["upload_filesize"] = filesize
+        container.size_bytes = filesize
         container.metadata["upload_max_size"] = max_size
-        container.metadata["upload_by"] = upload_by
+        container.metadata["upload_by"] = total_parts
         container.metadata["upload_total_parts"] = total_parts
+        container.metadata["upload_storage"] = storage
         container.save()
 
         # Start a multipart upload, telling Singularity how many parts and the size
@@ -304,6 +302,15 @@ class RequestMultiPartPushImageFileView(APIView):
             "totalParts": total_parts,
             "partSize": max_size,
         }
+
+        # A client can ask for the urls for all parts (without sha256sums)
+        if body.get("presignParts"):
+            parts = [(number, None) for number in range(1, total_parts + 1)]
+            urls = presign_upload_parts(storage, upload_id, parts)
+            data["presignedURLs"] = [
+                {"partNumber": number, "presignedURL": url}
+                for number, url in urls.items()
+            ]
         return Response(data={"data": data}, status=200)
 
 
@@ -336,13 +343,16 @@ class RequestPushImageFileView(RatelimitMixin, APIView):
         if token.user not in container.collection.owners.all():
             return Response(status=403)
 
+        # Get the container storage path
+        storage = get_upload_storage(container)
+
         push_secret = str(uuid.uuid4())
         container.metadata["pushSecret"] = push_secret
+        container.metadata["upload_storage"] = storage
         container.save()
 
-        # Get the container name and generate signed url
-        storage = container.get_storage()
-        url = minioExternalClient.presigned_put_object(
+        # Generate the signed url
+        url = get_minio_client(external=True).presigned_put_object(
             MINIO_BUCKET,
             storage,
             expires=timedelta(minutes=MINIO_SIGNED_URL_EXPIRE_MINUTES),
@@ -353,12 +363,14 @@ class RequestPushImageFileView(RatelimitMixin, APIView):
         return Response(data={"data": data}, status=200)
 
 
-class PushImageView(RatelimitMixin, APIView):
+class PushImageView(TokenBucketMixin, RatelimitMixin, APIView):
     """Given a collection and container name, return the associated metadata.
     GET /v1/containers/vsoch/dinosaur-collection/container
     """
 
     renderer_classes = (JSONRenderer,)
+    rate_limit_budget = "push"
+    rate_limit_setting = "LIBRARY_PUSH_RATE_LIMIT"
     ratelimit_key = "ip"
     ratelimit_rate = settings.VIEW_RATE_LIMIT
     ratelimit_block = settings.VIEW_RATE_LIMIT_BLOCK
@@ -394,20 +406,54 @@ class PushImageView(RatelimitMixin, APIView):
             tag=tag,
             version="sha256." + version,
         )
+        # Update the row directly, saving would change the container secret
         arch = request.query_params.get("arch")
-        if arch:
-            container.metadata["arch"] = arch
+        if arch and arch != container.arch:
+            container.arch = arch
+            Container.objects.filter(id=container.id).update(arch=arch)
+            container_cache.clear_collection(container.collection_id)
 
+        # An image that is already stored doesn't need to be uploaded
         data = generate_container_metadata(container)
+        data["uploaded"] = link_stored_object(container, token.user)
+        return Response(data={"data": data}, status=200)
+
+
+class DigestView(RatelimitMixin, APIView):
+    """Determine if an image (by sha256 digest) is stored, so a push of it
+    doesn't need to upload it.
+    GET /v1/digests/sha256.<digest>
+    """
+
+    renderer_classes = (JSONRenderer,)
+    ratelimit_key = "ip"
+    ratelimit_rate = settings.VIEW_RATE_LIMIT
+    ratelimit_block = settings.VIEW_RATE_LIMIT_BLOCK
+    ratelimit_method = "GET"
+
+    def get(self, request, digest):
+        print("GET DigestView")
+
+        if not validate_token(request):
+            print("Token not valid")
+            return Response(status=403)
+
+        token = get_token(request)
+        if not digest_is_stored(digest, token.user):
+            return Response(status=404)
+
+        data = {"digest": "sha256.%s" % digest, "uploaded": True}
         return Response(data={"data": data}, status=200)
 
 
-class DownloadImageView(RatelimitMixin, APIView):
+class DownloadImageView(TokenBucketMixin, RatelimitMixin, APIView):
     """redirect to the url to download a container.
     https://library.sylabs.io/v1/imagefile/busybox:latest
     This view is used for manual download in the interface.
     """
 
+    rate_limit_budget = "pull"
+    rate_limit_setting = "LIBRARY_PULL_RATE_LIMIT"
     ratelimit_key = "ip"
     ratelimit_rate = settings.VIEW_RATE_LIMIT
     ratelimit_block = settings.VIEW_RATE_LIMIT_BLOCK
@@ -448,22 +494,18 @@ class DownloadImageView(RatelimitMixin, APIView):
             ):
                 return Response(status=404)
 
-        # Retrieve the url for minio
-        storage = container.get_storage()
-        url = minioExternalClient.presigned_get_object(
-            MINIO_BUCKET,
-            storage,
-            expires=timedelta(minutes=MINIO_SIGNED_URL_EXPIRE_MINUTES),
-        )
-        return redirect(url)
+        # Retrieve the (cached) url for minio
+        return redirect(get_download_url(container))
 
 
-class GetImageView(RatelimitMixin, APIView):
+class GetImageView(TokenBucketMixin, RatelimitMixin, APIView):
     """redirect to the url to download a container.
     https://library.sylabs.io/v1/imagefile/busybox:latest
     """
 
     renderer_classes = (JSONRenderer,)
+    rate_limit_budget = "pull"
+    rate_limit_setting = "LIBRARY_PULL_RATE_LIMIT"
     ratelimit_key = "ip"
     ratelimit_rate = settings.VIEW_RATE_LIMIT
     ratelimit_block = settings.VIEW_RATE_LIMIT_BLOCK
@@ -482,7 +524,7 @@ class GetImageView(RatelimitMixin, APIView):
         # If an arch is defined, ensure it matches the request
         arch = "amd64"
         if arch and container is not None:
-            if container.metadata.get("arch", "amd64") != "amd64":
+            if container.arch != "amd64":
                 return Response(status=404)
 
         # If no container, regardles of permissions, 404
@@ -501,9 +543,9 @@ class GetImageView(RatelimitMixin, APIView):
             ):
                 return Response(status=404)
 
-        # Generate log for downloads (async with worker)
-        django_rq.enqueue(
-            generate_log,
+        # Count the download, and queue the log (saved in batch by worker)
+        increment_container_downloads(container.id)
+        generate_log(
             view_name="shub.apps.api.urls.containers.ContainerDetailByName",
             ipaddr=request.META.get("HTTP_X_FORWARDED_FOR", None),
             method=request.method,
@@ -673,8 +715,9 @@ class GetCollectionTagsView(RatelimitMixin, APIView):
                 )
 
             # Case 2: Exists and not frozen (replace)
-            storage = existing.get_storage()
-            if storage != container.get_storage():
+            # A content addressed object is released when existing is deleted
+            storage = get_container_storage(existing)
+            if storage != get_container_storage(container):
                 delete_minio_container(existing)
 
             # Now delete the container object
@@ -691,6 +734,67 @@ class GetCollectionTagsView(RatelimitMixin, APIView):
         return Response(status=200)
 
 
+class PromoteImageView(RatelimitMixin, APIView):
+    """Add a tag (or a container in another collection) for an existing
+    image, without uploading it again, e.g., to promote a release candidate.
+    The body has the Tag, and optionally the Collection (name) and Name,
+    which default to those of the container.
+    POST /v1/promote/<container_id>
+    """
+
+    ratelimit_key = "ip"
+    ratelimit_rate = settings.VIEW_RATE_LIMIT
+    ratelimit_block = settings.VIEW_RATE_LIMIT_BLOCK
+    ratelimit_method = "POST"
+    renderer_classes = (JSONRenderer,)
+    parser_classes = (JSONParser,)
+
+    def post(self, request, container_id):
+        from shub.apps.api.actions.promote import promote_container
+
+        print("POST PromoteImageView")
+        if not validate_token(request):
+            print("Token not valid")
+            return Response(status=403)
+
+        token = get_token(request)
+
+        # {'Tag': 'latest', 'Collection': 'production', 'Name': 'app'}
+        try:
+            container = Container.objects.get(id=container_id)
+        except Container.DoesNotExist:
+            return Response(status=404)
+
+        params = request.data
+        if not isinstance(params, dict) or not params.get("Tag"):
+            return Response({"message": "A Tag is required."}, status=400)
+
+        if not container.has_view_permission(token.user):
+            return Response(status=403)
+
+        try:
+            collection = Collection.objects.get(
+                name=str(params.get("Collection") or container.collection.name)
+            )
+        except Collection.DoesNotExist:
+            return Response(status=404)
+
+        if token.user not in collection.owners.all():
+            return Response(status=403)
+
+        promoted, message = promote_container(
+            container,
+            collection,
+            name=str(params.get("Name") or container.name),
+            tag=str(params["Tag"]),
+        )
+        if promoted is None:
+            return Response({"message": message}, status=400)
+
+        data = generate_container_metadata(promoted)
+        return Response(data={"data": data}, status=200)
+
+
 # Containers
 
 
@@ -790,7 +894,9 @@ class GetNamedContainerView(RatelimitMixin, APIView):
             return Response(status=403)
 
         # We don't need to create the specific container here
-        containers = collection.containers.filter(name=container) or []
+        containers = collection.containers.filter(name=container).defer(
+            *DEFERRED_FIELDS
+        )
 
         # Even if the container doesn't exist, we return response that it does,
         # And it's created in the next view.
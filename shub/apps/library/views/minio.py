@@ -10,13 +10,26 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import hashlib
 import hmac
-from datetime import datetime
-
+import math
+import os
+import socket
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import lru_cache
+from threading import Lock
+from urllib.parse import urlparse
+
+import certifi
+import django_rq
+import urllib3
 from boto3 import Session
 from botocore.client import Config
+from django.db import transaction
+from django.db.models import F
 from minio import Minio
 from minio.compat import queryencode, urlsplit
-from minio.error import InvalidArgumentError
+from minio.error import InvalidArgumentError, NoSuchKey
 from minio.signer import (
     collections,
     generate_canonical_request,
@@ -25,70 +38,450 @@ from minio.signer import (
     generate_string_to_sign,
     get_signed_headers,
 )
-
-from shub.apps.main.models import Container
+from urllib3.connection import HTTPConnection
+
+from shub.apps.api.hashes import HASH_BLOCK_SIZE
+from shub.apps.main.counters import update_container_counters
+from shub.apps.main.models import Container, StorageObject
+from shub.apps.main.models.containers import get_digest
+from shub.apps.main.query import container_cache
+from shub.logger import bot
 from shub.settings import (
     DISABLE_MINIO_CLEANUP,
     MINIO_BUCKET,
     MINIO_EXTERNAL_SERVER,
+    MINIO_MAX_POOL_CONNECTIONS,
+    MINIO_MAX_RETRIES,
+    MINIO_MULTIPART_MIN_PART_SIZE_MB,
+    MINIO_MULTIPART_TARGET_PARTS,
     MINIO_REGION,
     MINIO_ROOT_PASSWORD,
     MINIO_ROOT_USER,
     MINIO_SERVER,
+    MINIO_SIGNED_URL_CACHE_MARGIN_SECONDS,
+    MINIO_SIGNED_URL_EXPIRE_MINUTES,
     MINIO_SSL,
+    MINIO_TCP_KEEPALIVE,
 )
 
 # Signature version '4' algorithm.
 _SIGN_V4_ALGORITHM = "AWS4-HMAC-SHA256"
 
+# A presigned url without a content sha256 (multipart upload parts)
+_UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+
+# S3 limits for a multipart upload
+MULTIPART_MAX_PARTS = 10000
+MULTIPART_MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+
 MINIO_HTTP_PREFIX = "https://" if MINIO_SSL else "http://"
 
-minioClient = Minio(
-    MINIO_SERVER,
-    region=MINIO_REGION,
-    access_key=MINIO_ROOT_USER,
-    secret_key=MINIO_ROOT_PASSWORD,
-    secure=MINIO_SSL,
-)
+################################################################################
+# CLIENTS
+################################################################################
 
-minioExternalClient = Minio(
-    MINIO_EXTERNAL_SERVER,
-    region=MINIO_REGION,
-    access_key=MINIO_ROOT_USER,
-    secret_key=MINIO_ROOT_PASSWORD,
-    secure=MINIO_SSL,
-)
+# Clients are created on first use, so importing this module (a worker start,
+# a management command) doesn't connect to minio. Each process keeps one client
+# per server, with a pool of up to MINIO_MAX_POOL_CONNECTIONS connections that
+# are kept alive between requests, and retries of failed requests.
 
-if not minioClient.bucket_exists(MINIO_BUCKET):
-    minioClient.make_bucket(MINIO_BUCKET)
 
-session = Session(
-    aws_access_key_id=MINIO_ROOT_USER,
-    aws_secret_access_key=MINIO_ROOT_PASSWORD,
-    region_name=MINIO_REGION,
-)
+def get_http_client():
+    """return a urllib3 connection pool for a Minio client, like the Minio
+    default but with the pool size, retries and keep-alive from settings.
+    """
+    socket_options = list(HTTPConnection.default_socket_options)
+    if MINIO_TCP_KEEPALIVE:
+        socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+
+    return urllib3.PoolManager(
+        timeout=urllib3.Timeout.DEFAULT_TIMEOUT,
+        maxsize=MINIO_MAX_POOL_CONNECTIONS,
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+        retries=urllib3.Retry(
+            total=MINIO_MAX_RETRIES,
+            backoff_factor=0.2,
+            status_forcelist=[500, 502, 503, 504],
+        ),
+        socket_options=socket_options,
+    )
 
 
-# https://github.com/boto/boto3/blob/develop/boto3/session.py#L185
-s3 = session.client(
-    "s3",
-    verify=MINIO_SSL,
-    use_ssl=MINIO_SSL,
-    endpoint_url=MINIO_HTTP_PREFIX + MINIO_SERVER,
-    region_name=MINIO_REGION,
-    config=Config(signature_version="s3v4", s3={"addressing_style": "path"}),
-)
+@lru_cache(maxsize=None)
+def get_minio_client(external=False):
+    """return the Minio client for the internal server, or the external
+    server (that Singularity interacts with) to presign urls.
+    """
+    return Minio(
+        MINIO_EXTERNAL_SERVER if external else MINIO_SERVER,
+        region=MINIO_REGION,
+        access_key=MINIO_ROOT_USER,
+        secret_key=MINIO_ROOT_PASSWORD,
+        secure=MINIO_SSL,
+        http_client=get_http_client(),
+    )
 
-# signature_versions
-# https://github.com/boto/botocore/blob/master/botocore/auth.py#L846
-s3_external = session.client(
-    "s3",
-    verify=MINIO_SSL,
-    use_ssl=MINIO_SSL,
-    endpoint_url=MINIO_HTTP_PREFIX + MINIO_EXTERNAL_SERVER,
-    region_name=MINIO_REGION,
-    config=Config(signature_version="s3v4", s3={"addressing_style": "path"}),
-)
+
+@lru_cache(maxsize=None)
+def get_s3_client(external=False):
+    """return the boto3 s3 client for the internal or external server"""
+    session = Session(
+        aws_access_key_id=MINIO_ROOT_USER,
+        aws_secret_access_key=MINIO_ROOT_PASSWORD,
+        region_name=MINIO_REGION,
+    )
+
+    # https://github.com/boto/boto3/blob/develop/boto3/session.py#L185
+    # signature_versions
+    # https://github.com/boto/botocore/blob/master/botocore/auth.py#L846
+    return session.client(
+        "s3",
+        verify=MINIO_SSL,
+        use_ssl=MINIO_SSL,
+        endpoint_url=MINIO_HTTP_PREFIX
+        + (MINIO_EXTERNAL_SERVER if external else MINIO_SERVER),
+        region_name=MINIO_REGION,
+        config=Config(
+            signature_version="s3v4",
+            s3={"addressing_style": "path"},
+            max_pool_connections=MINIO_MAX_POOL_CONNECTIONS,
+            retries={"max_attempts": MINIO_MAX_RETRIES, "mode": "standard"},
+            tcp_keepalive=MINIO_TCP_KEEPALIVE,
+        ),
+    )
+
+
+def create_bucket():
+    """create the MINIO_BUCKET if it doesn't exist. This is run once on
+    startup (python manage.py create_minio_bucket), not on import.
+    Returns True if the bucket was created.
+    """
+    client = get_minio_client()
+    if client.bucket_exists(MINIO_BUCKET):
+        return False
+    client.make_bucket(MINIO_BUCKET)
+    return True
+
+
+################################################################################
+# STORAGE LAYOUT
+################################################################################
+
+# A pushed container is stored by content, at sha256/<digest>, so the same
+# image pushed to many collections (or tags) is stored once. A StorageObject
+# counts the containers that reference each digest, and a container that
+# holds a reference has its storage path in metadata["storage"]. Containers
+# pushed before have the legacy path, container.get_storage(), until they
+# are moved with python manage.py rekey_storage.
+#
+# The digest of a push is given by the client, so every push is uploaded to
+# a temporary path, _upload/<container id>, that only its container uses. Once
+# the upload is complete, a worker reads the object to check its sha256, and
+# then it's copied to (or linked with) the object for its digest. Until then,
+# the container is pulled from its upload.
+
+# The upload of a pushed container
+UPLOAD_STORAGE = "_upload/%s"
+
+# Reading (and copying) a large object can take longer than the default job timeout
+VERIFY_UPLOAD_TIMEOUT = -1
+
+
+def get_upload_storage(container):
+    """return the storage path to upload a container to: a temporary path
+    for a (sha256) digest, checked and stored by digest once the upload is
+    complete (see complete_upload), and otherwise the legacy path.
+    """
+    storage = container.metadata.get("upload_storage")
+    if storage:
+        return storage
+
+    if get_digest(container.version) is None:
+        return container.get_storage()
+    return UPLOAD_STORAGE % container.id
+
+
+def is_upload_storage(storage):
+    """determine if a storage path is the (temporary) upload of a container"""
+    return (storage or "").startswith(UPLOAD_STORAGE.split("%")[0])
+
+
+def get_container_storage(container):
+    """return the storage path of a pushed container"""
+    return container.metadata.get("storage") or container.get_storage()
+
+
+def object_exists(storage):
+    """determine if an object exists in storage"""
+    try:
+        get_minio_client().stat_object(MINIO_BUCKET, storage)
+    except NoSuchKey:
+        return False
+    return True
+
+
+def get_object_size(storage):
+    """return the size (bytes) of an object, or None if it doesn't exist"""
+    try:
+        return get_minio_client().stat_object(MINIO_BUCKET, storage).size
+    except NoSuchKey:
+        return None
+
+
+def get_object_digest(storage):
+    """return the sha256 digest of an object, read from storage in blocks"""
+    sha256 = hashlib.sha256()
+    response = get_minio_client().get_object(MINIO_BUCKET, storage)
+    try:
+        for block in response.stream(HASH_BLOCK_SIZE):
+            sha256.update(block)
+    finally:
+        response.close()
+        response.release_conn()
+    return sha256.hexdigest()
+
+
+def complete_upload(container):
+    """a pushed container is uploaded: it's pulled from its upload until the
+    upload is checked, and stored by digest (see verify_upload) in a worker.
+    Returns True if the upload is queued to be checked.
+    """
+    storage = container.metadata.get("upload_storage")
+    if get_digest(container.version) is None or not is_upload_storage(storage):
+        return False
+
+    # Update the row directly, saving would change the container secret
+    container.metadata["storage"] = container.metadata.pop("upload_storage")
+    container.size_bytes = get_object_size(storage)
+    Container.objects.filter(id=container.id).update(
+        metadata=container.metadata, size_bytes=container.size_bytes
+    )
+    update_container_counters(container.collection_id)
+    container_cache.clear_collection(container.collection_id)
+
+    django_rq.get_queue("default").enqueue(
+        verify_upload, cid=container.id, job_timeout=VERIFY_UPLOAD_TIMEOUT
+    )
+    return True
+
+
+def verify_upload(cid):
+    """verify_upload is run as a separate task after a container is pushed.
+    The sha256 of the upload is calculated, and if it's the digest of the
+    container, the container is stored by digest. Otherwise the container
+    (and its upload) is deleted, its version isn't the image.
+    """
+    try:
+        container = Container.objects.get(id=cid)
+    except Container.DoesNotExist:
+        return False
+
+    storage = container.metadata.get("storage")
+    digest = get_digest(container.version)
+    if digest is None or not is_upload_storage(storage):
+        return False
+
+    try:
+        uploaded = get_object_digest(storage)
+    except NoSuchKey:
+        bot.warning("The upload of %s is not in storage." % container.get_uri())
+        return False
+
+    if uploaded != digest:
+        bot.warning(
+            "The upload of %s has sha256 %s, deleting it."
+            % (container.get_uri(), uploaded)
+        )
+        container.delete()
+        return False
+    return add_storage_reference(container, upload=storage)
+
+
+def add_storage_reference(container, upload=None):
+    """count a reference from a container to its content addressed object.
+    The object is the checked upload of the container, or (when linking a
+    container to a stored image) it must exist. The StorageObject is locked
+    while the object is checked, so it can't be removed (see
+    remove_stored_object) before it's referenced. Returns True if a
+    reference was added.
+
+    Parameters
+    ==========
+    container: the container to reference the object
+    upload: the upload of the container, its sha256 checked (see verify_upload)
+    """
+    digest = get_digest(container.version)
+    if digest is None:
+        return False
+    storage = container.metadata.get("storage")
+    if storage and not is_upload_storage(storage):
+        return False
+
+    with transaction.atomic():
+        storage_object, _ = StorageObject.objects.select_for_update().get_or_create(
+            digest=digest
+        )
+        stored = storage_object.get_storage()
+        exists = object_exists(stored)
+
+        # A checked upload replaces an object that wasn't checked (see rekey_storage)
+        if upload is not None and not (exists and storage_object.verified):
+            get_s3_client().copy(
+                {"Bucket": MINIO_BUCKET, "Key": upload}, MINIO_BUCKET, stored
+            )
+            storage_object.verified = True
+        elif not exists:
+            transaction.set_rollback(True)
+            return False
+
+        StorageObject.objects.filter(id=storage_object.id).update(
+            refcount=F("refcount") + 1, verified=storage_object.verified
+        )
+        container.metadata["storage"] = stored
+
+        # A pushed image gets its size once it's stored (or linked)
+        sized = container.size_bytes is None
+        if sized:
+            container.size_bytes = get_object_size(stored)
+
+        # Update the row directly, saving would change the container secret
+        if not Container.objects.filter(id=container.id).update(
+            metadata=container.metadata, size_bytes=container.size_bytes
+        ):
+            transaction.set_rollback(True)
+            return False
+        if sized:
+            update_container_counters(container.collection_id)
+        transaction.on_commit(
+            lambda: container_cache.clear_collection(container.collection_id)
+        )
+
+    # The upload is stored by digest (or was a copy of it)
+    if upload is not None:
+        signed_url_cache.clear(container.id)
+        transaction.on_commit(
+            lambda: get_minio_client().remove_object(MINIO_BUCKET, upload)
+        )
+    return True
+
+
+def digest_is_stored(digest, user):
+    """determine if the object for a digest is stored (and its sha256 was
+    checked, so it's the image for the digest), and the user can pull a
+    container with it (so a digest doesn't reveal a private container).
+    """
+    from shub.apps.main.query import visible_containers
+
+    storage = StorageObject(digest=digest).get_storage()
+    return (
+        StorageObject.objects.filter(
+            digest=digest, refcount__gt=0, verified=True
+        ).exists()
+        and visible_containers(user).filter(metadata__storage=storage).exists()
+    )
+
+
+def link_stored_object(container, user):
+    """link a pushed container to the stored object for its digest, if the
+    user can pull it, so the image doesn't need to be uploaded. Returns True
+    if the container is linked.
+
+    Parameters
+    ==========
+    container: the new container (with a sha256 version) being pushed
+    user: the user pushing the container
+    """
+    digest = get_digest(container.version)
+    if digest is None:
+        return False
+    if container.metadata.get("storage"):
+        return not is_upload_storage(container.metadata["storage"])
+    if not digest_is_stored(digest, user):
+        return False
+    return add_storage_reference(container)
+
+
+def store_by_digest(container):
+    """copy an object stored with the legacy layout to its content addressed
+    path (a server side copy, the image isn't downloaded), unless the digest
+    is already stored. Returns False if the container has no digest, or no
+    object to copy (or its upload isn't checked yet).
+    """
+    digest = get_digest(container.version)
+    if digest is None:
+        return False
+    if container.metadata.get("storage"):
+        return not is_upload_storage(container.metadata["storage"])
+
+    storage = StorageObject(digest=digest).get_storage()
+    if StorageObject.objects.filter(digest=digest, refcount__gt=0).exists():
+        return True
+    if object_exists(storage):
+        return True
+    if not object_exists(container.get_storage()):
+        return False
+
+    get_s3_client().copy(
+        {"Bucket": MINIO_BUCKET, "Key": container.get_storage()}, MINIO_BUCKET, storage
+    )
+    return True
+
+
+def release_storage_reference(container):
+    """release the reference from a (deleted) container to its content
+    addressed object, and delete the object when it's no longer referenced
+    (after the transaction is committed). Returns True if it was the last.
+    """
+    storage = container.metadata.get("storage") or container.metadata.get(
+        "upload_storage"
+    )
+    if not storage:
+        return False
+
+    # An upload (that isn't stored by digest yet) is only used by its container
+    if is_upload_storage(storage):
+        transaction.on_commit(
+            lambda: get_minio_client().remove_object(MINIO_BUCKET, storage)
+        )
+        return False
+
+    if "storage" not in container.metadata:
+        return False
+    digest = storage.split("/", 1)[-1]
+
+    StorageObject.objects.filter(digest=digest, refcount__gt=0).update(
+        refcount=F("refcount") - 1
+    )
+    if not StorageObject.objects.filter(digest=digest, refcount=0).exists():
+        return False
+
+    if DISABLE_MINIO_CLEANUP:
+        StorageObject.objects.filter(digest=digest, refcount=0).delete()
+    else:
+        transaction.on_commit(lambda: remove_stored_object(digest))
+    return True
+
+
+def remove_stored_object(digest):
+    """remove the object for a digest that is no longer referenced. The
+    StorageObject is locked (and deleted) while the object is removed, so a
+    push of the same digest waits, and then stores the object again.
+    Returns True if the object was removed.
+    """
+    with transaction.atomic():
+        storage_object = (
+            StorageObject.objects.select_for_update()
+            .filter(digest=digest, refcount=0)
+            .first()
+        )
+        if storage_object is None:
+            return False
+        storage = storage_object.get_storage()
+        bot.info("Deleting no longer referenced object %s from Minio" % storage)
+        get_minio_client().remove_object(MINIO_BUCKET, storage)
+        storage_object.delete()
+    return True
 
 
 def sregistry_presign_v4(
@@ -179,9 +572,7 @@ def sregistry_presign_v4(
         method, new_parsed_url, headers_to_sign, signed_headers, content_hash_hex
     )
     string_to_sign = generate_string_to_sign(request_date, region, canonical_request)
-    signing_key = generate_signing_key(
-        request_date, region, credentials.get().secret_key
-    )
+    signing_key = get_signing_key(request_date, region, credentials.get().secret_key)
     signature = hmac.new(
         signing_key, string_to_sign.encode("utf-8"), hashlib.sha256
     ).hexdigest()
@@ -189,6 +580,155 @@ def sregistry_presign_v4(
     return new_parsed_url.geturl()
 
 
+@lru_cache(maxsize=16)
+def _get_signing_key(formatted_date, region, secret_key):
+    return generate_signing_key(
+        datetime.strptime(formatted_date, "%Y%m%d"), region, secret_key
+    )
+
+
+def get_signing_key(date, region, secret_key):
+    """the signing key is derived (four HMAC rounds) from the secret key,
+    and is the same for a day and region, so it is derived once per day.
+    """
+    return _get_signing_key(date.strftime("%Y%m%d"), region, secret_key)
+
+
+def get_part_size(filesize):
+    """choose the part size for a multipart upload of a file, to upload in
+    about MINIO_MULTIPART_TARGET_PARTS parts (that can be sent in parallel),
+    with parts at least MINIO_MULTIPART_MIN_PART_SIZE_MB, and within the
+    S3 limits (10000 parts, of at most 5GB).
+
+    Returns
+    =======
+    (part_size, total_parts)
+    """
+    megabyte = 1024 * 1024
+    part_size = math.ceil(filesize / MINIO_MULTIPART_TARGET_PARTS / megabyte) * megabyte
+    part_size = max(
+        part_size,
+        MINIO_MULTIPART_MIN_PART_SIZE_MB * megabyte,
+        math.ceil(filesize / MULTIPART_MAX_PARTS),
+    )
+    part_size = min(part_size, MULTIPART_MAX_PART_SIZE)
+    return part_size, max(math.ceil(filesize / part_size), 1)
+
+
+def presign_upload_parts(storage, upload_id, parts):
+    """generate presigned urls to upload parts of a multipart upload for the
+    external client. The url for the object is generated once, and each
+    part is signed with the (cached) signing key. A part with a sha256sum
+    includes it in the signature, otherwise the payload is unsigned.
+
+    Parameters
+    ==========
+    storage: the object key in storage
+    upload_id: the multipart upload id
+    parts: a list of (part_number, sha256sum or None)
+    """
+    expires = timedelta(minutes=MINIO_SIGNED_URL_EXPIRE_MINUTES).seconds
+    signed_url = get_s3_client(external=True).generate_presigned_url(
+        ClientMethod="upload_part",
+        HttpMethod="PUT",
+        Params={
+            "Bucket": MINIO_BUCKET,
+            "Key": storage,
+            "UploadId": upload_id,
+            "PartNumber": 1,
+        },
+        ExpiresIn=expires,
+    )
+
+    # Split the url to only include UploadID and PartNumber parameters
+    parsed = urlparse(signed_url)
+    params = {
+        x.split("=")[0]: x.split("=")[1]
+        for x in parsed.query.split("&")
+        if not x.startswith("X-Amz")
+    }
+    url = parsed.scheme + "://" + parsed.netloc + parsed.path
+
+    urls = {}
+    for part_number, sha256 in parts:
+        params["partNumber"] = str(part_number)
+        headers = {}
+        if sha256:
+            headers["X-Amz-Content-Sha256"] = sha256
+
+        # Derive headers in the same way that Minio does, but include the sha256sum
+        urls[part_number] = sregistry_presign_v4(
+            "PUT",
+            url,
+            region=MINIO_REGION,
+            content_hash_hex=sha256 or _UNSIGNED_PAYLOAD,
+            credentials=get_minio_client(external=True)._credentials,
+            expires=str(expires),
+            headers=headers,
+            response_headers=dict(params),
+        )
+    return urls
+
+
+class SignedURLCache:
+    """A small, thread safe least recently used cache of presigned download
+    urls, keyed by container id. A url is reused until
+    MINIO_SIGNED_URL_CACHE_MARGIN_SECONDS before it expires, so a client
+    always has at least that long to start the download. Entries are
+    cleared by the Container signals in shub.apps.main.models.signals.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, container_id, storage):
+        with self.lock:
+            entry = self.entries.get(container_id)
+            if entry is None:
+                return None
+            expires, cached_storage, url = entry
+            if expires < time.monotonic() or cached_storage != storage:
+                del self.entries[container_id]
+                return None
+            self.entries.move_to_end(container_id)
+            return url
+
+    def set(self, container_id, storage, url, seconds):
+        with self.lock:
+            self.entries[container_id] = (time.monotonic() + seconds, storage, url)
+            self.entries.move_to_end(container_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self, container_id):
+        with self.lock:
+            self.entries.pop(container_id, None)
+
+
+signed_url_cache = SignedURLCache()
+
+
+def get_download_url(container):
+    """return a presigned url for the external client to download a container
+    from storage, reusing a cached url if it isn't close to expiring.
+    """
+    storage = get_container_storage(container)
+    url = signed_url_cache.get(container.id, storage)
+    if url is not None:
+        return url
+
+    expires = timedelta(minutes=MINIO_SIGNED_URL_EXPIRE_MINUTES)
+    url = get_minio_client(external=True).presigned_get_object(
+        MINIO_BUCKET, storage, expires=expires
+    )
+    seconds = expires.total_seconds() - MINIO_SIGNED_URL_CACHE_MARGIN_SECONDS
+    if seconds > 0:
+        signed_url_cache.set(container.id, storage, url, seconds)
+    return url
+
+
 def remove_default_port(parsed_url):
     default_ports = {"http": 80, "https": 443}
     if any(
@@ -205,20 +745,30 @@ def remove_default_port(parsed_url):
 def delete_minio_container(container):
     """A helper function to delete a container in Minio based on not finding
     more than one count for it (indicating that it is not in use by other
-    container collections).
+    container collections). This is only needed for a container stored with
+    the legacy layout, a content addressed object is released (and deleted
+    when no longer referenced) when the container is deleted.
 
     Parameters
     ==========
     container: the container object to get Minio storage from.
     """
+    signed_url_cache.clear(container.id)
+    if container.metadata.get("storage"):
+        return False
+
     # Ensure that we don't have the container referenced by another collection
     # The verison would be the same, regardless of the collection/container name
-    count = Container.objects.filter(version=container.version).count()
+    count = (
+        Container.objects.filter(version=container.version)
+        .exclude(metadata__has_key="storage")
+        .count()
+    )
     storage = container.get_storage()
 
     # only delete from Minio not same filename, and if there is only one count
     if count == 1 and not DISABLE_MINIO_CLEANUP:
         print("Deleting no longer referenced container %s from Minio" % storage)
-        minioClient.remove_object(MINIO_BUCKET, storage)
+        get_minio_client().remove_object(MINIO_BUCKET, storage)
         return True
     return False
@@ -0,0 +1,77 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q
+from sregistry.utils import parse_image_name
+
+from shub.apps.logs.models import APIRequestLog, ContainerDownloadCount
+from shub.apps.main.query import resolve_container
+from shub.logger import bot
+
+# Request paths (prefixes) that count as a container download
+DOWNLOAD_PATHS = ["/v1/images/", "/api/container/"]
+
+
+class Command(BaseCommand):
+    """build container download counts from the existing request logs, one
+    grouped query for all logs, and then one write per container. Run once
+    after upgrading, counts are kept up to date afterwards.
+    """
+
+    help = "Backfill container download counts from request logs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            dest="dry_run",
+            default=False,
+            action="store_true",
+            help="Show counts without saving them.",
+        )
+
+    def handle(self, *args, **options):
+        query = Q()
+        for prefix in DOWNLOAD_PATHS:
+            query |= Q(path__startswith=prefix)
+
+        requests = (
+            APIRequestLog.objects.filter(query, method="GET")
+            .exclude(path__startswith="/api/container/search/")
+            .values("path")
+            .annotate(total=Count("id"))
+        )
+
+        counts = defaultdict(int)
+        for request in requests.iterator():
+            container = get_logged_container(request["path"])
+            if container is not None:
+                counts[container.id] += request["total"]
+
+        for container_id, count in counts.items():
+            bot.info("Container %s: %s downloads" % (container_id, count))
+            if not options["dry_run"]:
+                ContainerDownloadCount.objects.update_or_create(
+                    container_id=container_id, defaults={"count": count}
+                )
+        bot.info("Found downloads for %s containers." % len(counts))
+
+
+def get_logged_container(path):
+    """given the path of a logged request, return the container or None"""
+    for prefix in DOWNLOAD_PATHS:
+        if path.startswith(prefix):
+            path = path[len(prefix) :].strip("/")
+    try:
+        return resolve_container(parse_image_name(path))
+    except Exception:
+        return None
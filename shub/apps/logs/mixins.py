@@ -8,10 +8,10 @@ https://github.com/aschn/drf-tracking
 import traceback
 
 from django.utils.timezone import now
-from rest_framework.authtoken.models import Token
 
 from shub.apps.logs.models import APIRequestLog
-from shub.apps.logs.utils import clean_data
+from shub.apps.logs.utils import clean_data, queue_request_log
+from shub.apps.users.utils import get_cached_token
 
 
 class BaseLoggingMixin:
@@ -76,11 +76,9 @@ class BaseLoggingMixin:
         # Get a user, if auth token is provided
         auth_header = request.META.get("HTTP_AUTHORIZATION")
         if auth_header:
-            try:
-                token = Token.objects.get(key=auth_header.replace("BEARER", "").strip())
+            token = get_cached_token(auth_header.replace("BEARER", "").strip())
+            if token is not None:
                 user = token.user
-            except Token.DoesNotExist:
-                pass
 
         self.request.log.user = user
 
@@ -124,7 +122,7 @@ class BaseLoggingMixin:
             self.request.log.response = response.rendered_content
             self.request.log.status_code = response.status_code
             self.request.log.response_ms = response_ms
-            self.request.log.save()
+            queue_request_log(self.request.log)
 
         return response
 
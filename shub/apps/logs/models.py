@@ -7,7 +7,6 @@ https://github.com/aschn/drf-tracking
 
 from django.conf import settings
 from django.db import models
-from django.db.models.signals import pre_save
 from six import python_2_unicode_compatible
 
 from shub.apps.logs.managers import PrefetchUserManager
@@ -70,30 +69,24 @@ class APIRequestCount(models.Model):
     def __str__(self):
         return "%s %s: %s" % (self.method, self.collection.name, self.count)
 
-        # BaseAPIRequestLog (instance)
 
-
-def finalize_request(sender, instance, **kwargs):
-    """finalize request will add a counter object for the collection,
-    method, and path
+class ContainerDownloadCount(models.Model):
+    """A running count of downloads for a container. Downloads are counted
+    in redis and added here in batches (see shub.apps.logs.utils), so
+    reading the count for a container is a single primary key lookup.
     """
-    from shub.apps.logs.utils import get_request_collection
-
-    try:
-        collection = get_request_collection(instance)
-    except Exception:
-        collection = None
-
-    if collection is not None:
-        counter, _ = APIRequestCount.objects.get_or_create(
-            path=instance.view, method=instance.view_method, collection=collection
-        )
-        counter.count += 1
-        counter.save()
 
-    # Clear the response, we've saved minimal detail
-    if settings.LOGGING_SAVE_RESPONSES is False:
-        instance.response = {}
+    # When the container is deleted, the count is deleted too
+    container = models.OneToOneField(
+        "main.Container",
+        primary_key=True,
+        related_name="download_count",
+        on_delete=models.CASCADE,
+    )
+    count = models.PositiveBigIntegerField(default=0)
 
+    class Meta:
+        verbose_name = "Container Download Counter"
 
-pre_save.connect(finalize_request, sender=APIRequestLog)
+    def __str__(self):
+        return "%s: %s" % (self.container_id, self.count)
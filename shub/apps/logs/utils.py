@@ -10,23 +10,28 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import json
 import re
+from collections import Counter
+from datetime import timedelta
 
+import django_rq
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models import F
+from django.utils.dateparse import parse_datetime
 from django.utils.timezone import now
-from rest_framework.authtoken.models import Token
+from redis.exceptions import RedisError
 
+from shub.apps.users.utils import get_cached_token
 
-def get_request_collection(instance):
-    """obtain the collection from a request
+
+def get_request_collection_name(instance):
+    """obtain the collection name from a request, without a database lookup
 
     Parameters
     ==========
     instance: should be an APIRequestLog object, with a response
               and path to parse
     """
-    import pickle
-
-    pickle.dump(instance, open("instance.pkl", "wb"))
-    from shub.apps.main.models import Collection
     from sregistry.utils import parse_image_name
 
     try:
@@ -41,13 +46,7 @@ def get_request_collection(instance):
         else:
             collection_name = instance.path.replace("/api/container/", "")
         name = parse_image_name(collection_name)["collection"]
-
-    try:
-        collection = Collection.objects.get(name=name)
-    except Collection.DoesNotExist:
-        collection = None
-
-    return collection
+    return name
 
 
 def generate_log(
@@ -62,7 +61,8 @@ def generate_log(
     method,
 ):
     """a helper function to generate a log from a request, intended when
-    we want the same functionality but not as a mixin.
+    we want the same functionality but not as a mixin. The log is queued
+    to be saved by the worker (see queue_request_log).
     """
     from shub.apps.logs.models import APIRequestLog
 
@@ -88,12 +88,11 @@ def generate_log(
     )
 
     # Get a user, if auth token is provided
+    user = None
     if auth_header:
-        try:
-            token = Token.objects.get(key=auth_header.replace("BEARER", "").strip())
+        token = get_cached_token(auth_header.replace("BEARER", "").strip())
+        if token is not None:
             user = token.user
-        except Token.DoesNotExist:
-            pass
 
     log.user = user
 
@@ -103,7 +102,152 @@ def generate_log(
     except AttributeError:  # if already a dict, can't dictify
         log.data = clean_data(request_data)
 
-    log.save()
+    queue_request_log(log)
+
+
+################################################################################
+# REQUEST LOG QUEUE
+################################################################################
+
+# Redis list of queued request logs, and the flag for a scheduled flush
+LOGS_KEY = "sregistry:logs"
+LOGS_FLUSH_KEY = "sregistry:logs:flush"
+
+# Fields of a request log that are queued (the user is queued by id)
+LOG_FIELDS = [
+    "path",
+    "view",
+    "view_method",
+    "remote_addr",
+    "host",
+    "method",
+    "query_params",
+    "data",
+    "errors",
+    "response",
+    "response_ms",
+    "status_code",
+]
+
+
+def schedule_flush(connection, flag_key, seconds, func):
+    """schedule func to run in seconds with the worker, unless a run is
+    already scheduled (the flag is set for the same number of seconds)
+    """
+    if connection.set(flag_key, 1, nx=True, ex=seconds):
+        scheduler = django_rq.get_scheduler("default")
+        scheduler.enqueue_in(timedelta(seconds=seconds), func)
+
+
+def queue_request_log(log):
+    """add an (unsaved) request log to the redis queue, to be saved in a
+    batch by flush_request_logs. If redis isn't available, the log is
+    saved directly.
+
+    Parameters
+    ==========
+    log: the APIRequestLog to save
+    """
+    entry = {"user_id": log.user_id, "requested_at": log.requested_at.isoformat()}
+    for field in LOG_FIELDS:
+        value = getattr(log, field)
+        if isinstance(value, bytes):
+            value = value.decode("utf-8", errors="replace")
+        elif isinstance(value, (dict, list)):
+            value = str(value)
+        entry[field] = value
+
+    try:
+        connection = django_rq.get_connection()
+        pipeline = connection.pipeline()
+        pipeline.rpush(LOGS_KEY, json.dumps(entry))
+        pipeline.ltrim(LOGS_KEY, -settings.LOGGING_QUEUE_SIZE, -1)
+        pipeline.execute()
+        schedule_flush(
+            connection,
+            LOGS_FLUSH_KEY,
+            settings.LOGGING_FLUSH_SECONDS,
+            flush_request_logs,
+        )
+    except RedisError:
+        save_request_logs([log])
+
+
+def flush_request_logs(batch_size=1000):
+    """save all queued request logs, in batches of batch_size. Each batch
+    is read and removed from the queue in one transaction, and put back
+    (at the head of the queue) if it can't be saved.
+    """
+    from shub.apps.logs.models import APIRequestLog
+
+    connection = django_rq.get_connection()
+    connection.delete(LOGS_FLUSH_KEY)
+
+    saved = 0
+    while True:
+        pipeline = connection.pipeline(transaction=True)
+        pipeline.lrange(LOGS_KEY, 0, batch_size - 1)
+        pipeline.ltrim(LOGS_KEY, batch_size, -1)
+        entries, _ = pipeline.execute()
+        if not entries:
+            break
+
+        logs = []
+        for entry in entries:
+            entry = json.loads(entry)
+            entry["requested_at"] = parse_datetime(entry["requested_at"])
+            logs.append(APIRequestLog(**entry))
+        try:
+            save_request_logs(logs)
+        except DatabaseError:
+            connection.lpush(LOGS_KEY, *reversed(entries))
+            raise
+        saved += len(logs)
+    return saved
+
+
+def save_request_logs(logs):
+    """save a list of request logs with one insert, and add them to the
+    request counters for each collection, view and method, with one update
+    per counter (instead of per request).
+
+    Parameters
+    ==========
+    logs: a list of (unsaved) APIRequestLog
+    """
+    from shub.apps.logs.models import APIRequestCount, APIRequestLog
+    from shub.apps.main.models import Collection
+
+    names = []
+    for log in logs:
+        try:
+            names.append(get_request_collection_name(log))
+        except Exception:
+            names.append(None)
+
+    collections = dict(
+        Collection.objects.filter(name__in=set(names)).values_list("name", "id")
+    )
+
+    counts = Counter()
+    for log, name in zip(logs, names):
+        collection_id = collections.get(name)
+        if collection_id is not None:
+            counts[(log.view, log.view_method, collection_id)] += 1
+
+        # Clear the response, we've saved minimal detail
+        if settings.LOGGING_SAVE_RESPONSES is False:
+            log.response = {}
+
+    with transaction.atomic():
+        for (path, method, collection_id), count in counts.items():
+            counter, _ = APIRequestCount.objects.get_or_create(
+                path=path, method=method, collection_id=collection_id
+            )
+            APIRequestCount.objects.filter(id=counter.id).update(
+                count=F("count") + count
+            )
+        APIRequestLog.objects.bulk_create(logs)
 
 
 def clean_data(data):
@@ -121,3 +265,131 @@ def clean_data(data):
         if SENSITIVE_DATA.search(key):
             data[key] = CLEANSED_SUBSTITUTE
     return data
+
+
+################################################################################
+# DOWNLOAD COUNTS
+################################################################################
+
+# Redis keys for pending download counts (per container) and the set of
+# containers with pending counts, and the flag for a scheduled flush
+DOWNLOADS_KEY = "sregistry:downloads:%s"
+DOWNLOADS_PENDING_KEY = "sregistry:downloads:pending"
+DOWNLOADS_FLUSH_KEY = "sregistry:downloads:flush"
+
+
+def increment_container_downloads(container_id):
+    """count a download for a container. The count is incremented in redis,
+    and a flush to the database is scheduled (once per flush interval).
+    If redis isn't available, the database count is updated directly.
+
+    Parameters
+    ==========
+    container_id: the id of the downloaded container
+    """
+    try:
+        connection = django_rq.get_connection()
+        pipeline = connection.pipeline()
+        pipeline.incr(DOWNLOADS_KEY % container_id)
+        pipeline.sadd(DOWNLOADS_PENDING_KEY, container_id)
+        pipeline.execute()
+        schedule_flush(
+            connection,
+            DOWNLOADS_FLUSH_KEY,
+            settings.DOWNLOAD_COUNT_FLUSH_SECONDS,
+            flush_container_downloads,
+        )
+    except RedisError:
+        add_container_downloads({container_id: 1})
+
+
+def add_container_downloads(counts):
+    """add counts to the database download counters, with one atomic update
+    per container. Containers that were deleted are skipped.
+
+    Parameters
+    ==========
+    counts: a lookup of container id to number of downloads to add
+    """
+    from shub.apps.logs.models import ContainerDownloadCount
+    from shub.apps.main.models import Container
+
+    existing = Container.objects.filter(id__in=counts).values_list("id", flat=True)
+    with transaction.atomic():
+        for container_id in existing:
+            updated = ContainerDownloadCount.objects.filter(
+                container_id=container_id
+            ).update(count=F("count") + counts[container_id])
+            if not updated:
+                ContainerDownloadCount.objects.get_or_create(container_id=container_id)
+                ContainerDownloadCount.objects.filter(container_id=container_id).update(
+                    count=F("count") + counts[container_id]
+                )
+
+
+def flush_container_downloads():
+    """move pending download counts from redis to the database. Each count is
+    read and removed in one transaction, so a download that happens during
+    the flush is kept for the next one. If the counts can't be saved, they
+    are added back to redis.
+    """
+    connection = django_rq.get_connection()
+    connection.delete(DOWNLOADS_FLUSH_KEY)
+
+    counts = {}
+    while True:
+        container_ids = connection.spop(DOWNLOADS_PENDING_KEY, 1000)
+        if not container_ids:
+            break
+        for container_id in container_ids:
+            pipeline = connection.pipeline(transaction=True)
+            pipeline.get(DOWNLOADS_KEY % int(container_id))
+            pipeline.delete(DOWNLOADS_KEY % int(container_id))
+            count, _ = pipeline.execute()
+            if count:
+                counts[int(container_id)] = int(count)
+
+    if counts:
+        try:
+            add_container_downloads(counts)
+        except DatabaseError:
+            pipeline = connection.pipeline()
+            for container_id, count in counts.items():
+                pipeline.incrby(DOWNLOADS_KEY % container_id, count)
+                pipeline.sadd(DOWNLOADS_PENDING_KEY, container_id)
+            pipeline.execute()
+            raise
+    return counts
+
+
+def get_download_counts(container_ids):
+    """return a lookup of downloads by container id, including counts not
+    yet written to the database. This is one query and one redis call,
+    regardless of the number of containers.
+
+    Parameters
+    ==========
+    container_ids: the list of container ids to get counts for
+    """
+    from shub.apps.logs.models import ContainerDownloadCount
+
+    container_ids = list(container_ids)
+    downloads = dict.fromkeys(container_ids, 0)
+    if not container_ids:
+        return downloads
+
+    downloads.update(
+        ContainerDownloadCount.objects.filter(
+            container_id__in=container_ids
+        ).values_list("container_id", "count")
+    )
+    try:
+        pending = django_rq.get_connection().mget(
+            [DOWNLOADS_KEY % container_id for container_id in container_ids]
+        )
+        for container_id, count in zip(container_ids, pending):
+            if count:
+                downloads[container_id] += int(count)
+    except RedisError:
+        pass
+    return downloads
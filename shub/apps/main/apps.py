@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class MainAppConfig(AppConfig):
@@ -6,3 +7,10 @@ class MainAppConfig(AppConfig):
 
     def ready(self):
         import shub.apps.main.models.signals  # noqa
+        from shub.apps.main.counters import fill_collection_counters
+        from shub.apps.main.permissions import create_permission_index
+        from shub.apps.main.search import create_search_index
+
+        post_migrate.connect(create_search_index, sender=self)
+        post_migrate.connect(create_permission_index, sender=self)
+        post_migrate.connect(fill_collection_counters, sender=self)
@@ -0,0 +1,114 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.db import DatabaseError
+from django.db.models import Count, F, FloatField, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Cast, Coalesce
+
+from shub.apps.main.models import Collection, Container, Star
+from shub.logger import bot
+
+################################################################################
+# COLLECTION COUNTERS
+################################################################################
+
+# Each collection keeps its container count, star count and total size (the
+# sum of the container sizes, in MB) in columns, so listings and pages read
+# them instead of counting. A star changes the star count with an F() update,
+# and a saved or deleted container recomputes the container count and size of
+# its collection in one UPDATE. Changes that don't send signals (e.g., bulk
+# updates) are fixed by reconcile_collection_counters.
+
+# Collections are reconciled in batches of this size
+COUNTER_BATCH_SIZE = 1000
+
+
+def get_container_counters():
+    """return the expressions for the container count and total size of a
+    collection (OuterRef), to update or annotate collections.
+    """
+    containers = (
+        Container.objects.filter(collection=OuterRef("pk"))
+        .order_by()
+        .values("collection")
+    )
+    size = Cast(Sum("size_bytes"), FloatField()) / (1 << 20)
+    return {
+        "container_count": Coalesce(
+            Subquery(containers.annotate(count=Count("id")).values("count")), 0
+        ),
+        "total_size_mb": Coalesce(
+            Subquery(containers.annotate(size=size).values("size")),
+            0.0,
+            output_field=FloatField(),
+        ),
+    }
+
+
+def get_collection_counters():
+    """return the expressions for all counters of a collection (OuterRef)"""
+    stars = (
+        Star.objects.filter(collection=OuterRef("pk"))
+        .order_by()
+        .values("collection")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    counters = get_container_counters()
+    counters["star_count"] = Coalesce(Subquery(stars), 0)
+    return counters
+
+
+def update_container_counters(collection_id):
+    """recompute the container count and total size of a collection"""
+    Collection.objects.filter(id=collection_id).update(**get_container_counters())
+
+
+def update_star_count(collection_id, delta):
+    """add (or remove) stars from the star count of a collection"""
+    collections = Collection.objects.filter(id=collection_id)
+    if delta < 0:
+        collections = collections.filter(star_count__gte=-delta)
+    collections.update(star_count=F("star_count") + delta)
+
+
+def reconcile_collection_counters(batch_size=COUNTER_BATCH_SIZE):
+    """recompute the counters of collections that are out of sync, returning
+    the number of collections updated.
+    """
+    counters = get_collection_counters()
+    stale = Q()
+    for name in counters:
+        stale |= ~Q(**{name: F("actual_%s" % name)})
+
+    collection_ids = list(
+        Collection.objects.alias(
+            **{"actual_%s" % name: value for name, value in counters.items()}
+        )
+        .filter(stale)
+        .values_list("id", flat=True)
+    )
+    for start in range(0, len(collection_ids), batch_size):
+        Collection.objects.filter(
+            id__in=collection_ids[start : start + batch_size]
+        ).update(**counters)
+    return len(collection_ids)
+
+
+def fill_collection_counters(**kwargs):
+    """fill the counters after migrations, e.g., when upgrading a registry
+    with existing collections (where the new columns start at 0).
+    """
+    try:
+        count = reconcile_collection_counters()
+        if count:
+            bot.info("Updated counters for %s collections." % count)
+    except DatabaseError as e:
+        bot.warning("Cannot update collection counters: %s" % e)
@@ -0,0 +1,267 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+import os
+import time
+from collections import Counter
+from datetime import timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import Case, CharField, Value, When
+from django.db.models.functions import Concat
+from django.utils.timezone import now
+
+from shub.apps.api.models import ImageBlob, ImageFile, ImageUpload
+from shub.apps.main.models import Container, StorageObject
+from shub.logger import bot
+
+################################################################################
+# GARBAGE COLLECTION
+################################################################################
+
+# Storage (objects in minio, and files in MEDIA_ROOT) is listed in batches,
+# and each batch is checked against the database with one query, so neither
+# the listing nor the references are loaded at once. Anything newer than the
+# grace period is skipped, it may be an upload that isn't complete yet.
+
+
+def get_batches(iterable, size):
+    """yield lists of (up to) size items from an iterable"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def get_legacy_storage():
+    """annotate containers with their legacy storage path (see
+    Container.get_storage) to look them up by path.
+    """
+    return Case(
+        When(
+            name__contains="/",
+            then=Concat("name", Value(":"), "version", output_field=CharField()),
+        ),
+        default=Concat(
+            "collection__name",
+            Value("/"),
+            "name",
+            Value(":"),
+            "version",
+            output_field=CharField(),
+        ),
+    )
+
+
+class GarbageCollector:
+    """find (and remove, unless dry_run) storage that is no longer referenced:
+
+    - objects in minio without a container (or StorageObject)
+    - temporary (_upload) objects in minio not used by a container, and stale
+      multipart uploads
+    - chunked uploads that were never completed, ImageFiles without a container
+    - files in MEDIA_ROOT without an ImageFile (or upload in progress, or ImageBlob)
+
+    Removals are limited to rate per second (0 for no limit).
+    """
+
+    def __init__(self, dry_run=False, rate=None, grace_hours=None, batch_size=None):
+        self.dry_run = dry_run
+        self.rate = settings.GC_DELETE_RATE if rate is None else rate
+        self.batch_size = batch_size or settings.GC_BATCH_SIZE
+        hours = settings.GC_GRACE_HOURS if grace_hours is None else grace_hours
+        self.cutoff = now() - timedelta(hours=hours)
+        self.counts = Counter()
+
+    def remove(self, kind, name, func, *args):
+        """remove (or report) one unreferenced item"""
+        self.counts[kind] += 1
+        if self.dry_run:
+            bot.info("Unreferenced %s: %s" % (kind, name))
+            return
+        bot.info("Removing unreferenced %s: %s" % (kind, name))
+        func(*args)
+        if self.rate:
+            time.sleep(1.0 / self.rate)
+
+    def run(self):
+        self.collect_objects()
+        self.collect_multipart_uploads()
+        self.collect_uploads()
+        self.collect_image_files()
+        self.collect_files()
+        return self.counts
+
+    # Minio
+
+    def list_objects(self):
+        """yield pages of (key, last modified) of objects in the bucket"""
+        from shub.apps.library.views.minio import get_s3_client
+
+        paginator = get_s3_client().get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=settings.MINIO_BUCKET,
+            PaginationConfig={"PageSize": self.batch_size},
+        ):
+            yield [(x["Key"], x["LastModified"]) for x in page.get("Contents", [])]
+
+    def collect_objects(self):
+        from shub.apps.library.views.minio import UPLOAD_STORAGE, get_minio_client
+
+        upload_prefix = UPLOAD_STORAGE.split("%")[0]
+        client = get_minio_client()
+        for page in self.list_objects():
+            keys = [key for key, modified in page if modified < self.cutoff]
+
+            digests = {
+                key: key.split("/", 1)[1] for key in keys if key.startswith("sha256/")
+            }
+            referenced = set(
+                StorageObject.objects.filter(
+                    digest__in=digests.values(), refcount__gt=0
+                ).values_list("digest", flat=True)
+            )
+
+            # An upload is kept while its container is pulled from it (until checked)
+            uploads = [key for key in keys if key.startswith(upload_prefix)]
+            referenced.update(
+                Container.objects.filter(metadata__storage__in=uploads).values_list(
+                    "metadata__storage", flat=True
+                )
+            )
+
+            legacy = [
+                key
+                for key in keys
+                if key not in digests and not key.startswith(upload_prefix)
+            ]
+            referenced.update(
+                Container.objects.exclude(metadata__has_key="storage")
+                .annotate(storage=get_legacy_storage())
+                .filter(storage__in=legacy)
+                .values_list("storage", flat=True)
+            )
+
+            for key in keys:
+                if digests.get(key, key) not in referenced:
+                    self.remove(
+                        "object", key, client.remove_object, settings.MINIO_BUCKET, key
+                    )
+
+    def collect_multipart_uploads(self):
+        """abort multipart uploads that were started and never completed"""
+        from shub.apps.library.views.minio import get_s3_client
+
+        client = get_s3_client()
+        paginator = client.get_paginator("list_multipart_uploads")
+        for page in paginator.paginate(Bucket=settings.MINIO_BUCKET):
+            for upload in page.get("Uploads", []):
+                if upload["Initiated"] >= self.cutoff:
+                    continue
+                self.remove(
+                    "multipart upload",
+                    "%s (%s)" % (upload["Key"], upload["UploadId"]),
+                    lambda upload: client.abort_multipart_upload(
+                        Bucket=settings.MINIO_BUCKET,
+                        Key=upload["Key"],
+                        UploadId=upload["UploadId"],
+                    ),
+                    upload,
+                )
+
+    # MEDIA_ROOT
+
+    def list_files(self, root):
+        """yield paths of files under root older than the cutoff"""
+        cutoff = self.cutoff.timestamp()
+        try:
+            entries = os.scandir(root)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self.list_files(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    if entry.stat().st_mtime < cutoff:
+                        yield entry.path
+
+    def collect_uploads(self):
+        """remove chunked uploads that were never completed"""
+        uploads = ImageUpload.objects.filter(
+            completed_on__isnull=True, created_on__lt=self.cutoff
+        ).only("id", "file")
+        for upload in uploads.iterator(chunk_size=self.batch_size):
+            self.remove("upload", upload.file.name, upload.delete)
+
+    def collect_image_files(self):
+        """remove ImageFiles (and their images) that no container uses"""
+        image_files = ImageFile.objects.filter(
+            container__isnull=True, created__lt=self.cutoff
+        ).only("id", "datafile", "digest")
+        for image_file in image_files.iterator(chunk_size=self.batch_size):
+            self.remove(
+                "image file",
+                image_file.datafile.name,
+                self.delete_image_file,
+                image_file,
+            )
+
+    def delete_image_file(self, image_file):
+        if image_file.datafile and os.path.exists(image_file.datafile.path):
+            image_file.datafile.delete(save=False)
+        image_file.delete()
+
+    def collect_files(self):
+        """remove files in MEDIA_ROOT (images, files uploaded by nginx to
+        UPLOAD_PATH, and blobs in IMAGE_BLOB_ROOT) that don't belong to an
+        ImageFile, an upload in progress, or an ImageBlob. A file name can be
+        relative to MEDIA_ROOT, or absolute.
+        """
+        blob_root = os.path.join(os.path.normpath(settings.IMAGE_BLOB_ROOT), "")
+        for paths in get_batches(self.list_files(settings.MEDIA_ROOT), self.batch_size):
+            names = {path: os.path.relpath(path, settings.MEDIA_ROOT) for path in paths}
+            blobs = {
+                path: os.path.basename(path).split(".")[0]
+                for path in paths
+                if path.startswith(blob_root)
+            }
+            lookup = list(names) + list(names.values())
+            referenced = set(
+                ImageFile.objects.filter(datafile__in=lookup).values_list(
+                    "datafile", flat=True
+                )
+            )
+            referenced.update(
+                ImageUpload.objects.filter(
+                    file__in=lookup, completed_on__isnull=True
+                ).values_list("file", flat=True)
+            )
+            referenced.update(
+                ImageBlob.objects.filter(
+                    digest__in=blobs.values(), refcount__gt=0
+                ).values_list("digest", flat=True)
+            )
+            for path, name in names.items():
+                if blobs.get(path, path) not in referenced and name not in referenced:
+                    self.remove("file", path, os.remove, path)
+
+
+def collect_garbage(dry_run=False, rate=None, grace_hours=None):
+    """find and remove unreferenced storage, a management command (gc) and
+    rq job. Returns the counts of each kind found.
+    """
+    counts = GarbageCollector(dry_run=dry_run, rate=rate, grace_hours=grace_hours).run()
+    for kind, count in counts.items():
+        bot.info("%s %s: %s" % ("Found" if dry_run else "Removed", kind, count))
+    return dict(counts)
@@ -0,0 +1,310 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+import math
+import re
+from functools import lru_cache
+
+import django_rq
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.http import JsonResponse
+from django.utils.timezone import now
+from redis.exceptions import RedisError
+
+from shub.apps.main.models import Collection, Container
+from shub.logger import bot
+
+################################################################################
+# GET LIMITS
+################################################################################
+
+# Weekly GET counts are kept in redis, one key per window, model and id.
+# A new (ISO) week starts a new window, so counts don't need to be reset.
+GET_COUNT_KEY = "sregistry:gets:%s:%s:%s"
+GET_COUNT_PATTERN = "sregistry:gets:%s:*"
+
+# A window key is kept a day longer than the week it counts
+GET_COUNT_EXPIRE_SECONDS = 8 * 24 * 60 * 60
+
+# Check both counts against their limits, and only increment if both are under
+GET_COUNT_SCRIPT = """
+local container = tonumber(redis.call("GET", KEYS[1]) or "0")
+local collection = tonumber(redis.call("GET", KEYS[2]) or "0")
+if container >= tonumber(ARGV[1]) or collection >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call("INCR", KEYS[1])
+redis.call("EXPIRE", KEYS[1], ARGV[3])
+redis.call("INCR", KEYS[2])
+redis.call("EXPIRE", KEYS[2], ARGV[3])
+return 1
+"""
+
+# Bytes served in ranges are added up for each container (in the window), and
+# a GET is counted each time they reach the size of the container, so a
+# download split into ranges (however it's split) counts like a whole one
+RANGE_BYTES_SCRIPT = """
+local served = redis.call("INCRBY", KEYS[1], ARGV[1])
+redis.call("EXPIRE", KEYS[1], ARGV[3])
+if served >= tonumber(ARGV[2]) then
+    redis.call("DECRBY", KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+def get_window():
+    """return the current (weekly) window, the ISO year and week"""
+    year, week, _ = now().isocalendar()
+    return "%s-%s" % (year, week)
+
+
+def get_count_keys(container, window=None):
+    """return the redis keys for the container and collection GET counts"""
+    window = window or get_window()
+    return [
+        GET_COUNT_KEY % (window, "container", container.id),
+        GET_COUNT_KEY % (window, "collection", container.collection_id),
+    ]
+
+
+def get_limit_reached(container):
+    """determine if the container (or its collection) has reached its
+    weekly GET limit, without counting a GET.
+
+    Parameters
+    ==========
+    container: the container to check
+    """
+    try:
+        counts = django_rq.get_connection().mget(get_count_keys(container))
+        container_count, collection_count = [int(count or 0) for count in counts]
+    except RedisError:
+        container_count = container.get_count
+        collection_count = container.collection.get_count
+
+    return (
+        container_count >= container.get_limit
+        or collection_count >= container.collection.get_limit
+    )
+
+
+def increment_get_count(container):
+    """count a GET for a container and its collection, if neither has
+    reached its weekly limit. The check and increment are atomic, so
+    concurrent downloads can't go over the limit or lose counts. Returns
+    True if the GET was counted (allowed), False otherwise.
+
+    Parameters
+    ==========
+    container: the container to count a GET for
+    """
+    try:
+        connection = django_rq.get_connection()
+        script = connection.register_script(GET_COUNT_SCRIPT)
+        return bool(
+            script(
+                keys=get_count_keys(container),
+                args=[
+                    container.get_limit,
+                    container.collection.get_limit,
+                    GET_COUNT_EXPIRE_SECONDS,
+                ],
+            )
+        )
+    except RedisError:
+        return increment_get_count_database(container)
+
+
+def count_byte_range(container, start, end, size):
+    """add a byte range (inclusive) served for a container, counting a GET
+    when the bytes served reach its size. If redis isn't available, a range
+    to the end of the file counts as a GET. Returns True if the range can be
+    served (the GET was counted, or the limits aren't reached).
+
+    Parameters
+    ==========
+    container: the container the range is served for
+    start: the first byte of the range
+    end: the last byte of the range
+    size: the size of the container file
+    """
+    try:
+        connection = django_rq.get_connection()
+        script = connection.register_script(RANGE_BYTES_SCRIPT)
+        counted = script(
+            keys=[GET_COUNT_KEY % (get_window(), "bytes", container.id)],
+            args=[end - start + 1, size, GET_COUNT_EXPIRE_SECONDS],
+        )
+    except RedisError:
+        counted = end == size - 1
+
+    if counted:
+        return increment_get_count(container)
+    return not get_limit_reached(container)
+
+
+def increment_get_count_database(container):
+    """count a GET in the database, used when redis isn't available. Each
+    count is a conditional update, so the rows are not saved (which would
+    regenerate the container secret and update the collection modify date).
+    """
+    with transaction.atomic():
+        counted = Container.objects.filter(
+            id=container.id, get_count__lt=F("get_limit")
+        ).update(get_count=F("get_count") + 1)
+        if not counted:
+            return False
+
+        counted = Collection.objects.filter(
+            id=container.collection_id, get_count__lt=F("get_limit")
+        ).update(get_count=F("get_count") + 1)
+        if not counted:
+            transaction.set_rollback(True)
+            return False
+    return True
+
+
+def reset_get_counts():
+    """reset GET counts for the current window. Past windows expire on their
+    own, so this only needs to remove the keys counted this week, and the
+    database counts that were used while redis wasn't available.
+    """
+    try:
+        connection = django_rq.get_connection()
+        keys = list(connection.scan_iter(GET_COUNT_PATTERN % get_window()))
+        if keys:
+            connection.delete(*keys)
+    except RedisError:
+        pass
+
+    Container.objects.filter(get_count__gt=0).update(get_count=0)
+    Collection.objects.filter(get_count__gt=0).update(get_count=0)
+
+
+################################################################################
+# RATE LIMITS
+################################################################################
+
+# Each rate limit budget (e.g., library pulls) is a token bucket in redis, for
+# the ip address of the request, and for the user of its token. A bucket holds
+# up to the count of the rate, and refills at the rate. A request takes one
+# token from each of its buckets, only if all have one, in one script (and
+# round trip) with the time of the redis server, so the limits hold across
+# workers and nodes.
+RATE_LIMIT_KEY = "sregistry:ratelimit:%s:%s:%s"
+
+# Returns 0 if a token was taken, otherwise the milliseconds until one is added
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local bucket = redis.call("HMGET", key, "tokens", "updated")
+    local count = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    count = math.min(capacity, count + math.max(0, now - updated) * rate)
+    if count < 1 then
+        wait = math.max(wait, (1 - count) / rate)
+    end
+    tokens[i] = count
+end
+for i, key in ipairs(KEYS) do
+    if wait == 0 then
+        tokens[i] = tokens[i] - 1
+    end
+    redis.call("HSET", key, "tokens", tostring(tokens[i]), "updated", tostring(now))
+    redis.call("EXPIRE", key, math.ceil(capacity / rate) + 1)
+end
+return math.ceil(wait * 1000)
+"""
+
+rate_regex = re.compile("^(?P<count>[0-9]+)/(?P<multiplier>[0-9]*)(?P<period>[smhd])$")
+rate_periods = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+
+@lru_cache(maxsize=None)
+def parse_rate(rate):
+    """parse a rate (as for django-ratelimit, e.g., 100/1h) to the count and
+    the period in seconds, or None if it's not set
+    """
+    if not rate:
+        return None
+    match = rate_regex.match(rate)
+    if match is None:
+        raise ValueError("%s is not a valid rate limit (e.g., 100/1h)" % rate)
+    seconds = int(match.group("multiplier") or 1) * rate_periods[match.group("period")]
+    return int(match.group("count")), seconds
+
+
+def get_rate_limit_keys(request, budget):
+    """return the redis keys of the buckets for a request, one for the ip
+    address, and one for the user of the token (if it's valid)
+    """
+    from shub.apps.library.views.helpers import get_request_token
+
+    keys = [RATE_LIMIT_KEY % (budget, "ip", request.META.get("REMOTE_ADDR"))]
+    token = get_request_token(request)
+    if token is not None:
+        keys.append(RATE_LIMIT_KEY % (budget, "user", token.user_id))
+    return keys
+
+
+def take_rate_limit_token(request, budget, rate):
+    """take a token from the buckets of a request for a budget. Returns 0 if
+    the request is allowed, otherwise the seconds until it would be. If redis
+    isn't available, requests are allowed.
+
+    Parameters
+    ==========
+    request: the request to limit
+    budget: the name of the budget (e.g., pull)
+    rate: the rate limit, as a count and period (e.g., 100/1h)
+    """
+    limit = parse_rate(rate)
+    if limit is None:
+        return 0
+
+    count, seconds = limit
+    try:
+        connection = django_rq.get_connection()
+        script = connection.register_script(TOKEN_BUCKET_SCRIPT)
+        wait = script(
+            keys=get_rate_limit_keys(request, budget), args=[count, count / seconds]
+        )
+    except RedisError as e:
+        bot.warning("Cannot check rate limit: %s" % e)
+        return 0
+    return int(math.ceil(int(wait) / 1000))
+
+
+class TokenBucketMixin:
+    """Limit a view to a rate limit budget (see take_rate_limit_token), shared
+    by the views with the same budget. A request over the limit gets a 429,
+    with the seconds to wait in Retry-After.
+    """
+
+    rate_limit_budget = None
+    rate_limit_setting = None
+
+    def dispatch(self, request, *args, **kwargs):
+        rate = getattr(settings, self.rate_limit_setting, None)
+        wait = take_rate_limit_token(request, self.rate_limit_budget, rate)
+        if wait:
+            response = JsonResponse({"message": "Rate limit exceeded."}, status=429)
+            response["Retry-After"] = str(wait)
+            return response
+        return super().dispatch(request, *args, **kwargs)
@@ -0,0 +1,95 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+import base64
+import binascii
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+################################################################################
+# COLLECTION LISTING
+################################################################################
+
+# Collections are listed from one query: the collections visible to the user
+# (see shub.apps.main.permissions), sorted by a column (the counters are kept
+# on the collection, see shub.apps.main.counters), in pages. A page starts
+# after the (sort key, id) of the last collection of the previous page (keyset
+# pagination), so a page is an index range, however deep it is.
+
+# Sort orders, the field to sort by (descending, then by id)
+COLLECTION_ORDERS = {
+    "stars": "star_count",
+    "recent": "modify_date",
+    "size": "total_size_mb",
+}
+
+DEFAULT_COLLECTION_ORDER = "stars"
+
+
+def encode_cursor(value, pk):
+    """encode the sort key and id of the last collection of a page, without
+    the base64 padding so it can be used in a url as is
+    """
+    if hasattr(value, "isoformat"):
+        value = value.isoformat()
+    cursor = base64.urlsafe_b64encode(json.dumps([value, pk]).encode())
+    return cursor.decode().rstrip("=")
+
+
+def decode_cursor(cursor, order):
+    """decode a cursor to (sort key, id), or None if it's not valid"""
+    try:
+        cursor += "=" * (-len(cursor) % 4)
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if order == "recent":
+            value = parse_datetime(value)
+        elif not isinstance(value, (int, float)):
+            return None
+        if value is None or not isinstance(pk, int):
+            return None
+        return value, pk
+    except (binascii.Error, TypeError, ValueError):
+        return None
+
+
+def list_collections(collections, order=None, cursor=None, size=50):
+    """return a page of collections (a list), and the cursor for the next
+    page (or None if it's the last page).
+
+    Parameters
+    ==========
+    collections: the collections to list (e.g., get_visible_collections)
+    order: the sort order, one of COLLECTION_ORDERS (defaults to stars)
+    cursor: the cursor of the page, from the previous page
+    size: the number of collections in a page
+    """
+    if order not in COLLECTION_ORDERS:
+        order = DEFAULT_COLLECTION_ORDER
+    key = COLLECTION_ORDERS[order]
+
+    # The listing doesn't show the metadata or search text
+    collections = collections.defer("metadata", "search_text").order_by(
+        "-%s" % key, "-id"
+    )
+    after = decode_cursor(cursor, order) if cursor else None
+    if after is not None:
+        value, pk = after
+        collections = collections.filter(
+            Q(**{"%s__lt" % key: value}) | Q(**{key: value, "id__lt": pk})
+        )
+
+    page = list(collections[: size + 1])
+    if len(page) <= size:
+        return page, None
+    page = page[:size]
+    last = page[-1]
+    return page, encode_cursor(getattr(last, key), last.id)
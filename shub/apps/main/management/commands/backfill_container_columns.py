@@ -0,0 +1,117 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+import os
+
+from django.core.management.base import BaseCommand
+from django.db.models import F, Q
+from django.db.models.fields.json import KeyTextTransform
+
+from shub.apps.main.counters import reconcile_collection_counters
+from shub.apps.main.gc import get_batches
+from shub.apps.main.models import Container
+from shub.apps.main.models.containers import get_digest
+from shub.logger import bot
+
+# Containers are updated in batches of this size
+BACKFILL_BATCH_SIZE = 500
+
+
+def get_container_size(container):
+    """return the size (bytes) of a container image: the size of the file,
+    or of the object in minio, or (rounded) the size_mb in the metadata.
+    """
+    from minio.error import NoSuchKey
+
+    from shub.apps.library.views.minio import get_container_storage, get_minio_client
+    from shub.settings import MINIO_BUCKET
+
+    if container.image is not None:
+        if container.image.datafile and os.path.exists(container.image.datafile.path):
+            return os.path.getsize(container.image.datafile.path)
+
+    elif not container.metadata.get("image"):
+        try:
+            return (
+                get_minio_client()
+                .stat_object(MINIO_BUCKET, get_container_storage(container))
+                .size
+            )
+        except NoSuchKey:
+            pass
+        except Exception as e:
+            bot.warning("Cannot get the size of %s: %s" % (container.get_uri(), e))
+
+    size_mb = container.metadata.get("size_mb", container.metrics.get("size_mb"))
+    try:
+        return int(float(size_mb) * (1 << 20))
+    except (TypeError, ValueError):
+        return None
+
+
+class Command(BaseCommand):
+    """fill the size, digest and arch columns of containers pushed before
+    they were added (from the image file or object, version and metadata),
+    and then the collection counters. Run once after upgrading, it's safe
+    to run again.
+    """
+
+    help = "Fill the size, digest and arch columns of existing containers"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            dest="dry_run",
+            default=False,
+            action="store_true",
+            help="Show the containers that would be updated.",
+        )
+
+    def handle(self, *args, **options):
+        containers = (
+            Container.objects.alias(metadata_arch=KeyTextTransform("arch", "metadata"))
+            .filter(
+                Q(size_bytes__isnull=True)
+                | Q(digest__isnull=True, version__startswith="sha256.")
+                | (Q(metadata_arch__isnull=False) & ~Q(arch=F("metadata_arch")))
+            )
+            .select_related("image", "collection")
+            .order_by("id")
+        )
+
+        count = 0
+        for batch in get_batches(
+            containers.iterator(chunk_size=BACKFILL_BATCH_SIZE), BACKFILL_BATCH_SIZE
+        ):
+            for container in batch:
+                container.digest = get_digest(container.version)
+                container.arch = container.metadata.get("arch") or container.arch
+                if container.size_bytes is None:
+                    container.size_bytes = get_container_size(container)
+                bot.info(
+                    "%s: size %s, digest %s, arch %s"
+                    % (
+                        container.get_uri(),
+                        container.size_bytes,
+                        container.digest,
+                        container.arch,
+                    )
+                )
+
+            # Update the rows directly, saving would change the container secret
+            if not options["dry_run"]:
+                Container.objects.bulk_update(batch, ["size_bytes", "digest", "arch"])
+            count += len(batch)
+
+        if not options["dry_run"]:
+            reconcile_collection_counters()
+        bot.info(
+            "%s %s containers." % ("Found" if options["dry_run"] else "Updated", count)
+        )
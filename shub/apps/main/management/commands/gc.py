@@ -0,0 +1,85 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+import django_rq
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from shub.apps.main.gc import collect_garbage
+from shub.logger import bot
+
+# A job on the worker can take as long as it needs
+GC_JOB_TIMEOUT = -1
+
+
+class Command(BaseCommand):
+    """scheduled to run nightly to remove storage that is no longer
+    referenced: objects in minio, multipart and chunked uploads, and files
+    in MEDIA_ROOT. See shub.apps.main.gc for what is removed. The nightly
+    run (--scheduled) is a dry run unless GC_ENABLED is set.
+    """
+
+    help = "Remove unreferenced storage and stale uploads"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            dest="dry_run",
+            default=False,
+            action="store_true",
+            help="Show what would be removed, without removing it.",
+        )
+        parser.add_argument(
+            "--rate",
+            dest="rate",
+            default=None,
+            type=float,
+            help="Remove at most this many items per second (default GC_DELETE_RATE).",
+        )
+        parser.add_argument(
+            "--grace-hours",
+            dest="grace_hours",
+            default=None,
+            type=int,
+            help="Skip storage newer than this (default GC_GRACE_HOURS).",
+        )
+        parser.add_argument(
+            "--scheduled",
+            dest="scheduled",
+            default=False,
+            action="store_true",
+            help="Run as the nightly job, a dry run unless GC_ENABLED.",
+        )
+        parser.add_argument(
+            "--queue",
+            dest="queue",
+            default=False,
+            action="store_true",
+            help="Run as a job on the worker.",
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options["dry_run"]
+        if options["scheduled"] and not settings.GC_ENABLED:
+            bot.info("GC_ENABLED is not set, nothing will be removed.")
+            dry_run = True
+
+        kwargs = {
+            "dry_run": dry_run,
+            "rate": options["rate"],
+            "grace_hours": options["grace_hours"],
+        }
+        if options["queue"]:
+            job = django_rq.get_queue("default").enqueue(
+                collect_garbage, job_timeout=GC_JOB_TIMEOUT, **kwargs
+            )
+            bot.info("Queued garbage collection job %s." % job.id)
+            return
+        collect_garbage(**kwargs)
@@ -0,0 +1,27 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.core.management.base import BaseCommand
+
+from shub.apps.main.permissions import rebuild_permissions
+from shub.logger import bot
+
+
+class Command(BaseCommand):
+    """Generate the permission index for all collections, e.g., after an
+    upgrade. The index is otherwise kept in sync when owners, contributors
+    and teams change.
+    """
+
+    help = "Rebuild the collection permission index"
+
+    def handle(self, *args, **options):
+        count = rebuild_permissions()
+        bot.info("Indexed permissions for %s collections." % count)
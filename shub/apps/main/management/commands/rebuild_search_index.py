@@ -0,0 +1,27 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.core.management.base import BaseCommand
+
+from shub.apps.main.search import create_search_index, rebuild_search_index
+from shub.logger import bot
+
+
+class Command(BaseCommand):
+    """Generate the search text for all collections, e.g., after an upgrade.
+    The search text is otherwise kept in sync when containers change.
+    """
+
+    help = "Rebuild the collection search index"
+
+    def handle(self, *args, **options):
+        create_search_index()
+        count = rebuild_search_index()
+        bot.info("Indexed %s collections." % count)
@@ -0,0 +1,27 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.core.management.base import BaseCommand
+
+from shub.apps.main.counters import reconcile_collection_counters
+from shub.logger import bot
+
+
+class Command(BaseCommand):
+    """Recompute the container count, star count and total size of
+    collections that are out of sync, e.g., after an upgrade, or changes
+    made without signals (bulk updates, or in the database).
+    """
+
+    help = "Reconcile the collection container, star and size counters"
+
+    def handle(self, *args, **options):
+        count = reconcile_collection_counters()
+        bot.info("Updated counters for %s collections." % count)
@@ -1,2 +1,4 @@
 from .containers import Container
+from .permissions import CollectionPermission
 from .shared import *  # noqa
+from .storage import StorageObject
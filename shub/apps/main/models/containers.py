@@ -8,6 +8,7 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 """
 
+import re
 import uuid
 
 from django.db import models
@@ -28,6 +29,20 @@ FROZEN_CHOICES = ((True, "Frozen"), (False, "Not Frozen"))
 
 ACTIVE_CHOICES = ((True, "Active"), (False, "Disabled"))
 
+# A container version that is a sha256 digest
+digest_regex = re.compile("^sha256[.](?P<digest>[0-9a-f]{64})$")
+
+# JSON fields that can be large (e.g., build_metadata from Google Build),
+# deferred when listing containers
+DEFERRED_FIELDS = ["metadata", "metrics"]
+
+
+def get_digest(version):
+    """return the sha256 digest of a container version, or None"""
+    match = digest_regex.match(version or "")
+    if match:
+        return match.group("digest")
+
 
 ################################################################################
 # Containers ###################################################################
@@ -66,6 +81,12 @@ class Container(models.Model):
         choices=FROZEN_CHOICES, default=False, verbose_name=verbose_frozen_name
     )
 
+    # The image size (bytes), sha256 digest and architecture, to filter, sort
+    # and sum in the database. The digest is kept in sync with the version.
+    size_bytes = models.BigIntegerField(null=True, blank=True, db_index=True)
+    digest = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    arch = models.CharField(max_length=32, default="amd64", db_index=True)
+
     # Limits on number of GETS - the counter (top) and then a custom value
     get_count = models.PositiveIntegerField(null=False, blank=False, default=0)
     get_limit = models.PositiveIntegerField(
@@ -107,9 +128,16 @@ class Container(models.Model):
         if save is True:
             self.save()
 
+    def get_size_mb(self):
+        """the image size in MB, or None if it isn't known"""
+        if self.size_bytes is None:
+            return None
+        return self.size_bytes >> 20
+
     def save(self, *args, **kwargs):
-        """update secret on each save"""
+        """update secret (and the digest of the version) on each save"""
         self.update_secret(save=False)
+        self.digest = get_digest(self.version)
         super(Container, self).save(*args, **kwargs)
 
     def get_image_path(self):
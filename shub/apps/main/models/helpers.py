@@ -22,6 +22,7 @@ def has_edit_permission(instance, request):
     request: the request with the user object OR the user object
     """
     from .containers import Container
+    from .permissions import EDIT_LEVELS, CollectionPermission
 
     if isinstance(instance, Container):
         instance = instance.collection
@@ -42,9 +43,9 @@ def has_edit_permission(instance, request):
         return True
 
     # Collection Owners can edit
-    if user in instance.owners.all():
-        return True
-    return False
+    return CollectionPermission.objects.filter(
+        user_id=user.id, collection_id=instance.id, level__in=EDIT_LEVELS
+    ).exists()
 
 
 def has_view_permission(instance, request):
@@ -59,6 +60,7 @@ def has_view_permission(instance, request):
 
     """
     from .containers import Container
+    from .permissions import VIEW_LEVELS, CollectionPermission
 
     if isinstance(instance, Container):
         instance = instance.collection
@@ -80,11 +82,9 @@ def has_view_permission(instance, request):
         return True
 
     # Collection Contributors (owners and contributors)
-    contributors = instance.members()
-    if user in contributors:
-        return True
-
-    return False
+    return CollectionPermission.objects.filter(
+        user_id=user.id, collection_id=instance.id, level__in=VIEW_LEVELS
+    ).exists()
 
 
 def get_collection_users(instance):
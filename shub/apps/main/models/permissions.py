@@ -0,0 +1,49 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.db import models
+
+################################################################################
+# Collection Permissions #######################################################
+################################################################################
+
+PERMISSION_LEVELS = (
+    ("owner", "Owner of the collection"),
+    ("contributor", "Contributor to the collection"),
+    ("team_owner", "Owner of a team of a collection owner"),
+    ("team_member", "Member of a team of a collection owner"),
+)
+
+# Owners can edit, owners and contributors can view (pull) a private collection
+EDIT_LEVELS = ["owner"]
+VIEW_LEVELS = ["owner", "contributor"]
+
+
+class CollectionPermission(models.Model):
+    """An index of the users with access to a collection, one row for each
+    user, collection and level (owner, contributor, or through a team owned
+    by a collection owner). It's derived from the collection and team owners
+    and members, and kept in sync when they change (see shub.apps.main.permissions).
+    """
+
+    user = models.ForeignKey(
+        "users.User", on_delete=models.CASCADE, related_name="collection_permissions"
+    )
+    collection = models.ForeignKey(
+        "main.Collection", on_delete=models.CASCADE, related_name="permissions"
+    )
+    level = models.CharField(choices=PERMISSION_LEVELS, max_length=16)
+
+    def __str__(self):
+        return "%s:%s:%s" % (self.user_id, self.collection_id, self.level)
+
+    class Meta:
+        app_label = "main"
+        unique_together = (("user", "collection", "level"),)
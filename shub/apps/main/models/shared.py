@@ -93,6 +93,14 @@ class Collection(models.Model):
         verbose_name="Accessibility",
     )
 
+    # Collection, container names, tags and labels, kept in sync for search
+    search_text = models.TextField(blank=True, default="", editable=False)
+
+    # Counters, kept in sync with the containers and stars (see main/counters.py)
+    container_count = models.PositiveIntegerField(default=0, editable=False)
+    star_count = models.PositiveIntegerField(default=0, editable=False)
+    total_size_mb = models.FloatField(default=0, editable=False)
+
     def get_absolute_url(self):
         return_cid = self.id
         return reverse("collection_details", args=[str(return_cid)])
@@ -104,13 +112,16 @@ class Collection(models.Model):
         return self.get_uri()
 
     def sizes(self, container_name=None):
-        """return list of sizes for containers across collection.
+        """return list of sizes (MB) for containers across collection.
         Optionally limited to container name"""
         if container_name is not None:
             queryset = self.containers.filter(name=container_name)
         else:
             queryset = self.containers.all()
-        return [x.metadata["size_mb"] for x in queryset if "size_mb" in x.metadata]
+        sizes = queryset.filter(size_bytes__isnull=False).values_list(
+            "size_bytes", flat=True
+        )
+        return [size / (1 << 20) for size in sizes]
 
     def members(self):
         """a compiled list of members (contributors and owners)"""
@@ -118,16 +129,22 @@ class Collection(models.Model):
 
     def mean_size(self, container_name=None):
         total = self.total_size(container_name=container_name)
-        if total == 0:
-            return total
-        return total / self.containers.count()
+        if container_name is None:
+            count = self.container_count
+        else:
+            count = self.containers.filter(name=container_name).count()
+        if total == 0 or count == 0:
+            return 0
+        return total / count
 
     def total_size(self, container_name=None):
+        if container_name is None:
+            return self.total_size_mb
         sizes = self.sizes(container_name=container_name)
         return sum(sizes)
 
     def get_uri(self):
-        return "%s:%s" % (self.name, self.containers.count())
+        return "%s:%s" % (self.name, self.container_count)
 
     def get_label(self):
         return "collection"
@@ -166,6 +183,11 @@ class Collection(models.Model):
 
     class Meta:
         app_label = "main"
+        indexes = [
+            models.Index(fields=["star_count", "id"]),
+            models.Index(fields=["modify_date", "id"]),
+            models.Index(fields=["total_size_mb", "id"]),
+        ]
         permissions = (
             ("pull_collection", "Pull container collection"),
             ("change_privacy_collection", "Change the privacy of a collection"),
@@ -8,14 +8,20 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 """
 
-from django.db.models.signals import post_delete
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
 
+from shub.apps.api.models import ImageFile
+from shub.apps.users.models import Team, User
+
 from .containers import Container
+from .shared import Collection, Star
 
 
 @receiver(post_delete, sender=Container)
 def delete_imagefile(sender, instance, **kwargs):
+    from shub.apps.api.dedup import release_image
+
     print("Delete imagefile signal running.")
     if instance.image not in ["", None]:
         if hasattr(instance.image, "datafile"):
@@ -24,4 +30,195 @@ def delete_imagefile(sender, instance, **kwargs):
             ).count()
             if count == 0:
                 print("Deleting %s, no longer used." % instance.image.datafile)
+                release_image(instance.image)
                 instance.image.datafile.delete()
+
+
+@receiver(post_delete, sender=ImageFile)
+def release_imagefile(sender, instance, **kwargs):
+    """A deleted ImageFile is no longer linked to its ImageBlob"""
+    from shub.apps.api.dedup import release_image
+
+    release_image(instance)
+
+
+@receiver(post_save, sender=Container)
+@receiver(post_delete, sender=Container)
+def clear_container_cache(sender, instance, **kwargs):
+    """Resolved containers for the collection are no longer valid"""
+    from shub.apps.main.query import container_cache
+
+    container_cache.clear_collection(instance.collection_id)
+
+
+@receiver(post_delete, sender=Container)
+def release_container_storage(sender, instance, **kwargs):
+    """A deleted container no longer references its storage object"""
+    from shub.apps.library.views.minio import release_storage_reference
+
+    release_storage_reference(instance)
+
+
+@receiver(post_save, sender=Container)
+@receiver(post_delete, sender=Container)
+def clear_signed_url_cache(sender, instance, **kwargs):
+    """A re-pushed or deleted container needs a new download url"""
+    from shub.apps.library.views.minio import signed_url_cache
+
+    signed_url_cache.clear(instance.id)
+
+
+@receiver(post_save, sender=Collection)
+@receiver(post_delete, sender=Collection)
+@receiver(m2m_changed, sender=Collection.owners.through)
+@receiver(m2m_changed, sender=Collection.contributors.through)
+def clear_collection_container_cache(sender, instance, **kwargs):
+    """Cached containers hold the collection, privacy, owners and contributors.
+    For a change from the user side (reverse m2m) we clear everything.
+    """
+    from shub.apps.main.query import container_cache
+
+    if isinstance(instance, Collection):
+        container_cache.clear_collection(instance.id)
+    else:
+        container_cache.clear()
+
+
+@receiver(post_save, sender=Collection)
+@receiver(post_save, sender=Container)
+@receiver(post_delete, sender=Container)
+@receiver(m2m_changed, sender=Container.tags.through)
+def update_collection_search(sender, instance, **kwargs):
+    """Keep the collection search text in sync with its containers"""
+    from shub.apps.main.search import update_search_index
+
+    if isinstance(instance, Collection):
+        update_search_index(instance)
+    elif isinstance(instance, Container):
+        try:
+            update_search_index(instance.collection)
+        except Collection.DoesNotExist:
+            pass
+
+
+@receiver(post_delete, sender=Collection)
+def delete_collection_search(sender, instance, **kwargs):
+    from shub.apps.main.search import delete_search_index
+
+    delete_search_index(instance.id)
+
+
+@receiver(m2m_changed, sender=Collection.owners.through)
+@receiver(m2m_changed, sender=Collection.contributors.through)
+def update_collection_permission_index(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    """Keep the permission index in sync with the owners and contributors.
+    From the user side (reverse), the cleared collections are saved before
+    the clear, when they are still known.
+    """
+    from shub.apps.main.permissions import update_collection_permissions
+
+    if not reverse:
+        if action in ["post_add", "post_remove", "post_clear"]:
+            update_collection_permissions([instance.id])
+    elif action == "pre_clear":
+        instance._cleared_collection_ids = set(
+            sender.objects.filter(user_id=instance.id).values_list(
+                "collection_id", flat=True
+            )
+        )
+    elif action == "post_clear":
+        update_collection_permissions(
+            instance.__dict__.pop("_cleared_collection_ids", [])
+        )
+    elif action in ["post_add", "post_remove"]:
+        update_collection_permissions(pk_set)
+
+
+@receiver(m2m_changed, sender=Team.owners.through)
+@receiver(m2m_changed, sender=Team.members.through)
+def update_team_permission_index(sender, instance, action, reverse, pk_set, **kwargs):
+    """Team owners and members have access to the collections of the team
+    owners. Collections of an owner that is removed (or cleared) are updated
+    too, the collections are found before a clear.
+    """
+    from shub.apps.main.permissions import (
+        get_team_collection_ids,
+        update_collection_permissions,
+    )
+
+    if action not in ["pre_clear", "post_clear", "post_add", "post_remove"]:
+        return
+
+    is_owners = sender is Team.owners.through
+    if action == "post_clear":
+        update_collection_permissions(
+            instance.__dict__.pop("_cleared_collection_ids", [])
+        )
+        return
+
+    if reverse:
+        team_ids = pk_set
+        if action == "pre_clear":
+            team_ids = sender.objects.filter(user_id=instance.id).values_list(
+                "team_id", flat=True
+            )
+        user_ids = [instance.id] if is_owners else []
+    else:
+        team_ids = [instance.id]
+        user_ids = pk_set if is_owners else []
+
+    collection_ids = get_team_collection_ids(team_ids, user_ids)
+    if action == "pre_clear":
+        instance._cleared_collection_ids = collection_ids
+    else:
+        update_collection_permissions(collection_ids)
+
+
+@receiver(pre_delete, sender=Team)
+@receiver(pre_delete, sender=User)
+def save_permission_index_collections(sender, instance, **kwargs):
+    """A deleted team changes the access to the collections of its owners,
+    and a deleted user to the collections they owned. The team owners and
+    members (or collection owners) are deleted first, so the collections
+    are found before.
+    """
+    from shub.apps.main.permissions import get_team_collection_ids
+
+    if isinstance(instance, Team):
+        instance._deleted_collection_ids = get_team_collection_ids([instance.id])
+    else:
+        instance._deleted_collection_ids = get_team_collection_ids([], [instance.id])
+
+
+@receiver(post_delete, sender=Team)
+@receiver(post_delete, sender=User)
+def update_deleted_permission_index(sender, instance, **kwargs):
+    from shub.apps.main.permissions import update_collection_permissions
+
+    update_collection_permissions(instance.__dict__.pop("_deleted_collection_ids", []))
+
+
+@receiver(post_save, sender=Container)
+@receiver(post_delete, sender=Container)
+def update_collection_container_counters(sender, instance, **kwargs):
+    """Keep the container count and total size of the collection in sync"""
+    from shub.apps.main.counters import update_container_counters
+
+    update_container_counters(instance.collection_id)
+
+
+@receiver(post_save, sender=Star)
+def add_collection_star(sender, instance, created, **kwargs):
+    from shub.apps.main.counters import update_star_count
+
+    if created:
+        update_star_count(instance.collection_id, 1)
+
+
+@receiver(post_delete, sender=Star)
+def remove_collection_star(sender, instance, **kwargs):
+    from shub.apps.main.counters import update_star_count
+
+    update_star_count(instance.collection_id, -1)
@@ -0,0 +1,39 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.db import models
+
+################################################################################
+# Storage Objects ##############################################################
+################################################################################
+
+
+class StorageObject(models.Model):
+    """A content addressed object in storage (minio), keyed by the sha256
+    digest of the container, and the number of containers that reference
+    it. The object is deleted when the last reference is released. It's
+    verified once its sha256 is checked by the server (a pushed upload), and
+    otherwise it was copied from an object with the digest as its name.
+    """
+
+    digest = models.CharField(max_length=64, null=False, blank=False, unique=True)
+    refcount = models.PositiveIntegerField(null=False, blank=False, default=0)
+    verified = models.BooleanField(default=False)
+    add_date = models.DateTimeField("date object added", auto_now_add=True)
+
+    def get_storage(self):
+        """Return the storage path, the digest under sha256/"""
+        return "sha256/%s" % self.digest
+
+    def __str__(self):
+        return self.get_storage()
+
+    class Meta:
+        app_label = "main"
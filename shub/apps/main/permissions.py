@@ -0,0 +1,156 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.db import DatabaseError, transaction
+from django.db.models import Q
+
+from shub.apps.main.models import Collection, CollectionPermission
+from shub.apps.main.models.permissions import VIEW_LEVELS
+from shub.apps.users.models import Team
+from shub.logger import bot
+
+################################################################################
+# PERMISSION INDEX
+################################################################################
+
+# Each user with access to a collection has a CollectionPermission row for
+# each level: owner, contributor, or team_owner / team_member of a team that
+# a collection owner owns. A permission check is one indexed lookup, and
+# the collections a user can view are one join. The rows of a collection are
+# recomputed (in a fixed number of queries) when its owners or contributors
+# change, or the owners or members of a team of one of its owners change.
+
+# Collections are (re)indexed in batches of this size
+PERMISSION_BATCH_SIZE = 500
+
+
+def get_collection_permissions(collection_ids):
+    """return the set of (user id, collection id, level) for collections,
+    derived from the collection owners and contributors, and the owners and
+    members of the teams the collection owners own.
+    """
+    Owners = Collection.owners.through
+    Contributors = Collection.contributors.through
+    TeamOwners = Team.owners.through
+    TeamMembers = Team.members.through
+
+    rows = set()
+    owners = {}
+    for collection_id, user_id in Owners.objects.filter(
+        collection_id__in=collection_ids
+    ).values_list("collection_id", "user_id"):
+        owners.setdefault(user_id, set()).add(collection_id)
+        rows.add((user_id, collection_id, "owner"))
+
+    for collection_id, user_id in Contributors.objects.filter(
+        collection_id__in=collection_ids
+    ).values_list("collection_id", "user_id"):
+        rows.add((user_id, collection_id, "contributor"))
+
+    # The collections of the teams owned by the collection owners
+    teams = {}
+    for team_id, user_id in TeamOwners.objects.filter(user_id__in=owners).values_list(
+        "team_id", "user_id"
+    ):
+        teams.setdefault(team_id, set()).update(owners[user_id])
+
+    for through, level in [(TeamOwners, "team_owner"), (TeamMembers, "team_member")]:
+        for team_id, user_id in through.objects.filter(team_id__in=teams).values_list(
+            "team_id", "user_id"
+        ):
+            rows.update(
+                (user_id, collection_id, level) for collection_id in teams[team_id]
+            )
+    return rows
+
+
+def update_collection_permissions(collection_ids):
+    """replace the permission rows of one or more collections"""
+    collection_ids = set(collection_ids)
+    if not collection_ids:
+        return
+    rows = get_collection_permissions(collection_ids)
+    with transaction.atomic():
+        CollectionPermission.objects.filter(collection_id__in=collection_ids).delete()
+        CollectionPermission.objects.bulk_create(
+            [
+                CollectionPermission(
+                    user_id=user_id, collection_id=collection_id, level=level
+                )
+                for user_id, collection_id, level in rows
+            ],
+            ignore_conflicts=True,
+        )
+
+
+def get_team_collection_ids(team_ids, user_ids=None):
+    """return the ids of the collections owned by an owner of the teams (or
+    one of the users), the collections with permissions derived from them.
+    """
+    query = Q(user__team_owners__in=team_ids)
+    if user_ids:
+        query |= Q(user_id__in=user_ids)
+    return set(
+        Collection.owners.through.objects.filter(query).values_list(
+            "collection_id", flat=True
+        )
+    )
+
+
+def get_viewable_collection_ids(user):
+    """return a query of the ids of the collections a user owns or
+    contributes to, to filter collections (or containers) in one query.
+    """
+    return CollectionPermission.objects.filter(
+        user_id=user.id, level__in=VIEW_LEVELS
+    ).values("collection_id")
+
+
+def get_visible_collections(user):
+    """return the collections a user can view, the public collections, and
+    the private collections they own or contribute to (all for staff).
+    """
+    if user.is_authenticated and (user.is_staff or user.is_superuser):
+        return Collection.objects.all()
+    query = Q(private=False)
+    if user.is_authenticated:
+        query |= Q(id__in=get_viewable_collection_ids(user))
+    return Collection.objects.filter(query)
+
+
+def rebuild_permissions():
+    """regenerate the permission rows for all collections, returning the count"""
+    collection_ids = Collection.objects.values_list("id", flat=True).order_by("id")
+    with transaction.atomic():
+        CollectionPermission.objects.all().delete()
+        batch = []
+        for collection_id in collection_ids.iterator():
+            batch.append(collection_id)
+            if len(batch) == PERMISSION_BATCH_SIZE:
+                update_collection_permissions(batch)
+                batch = []
+        update_collection_permissions(batch)
+        count = collection_ids.count()
+    return count
+
+
+def create_permission_index(**kwargs):
+    """fill the permission index after migrations if it's empty, e.g., when
+    upgrading a registry with existing collections.
+    """
+    try:
+        if (
+            not CollectionPermission.objects.exists()
+            and Collection.objects.filter(owners__isnull=False).exists()
+        ):
+            count = rebuild_permissions()
+            bot.info("Indexed permissions for %s collections." % count)
+    except DatabaseError as e:
+        bot.warning("Cannot create permission index: %s" % e)
@@ -8,20 +8,27 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 """
 
+import re
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
 
-from django.db.models import Q
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.query import prefetch_related_objects
 
 from shub.apps.main.models import Collection, Container
+from shub.apps.main.permissions import get_viewable_collection_ids
 from sregistry.utils import parse_image_name
 
 
 def collection_query(q):
-    return Collection.objects.filter(
-        Q(name__contains=q)
-        | Q(containers__name__icontains=q)
-        | Q(containers__tags__name__icontains=q)
-        | Q(containers__tag__icontains=q)
-    ).distinct()
+    """search collections by name, container name, tag and label, ranked"""
+    from shub.apps.main.search import search_collections
+
+    return search_collections(q)
 
 
 def container_query(q, across_collections=1):
@@ -80,6 +87,16 @@ def specific_container_query(name, collection=None, tag=None):
     return Container.objects.filter(collection__name=collection, name=name, tag=tag)
 
 
+def visible_containers(user):
+    """return the containers a user can pull, in public collections, and in
+    private collections they own or contribute to.
+    """
+    query = Q(collection__private=False)
+    if user is not None and user.is_authenticated:
+        query |= Q(collection_id__in=get_viewable_collection_ids(user))
+    return Container.objects.filter(query)
+
+
 def container_lookup(collection, name, tag=None, return_collection=False):
     """container lookup will parse a query string from the url to look up
        a container. If lookup incorrect or no container
@@ -99,21 +116,184 @@ def container_lookup(collection, name, tag=None, return_collection=False):
     name = name.lower()
     collection = collection.lower()
 
-    container = None
-    contenders = Container.objects.filter(
-        name=name, tag=tag, collection__name=collection
+    # One query: the container with the tag if it exists, otherwise most recent
+    container = (
+        Container.objects.select_related("collection")
+        .filter(name=name, collection__name=collection)
+        .order_by(
+            Case(
+                When(tag=tag, then=Value(0)),
+                default=Value(1),
+                output_field=IntegerField(),
+            ),
+            "-id",
+        )
+        .first()
     )
 
-    # If no contenders, try sending most recent tag
-    if not contenders:
-        contenders = Container.objects.filter(name=name, collection__name=collection)
+    if return_collection and container is not None:
+        return container.collection
+
+    return container
 
-    if not contenders:
-        return container  # No contenders, return None
 
-    container = contenders.last()
+################################################################################
+# Container Resolution
+################################################################################
+
+
+# Each collection has a generation in the (shared) cache, changed when its
+# containers, privacy or members change, and all collections share one for
+# changes from the user side. A cached container is only used while both
+# generations are the ones it was cached with, so a change in one worker
+# clears the containers cached by all of them.
+CONTAINER_GENERATION_KEY = "sregistry:containers:%s"
 
-    if return_collection and container is not None:
-        return container.collection
 
+class ContainerCache:
+    """A small, thread safe least recently used cache of resolved containers,
+    keyed by (collection, name, tag, version). Entries expire after
+    CONTAINER_CACHE_SECONDS, and are cleared (for all workers) by the
+    Container and Collection signals in shub.apps.main.models.signals, or
+    when a container row is updated directly.
+    """
+
+    def __init__(self, size, seconds):
+        self.size = size
+        self.seconds = seconds
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get_generations(self, collection_id):
+        keys = [
+            CONTAINER_GENERATION_KEY % collection_id,
+            CONTAINER_GENERATION_KEY % "all",
+        ]
+        generations = cache.get_many(keys)
+        return tuple(generations.get(key) for key in keys)
+
+    def get(self, key):
+        if not self.seconds:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        expires, container, generations = entry
+        if expires < time.monotonic() or generations != self.get_generations(
+            container.collection_id
+        ):
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+            return None
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return container
+
+    def set(self, key, container):
+        if not self.seconds:
+            return
+        generations = self.get_generations(container.collection_id)
+        with self.lock:
+            self.entries[key] = (
+                time.monotonic() + self.seconds,
+                container,
+                generations,
+            )
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def new_generation(self, name):
+        """change a generation, it's kept as long as an entry could be"""
+        cache.set(CONTAINER_GENERATION_KEY % name, uuid.uuid4().hex, self.seconds + 1)
+
+    def clear_collection(self, collection_id):
+        """remove all containers that belong to a collection"""
+        with self.lock:
+            for key, (_, container, _) in list(self.entries.items()):
+                if container.collection_id == collection_id:
+                    del self.entries[key]
+        if self.seconds:
+            self.new_generation(collection_id)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.seconds:
+            self.new_generation("all")
+
+
+container_cache = ContainerCache(
+    size=settings.CONTAINER_CACHE_SIZE, seconds=settings.CONTAINER_CACHE_SECONDS
+)
+
+
+def resolve_container(names):
+    """resolve a container from a parsed image name (from parse_image_name)
+    with a single query. The collection is selected with the container, and
+    owners and contributors are prefetched so permission checks don't need
+    additional queries. Results are kept in the container_cache.
+
+    The collection is the url (minus a registry, which we don't need), and
+    if the url includes a slash, the first part of it is also considered.
+    A tag that starts with sha256 is treated as the version.
+
+    Parameters
+    ==========
+    names: the parsed image name, with url, image, tag and version
+    """
+    url = names["url"]
+    tag = names["tag"]
+    version = names["version"]
+
+    # The user can provide the username (a username) that owns the container
+    # We don't actually need it - namespace doesn't include username
+    if names["registry"] and names["registry"] in url:
+        url = re.sub("^%s/" % names["registry"], "", url)
+
+    # A hash can be given to the API too
+    if tag is not None and tag.startswith("sha256"):
+        version = tag
+        tag = None
+
+    if version is None and tag is None:
+        return None
+
+    key = (url, names["image"], tag, version)
+    container = container_cache.get(key)
+    if container is not None:
+        return container
+
+    collections = [url]
+    if "/" in url:
+        collections.append(url.split("/")[0])
+
+    containers = Container.objects.select_related("collection").filter(
+        collection__name__in=collections, name=names["image"]
+    )
+    if version is not None:
+        containers = containers.filter(version=version)
+    else:
+        containers = containers.filter(tag=tag)
+
+    # Prefer the full collection name to the first part of it
+    container = containers.order_by(
+        Case(
+            When(collection__name=url, then=Value(0)),
+            default=Value(1),
+            output_field=IntegerField(),
+        ),
+        "-id",
+    ).first()
+
+    if container is not None:
+        prefetch_related_objects(
+            [container], "collection__owners", "collection__contributors"
+        )
+        container_cache.set(key, container)
     return container
@@ -0,0 +1,181 @@
+"""
+
+Copyright 2017-2023 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.db import DatabaseError, connection
+from django.db.models import Case, IntegerField, Value, When
+
+from shub.apps.main.models import Collection, Container
+from shub.logger import bot
+
+################################################################################
+# SEARCH INDEX
+################################################################################
+
+# Each collection has a search_text with its name, and the names, tags and
+# labels of its containers. With Postgres, it has a trigram (pg_trgm) index,
+# and with SQLite, it's also kept in an FTS5 table with a trigram tokenizer.
+# Both support a substring search, ranked by similarity.
+
+SEARCH_INDEX = "main_collection_search_text_trgm"
+SEARCH_TABLE = "main_collection_search"
+
+# A trigram index can't be used for queries shorter than a trigram
+SEARCH_MIN_LENGTH = 3
+
+
+def get_search_text(collection):
+    """generate the search text for a collection, the (lowercase, unique)
+    collection name, container names, container tags and tag labels.
+    """
+    words = {collection.name}
+    for name, tag, label in Container.objects.filter(
+        collection_id=collection.id
+    ).values_list("name", "tag", "tags__name"):
+        words.update([name, tag, label])
+    words.discard(None)
+    return " ".join(sorted(words)).lower()
+
+
+def has_search_table():
+    return (
+        connection.vendor == "sqlite"
+        and SEARCH_TABLE in connection.introspection.table_names()
+    )
+
+
+def update_search_index(collection):
+    """update the search text for a collection. The row is updated directly,
+    so the collection modify date is not changed.
+    """
+    search_text = get_search_text(collection)
+    Collection.objects.filter(id=collection.id).update(search_text=search_text)
+    if has_search_table():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM %s WHERE rowid = %%s" % SEARCH_TABLE, [collection.id]
+            )
+            cursor.execute(
+                "INSERT INTO %s (rowid, search_text) VALUES (%%s, %%s)" % SEARCH_TABLE,
+                [collection.id, search_text],
+            )
+
+
+def delete_search_index(collection_id):
+    """remove a deleted collection from the search table"""
+    if has_search_table():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM %s WHERE rowid = %%s" % SEARCH_TABLE, [collection_id]
+            )
+
+
+def create_search_index(**kwargs):
+    """create the search index for the database, if it doesn't exist, and
+    index collections without a search text (e.g., when upgrading a registry
+    with existing collections). This runs after migrations, and is safe to
+    run again.
+    """
+    try:
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS %s ON main_collection "
+                    "USING gin (search_text gin_trgm_ops)" % SEARCH_INDEX
+                )
+
+        elif connection.vendor == "sqlite" and not has_search_table():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "CREATE VIRTUAL TABLE %s USING fts5(search_text, tokenize='trigram')"
+                    % SEARCH_TABLE
+                )
+                cursor.execute(
+                    "INSERT INTO %s (rowid, search_text) "
+                    "SELECT id, search_text FROM main_collection" % SEARCH_TABLE
+                )
+
+        # A collection's search text has at least its name
+        count = rebuild_search_index(Collection.objects.filter(search_text=""))
+        if count:
+            bot.info("Indexed %s collections for search." % count)
+
+    # Without the index (e.g., no permission to create pg_trgm) search scans
+    except DatabaseError as e:
+        bot.warning("Cannot create search index: %s" % e)
+
+
+def rebuild_search_index(collections=None):
+    """regenerate the search text for all collections (or a queryset of
+    them), returning the count
+    """
+    if collections is None:
+        collections = Collection.objects.all()
+    count = 0
+    for collection in collections.only("id", "name").iterator():
+        update_search_index(collection)
+        count += 1
+    return count
+
+
+################################################################################
+# SEARCH
+################################################################################
+
+
+def search_collections(q):
+    """search collections for a query, a (case insensitive) substring of a
+    collection name, container name, tag or label. Results are ordered by
+    relevance when the database has a search index.
+
+    Parameters
+    ==========
+    q: the query string
+    """
+    q = (q or "").strip().lower()
+    if not q:
+        return Collection.objects.none()
+
+    collections = Collection.objects.filter(search_text__contains=q)
+    if len(q) < SEARCH_MIN_LENGTH:
+        return collections.order_by("name")
+
+    if connection.vendor == "postgresql":
+        from django.contrib.postgres.search import TrigramWordSimilarity
+
+        return collections.annotate(
+            rank=TrigramWordSimilarity(q, "search_text")
+        ).order_by("-rank", "name")
+
+    if has_search_table():
+        return search_table(q)
+
+    return collections.order_by("name")
+
+
+def search_table(q):
+    """search the SQLite FTS5 table, ordered by rank (bm25)"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT rowid FROM %s WHERE search_text MATCH %%s ORDER BY rank"
+            % SEARCH_TABLE,
+            ['"%s"' % q.replace('"', '""')],
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+
+    if not ids:
+        return Collection.objects.none()
+
+    return Collection.objects.filter(id__in=ids).order_by(
+        Case(
+            *[When(id=cid, then=Value(i)) for i, cid in enumerate(ids)],
+            output_field=IntegerField()
+        )
+    )
@@ -9,16 +9,25 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """
 
 import uuid
-from itertools import chain
 
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db.models import Count, Q
+from django.db.models.fields.json import KeyTextTransform
 from django.http.response import Http404
 from django.shortcuts import redirect, render
 from ratelimit.decorators import ratelimit
 
+from shub.apps.main.listing import (
+    COLLECTION_ORDERS,
+    DEFAULT_COLLECTION_ORDER,
+    list_collections,
+)
 from shub.apps.main.models import Collection, Container
+from shub.apps.main.models.containers import DEFERRED_FIELDS
+from shub.apps.main.permissions import (
+    get_viewable_collection_ids,
+    get_visible_collections,
+)
 from shub.apps.main.utils import format_collection_name
 from shub.apps.users.views import validate_credentials
 from shub.settings import COLLECTIONS_VIEW_PAGE_COUNT as collection_count
@@ -55,25 +64,20 @@ def all_collections(request):
     and we add collections for which the user has permission.
 
     """
-    limit = min(Collection.objects.count(), collection_count)
-    collections = (
-        Collection.objects.filter(private=False)
-        .annotate(Count("star", distinct=True))
-        .order_by("-star__count")[:limit]
+    order = request.GET.get("order", DEFAULT_COLLECTION_ORDER)
+    collections, cursor = list_collections(
+        get_visible_collections(request.user),
+        order=order,
+        cursor=request.GET.get("after"),
+        size=collection_count,
     )
 
-    # private that the user can view
-    private_collections = [
-        x
-        for x in Collection.objects.filter(private=True)
-        if x.has_view_permission(request)
-    ]
-
-    collections = set(list(chain(collections, private_collections)))
-
     # Get information about if they have storage, and repo access
     context = validate_credentials(user=request.user)
     context["collections"] = collections
+    context["order"] = order if order in COLLECTION_ORDERS else DEFAULT_COLLECTION_ORDER
+    context["orders"] = list(COLLECTION_ORDERS)
+    context["next_cursor"] = cursor
 
     return render(request, "collections/all_collections.html", context)
 
@@ -82,14 +86,20 @@ def all_collections(request):
 @login_required
 def my_collections(request):
     """this view will provide a list of collections for the logged in user"""
-    user = request.user
-    collections = Collection.objects.filter(
-        Q(owners=user) | Q(contributors=user)
-    ).distinct()
+    order = request.GET.get("order", DEFAULT_COLLECTION_ORDER)
+    collections, cursor = list_collections(
+        Collection.objects.filter(id__in=get_viewable_collection_ids(request.user)),
+        order=order,
+        cursor=request.GET.get("after"),
+        size=collection_count,
+    )
 
     # Get information about if they have storage, and repo access
     context = validate_credentials(user=request.user)
     context["collections"] = collections
+    context["order"] = order if order in COLLECTION_ORDERS else DEFAULT_COLLECTION_ORDER
+    context["orders"] = list(COLLECTION_ORDERS)
+    context["next_cursor"] = cursor
     context["my_collections"] = True
     return render(request, "collections/all_collections.html", context)
 
@@ -160,7 +170,10 @@ def _view_collection(request, collection):
     # If the user is logged in, see if there is a star
     has_star = collection.has_collection_star(request)
 
-    containers = collection.containers.all()
+    # The page only needs the builder name from the (large) metadata
+    containers = collection.containers.defer(*DEFERRED_FIELDS).annotate(
+        builder_name=KeyTextTransform("name", "metadata__builder")
+    )
     context = {
         "collection": collection,
         "containers": containers,
@@ -10,11 +10,12 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import datetime
 
-from django.db.models import Q
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
 from django.shortcuts import render
 from ratelimit.decorators import ratelimit
 
-from shub.apps.main.models import Collection, Container
+from shub.apps.main.permissions import get_visible_collections
 from shub.settings import VIEW_RATE_LIMIT as rl_rate
 from shub.settings import VIEW_RATE_LIMIT_BLOCK as rl_block
 
@@ -52,9 +53,9 @@ def generate_size_data(collections):
         # Generate data on the level of collections by default
         # Size used to be container sizes, but now we return just counts
         data[collection_name] = {
-            "size": collection.containers.count(),
+            "size": collection.container_count,
             "id": collection.id,
-            "n": collection.containers.count(),
+            "n": collection.container_count,
         }
 
     return data
@@ -65,13 +66,7 @@ def get_filtered_collections(request):
     """return all collections or only public, given user accessing
     this function will return all collections based on a permission level
     """
-    if request.user.is_superuser or request.user.is_staff:
-        collections = Collection.objects.all()
-    else:
-        collections = Collection.objects.filter(
-            Q(owners=request.user) | Q(contributors=request.user) | Q(private=False)
-        )
-    return collections
+    return get_visible_collections(request.user)
 
 
 ### Treemap Views and Context
@@ -80,12 +75,14 @@ def get_filtered_collections(request):
 @ratelimit(key="ip", rate=rl_rate, block=rl_block)
 def generate_treemap_context(request):
     collections = get_filtered_collections(request)
-    containers = Container.objects.filter(collection__in=collections)
+    counts = collections.aggregate(
+        containers=Coalesce(Sum("container_count"), 0), collections=Count("id")
+    )
     date = datetime.datetime.now().strftime("%m-%d-%y")
     return {
         "generation_date": date,
-        "containers_count": containers.count(),
-        "collections_count": collections.count(),
+        "containers_count": counts["containers"],
+        "collections_count": counts["collections"],
     }
 
 
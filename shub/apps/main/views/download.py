@@ -9,15 +9,24 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """
 
 import os
+import re
 
+from django.conf import settings
 from django.contrib import messages
-from django.http import FileResponse, HttpResponse, HttpResponseForbidden
+from django.http import (
+    FileResponse,
+    HttpResponse,
+    HttpResponseForbidden,
+    HttpResponseNotModified,
+    StreamingHttpResponse,
+)
 from django.http.response import Http404
 from django.shortcuts import redirect
 from ratelimit.decorators import ratelimit
 from rest_framework import status
 from rest_framework.response import Response
 
+from shub.apps.main.limits import count_byte_range, increment_get_count
 from shub.apps.main.models import Share
 from shub.apps.main.utils import validate_share
 from shub.settings import PLUGINS_ENABLED
@@ -86,9 +95,12 @@ def download_container(request, cid, secret):
 def _download_container(container, request):
     """
     download_container is the shared function between downloading a share
-    or a direct container download. For each, we create a FileResponse
-    with content type application/img, and stream it to the container's
-    download name. A FileResponse is returned.
+    or a direct container download. For each, we validate the GET limit here,
+    and then hand the transfer to nginx (X-Accel-Redirect) or stream it with
+    content type application/img to the container's download name. Byte
+    ranges (Range) and conditional requests (If-None-Match, with the container
+    version as ETag) are supported. The whole file counts as a GET, and ranges
+    count as a GET when the bytes served reach the size.
 
     Parameters
     ==========
@@ -98,21 +110,58 @@ def _download_container(container, request):
     if container.image is not None:
         filename = container.get_download_name()
         filepath = container.image.get_abspath()
+        etag = '"%s"' % container.version if container.version else None
 
-        f = open(filepath, "rb")
-        response = FileResponse(f, content_type="application/img")
-        response["Content-Disposition"] = 'attachment; filename="%s"' % filename
-        response["Content-Length"] = os.path.getsize(filepath)
-
-        # Add 1 to the get count
-        if container.get_count < container.get_limit:
-            container.get_count += 1
-            container.collection.get_count += 1
-            container.collection.save()
-            container.save()
+        # The client already has this version of the container
+        if etag and etag in request.META.get("HTTP_IF_NONE_MATCH", ""):
+            response = HttpResponseNotModified()
+            response["ETag"] = etag
+            return response
+
+        size = os.path.getsize(filepath)
+        byte_range = get_byte_range(request.META.get("HTTP_RANGE"), size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = "bytes */%s" % size
             return response
 
-        return HttpResponseForbidden()
+        # Add 1 to the get count (if under the limit) for the whole file, or
+        # add up the bytes of a range (e.g., a resumed download)
+        if byte_range is None:
+            allowed = increment_get_count(container)
+        else:
+            allowed = count_byte_range(container, *byte_range, size)
+        if not allowed:
+            return HttpResponseForbidden()
+
+        # nginx serves the file (and range) from the internal location
+        if settings.DOWNLOAD_ACCEL_REDIRECT:
+            response = HttpResponse(content_type="application/img")
+            response["X-Accel-Redirect"] = "%s/%s" % (
+                settings.DOWNLOAD_ACCEL_REDIRECT_LOCATION.rstrip("/"),
+                os.path.relpath(filepath, settings.MEDIA_ROOT),
+            )
+
+        elif byte_range is not None:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                read_byte_range(filepath, start, end), content_type="application/img"
+            )
+            response.status_code = 206
+            response["Content-Range"] = "bytes %s-%s/%s" % (start, end, size)
+            response["Content-Length"] = end - start + 1
+
+        else:
+            response = FileResponse(
+                open(filepath, "rb"), content_type="application/img"
+            )
+            response["Content-Length"] = size
+
+        response["Content-Disposition"] = 'attachment; filename="%s"' % filename
+        response["Accept-Ranges"] = "bytes"
+        if etag:
+            response["ETag"] = etag
+        return response
 
     # A remove build will store a metadata image url
     elif "image" in container.metadata:
@@ -122,13 +171,44 @@ def _download_container(container, request):
             signed_url = generate_signed_url(container.metadata["image"])
 
             # If we can generate a URL, add one to limit and return url
-            if signed_url is not None and container.get_count < container.get_limit:
-                container.get_count += 1
-                container.collection.get_count += 1
-                container.collection.save()
-                container.save()
+            if signed_url is not None and increment_get_count(container):
                 return redirect(signed_url)
             return HttpResponseForbidden()
 
     # There is no container
     raise Http404
+
+
+def get_byte_range(header, size):
+    """parse a Range header for a file of some size. Returns None to send the
+    whole file (no header, or one we don't handle, like multiple ranges),
+    False if the range can't be satisfied, or an inclusive (start, end).
+    """
+    match = re.match(r"^bytes=(\d*)-(\d*)$", (header or "").strip())
+    if not match or match.groups() == ("", ""):
+        return None
+
+    start, end = match.groups()
+
+    # A suffix range is the last N bytes
+    if start == "":
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end or size - 1), size - 1)
+
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def read_byte_range(filepath, start, end, chunk_size=FileResponse.block_size):
+    """yield the bytes from start to end (inclusive) of a file, in chunks"""
+    with open(filepath, "rb") as fd:
+        fd.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = fd.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
@@ -8,7 +8,6 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 """
 
-from django.db.models.aggregates import Count
 from django.http import JsonResponse
 from django.http.response import Http404
 from django.shortcuts import render
@@ -29,12 +28,9 @@ from .collections import get_collection
 def collection_stars(request):
     """This is a "favorite" view of collections ordered based on number of stars."""
     # Favorites based on stars
-    collections = (
-        Collection.objects.filter(private=False)
-        .annotate(Count("star", distinct=True))
-        .order_by("-star__count")
+    collections = Collection.objects.filter(private=False, star_count__gt=0).order_by(
+        "-star_count"
     )
-    collections = [x for x in collections if x.star__count > 0]
     context = {"collections": collections}
     return render(request, "stars/collection_stars.html", context)
 
@@ -17,6 +17,7 @@ from ratelimit.decorators import ratelimit
 from taggit.models import Tag
 
 from shub.apps.main.models import Container
+from shub.apps.main.models.containers import DEFERRED_FIELDS
 from shub.settings import VIEW_RATE_LIMIT as rl_rate
 from shub.settings import VIEW_RATE_LIMIT_BLOCK as rl_block
 
@@ -59,7 +60,9 @@ def view_tag(request, tid):
         messages.info(request, "This tag does not exist.")
         return redirect("all_tags")
 
-    containers = Container.objects.filter(tags__name=tag, collection__private=False)
+    containers = Container.objects.filter(
+        tags__name=tag, collection__private=False
+    ).defer(*DEFERRED_FIELDS)
     context = {"containers": containers, "tag": tag}
 
     return render(request, "tags/view_tag.html", context)
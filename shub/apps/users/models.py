@@ -14,12 +14,12 @@ from itertools import chain
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.db import models
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.urls import reverse
 from rest_framework.authtoken.models import Token
 
-from shub.apps.users.utils import get_usertoken
+from shub.apps.users.utils import clear_cached_token, get_usertoken
 
 ################################################################################
 # Supporting Functions
@@ -111,21 +111,17 @@ class User(AbstractUser):
         """given a collection, determine if the user is member of any teams
         associated with the collection
         """
-        for owner in collection.owners.all():
-            for team in owner.team_owners.all():
-                if self in team.members.all():
-                    return True
-        return False
+        return self.collection_permissions.filter(
+            collection_id=collection.id, level="team_member"
+        ).exists()
 
     def is_team_owner(self, collection):
         """given a collection, determine if the user is owner of any teams
         associated with the collection
         """
-        for owner in collection.owners.all():
-            for team in owner.team_owners.all():
-                if self in team.owners.all():
-                    return True
-        return False
+        return self.collection_permissions.filter(
+            collection_id=collection.id, level="team_owner"
+        ).exists()
 
     def get_credentials(self, provider):
         """return one or more credentials, or None"""
@@ -335,3 +331,23 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
     """
     if created:
         Token.objects.create(user=instance)
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def clear_token_cache(sender, instance, **kwargs):
+    """A regenerated or deleted token must not be served from the cache"""
+    clear_cached_token(instance.key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def clear_user_token_cache(
+    sender, instance=None, created=False, update_fields=None, **kwargs
+):
+    """The cached token holds a copy of the user, so clear it on update.
+    A login only updates last_login, and doesn't need to clear it.
+    """
+    if created or update_fields == frozenset(["last_login"]):
+        return
+    for key in Token.objects.filter(user=instance).values_list("key", flat=True):
+        clear_cached_token(key)
@@ -11,10 +11,17 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import base64
 import hashlib
 import os
+import pickle
 import sys
 
+import django_rq
+from django.conf import settings
+from redis.exceptions import RedisError
 from rest_framework.authtoken.models import Token
 
+# Prefix for token (and user) entries in the shared redis cache
+TOKEN_CACHE_PREFIX = "sregistry:token:"
+
 
 def get_user(uid):
     """get a user based on id
@@ -42,6 +49,61 @@ def get_usertoken(user):
     return token.key
 
 
+################################################################################
+# TOKEN CACHE
+################################################################################
+
+
+def get_cached_token(key):
+    """look up a token (with the associated user) by its key. The token is
+    first looked for in redis, and if not found, retrieved from the
+    database with the user in the same query and cached for
+    TOKEN_CACHE_SECONDS. Invalid keys are not cached.
+
+    Parameters
+    ==========
+    key: the token key, without any "bearer" prefix
+    """
+    if not key:
+        return None
+
+    cache_key = TOKEN_CACHE_PREFIX + key
+    if settings.TOKEN_CACHE_SECONDS:
+        try:
+            cached = django_rq.get_connection().get(cache_key)
+            if cached is not None:
+                return pickle.loads(cached)
+        except RedisError:
+            pass
+
+    try:
+        token = Token.objects.select_related("user").get(key=key)
+    except Token.DoesNotExist:
+        return None
+
+    if settings.TOKEN_CACHE_SECONDS:
+        try:
+            django_rq.get_connection().setex(
+                cache_key, settings.TOKEN_CACHE_SECONDS, pickle.dumps(token)
+            )
+        except RedisError:
+            pass
+    return token
+
+
+def clear_cached_token(key):
+    """remove a token from the cache, e.g., when it is deleted or regenerated
+
+    Parameters
+    ==========
+    key: the token key to remove
+    """
+    try:
+        django_rq.get_connection().delete(TOKEN_CACHE_PREFIX + key)
+    except RedisError:
+        pass
+
+
 def create_code_challenge():
     """This function will produce a verifier and challenge for Native Application
     flow with OAuth2. We always use SHA256 and the code verifier is between 43
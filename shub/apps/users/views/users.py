@@ -12,7 +12,7 @@ from django.contrib import messages
 from django.contrib.auth import logout
 from django.contrib.auth.decorators import login_required
 from django.db.models import Q, Sum
-from django.db.models.aggregates import Count
+from django.db.models.functions import Coalesce
 from django.shortcuts import get_object_or_404, redirect, render
 from ratelimit.decorators import ratelimit
 from rest_framework.authtoken.models import Token
@@ -65,21 +65,17 @@ def view_profile(request, username=None):
         user = get_object_or_404(User, username=username)
 
     if user == request.user:
-        collections = (
-            Collection.objects.filter(owners=user)
-            .annotate(Count("star", distinct=True))
-            .order_by("-star__count")
-        )
+        collections = Collection.objects.filter(owners=user).order_by("-star_count")
     else:
-        collections = (
-            Collection.objects.filter(owners=user, private=False)
-            .annotate(Count("star", distinct=True))
-            .order_by("-star__count")
+        collections = Collection.objects.filter(owners=user, private=False).order_by(
+            "-star_count"
         )
 
     # Total Starred Collections
 
-    stars = Star.objects.filter(collection__owners=user).count()
+    stars = Collection.objects.filter(owners=user).aggregate(
+        stars=Coalesce(Sum("star_count"), 0)
+    )["stars"]
     favorites = Star.objects.filter(user=user)
 
     # Total Downloads Across Collections
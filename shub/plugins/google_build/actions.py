@@ -423,6 +423,7 @@ def complete_build(cid, params, check_again_seconds=10):
     # Add response metrics (size and file_hash)
     if "size" in response:
         container.metrics["size_mb"] = round(convert_size(response["size"], "MB"), 3)
+        container.size_bytes = int(response["size"])
 
     # Update the status
     if "status" in response:
@@ -24,7 +24,12 @@ from rest_framework.exceptions import PermissionDenied
 from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.viewsets import ModelViewSet
 
-from shub.apps.api.utils import get_request_user, has_permission, validate_request
+from shub.apps.api.utils import (
+    get_auth_context,
+    get_request_user,
+    has_permission,
+    validate_request,
+)
 from shub.apps.main.models import Collection, Container
 from shub.apps.main.views import get_collection, get_container
 from shub.settings import (
@@ -174,7 +179,7 @@ class RecipePushViewSet(ModelViewSet):
         print(self.request.data)
         tag = self.request.data.get("tag", "latest")
         name = self.request.data.get("name")
-        auth = self.request.META.get("HTTP_AUTHORIZATION", None)
+        auth = get_auth_context(self.request)
         collection_name = self.request.data.get("collection")
 
         # Building is disabled
@@ -50,8 +50,18 @@ BOOLEAN_DEFAULTS = {
     # use SSL for minio
     "MINIO_SSL": False,
     "MINIO_MULTIPART_UPLOAD": True,
+    # Enable TCP keep-alive for (pooled) connections to minio
+    "MINIO_TCP_KEEPALIVE": True,
     # Don't clean up images in Minio that are no longer referenced by sregistry
     "DISABLE_MINIO_CLEANUP": False,
+    # Keep one copy of identical images in MEDIA_ROOT (linked by digest)
+    "IMAGE_DEDUPLICATION": True,
+    # Keep the cache (and django-ratelimit counts) per process, instead of in redis
+    "DISABLE_REDIS_CACHE": False,
+    # Container downloads are checked by the registry, and then sent by nginx
+    # (X-Accel-Redirect) from DOWNLOAD_ACCEL_REDIRECT_LOCATION, which must be
+    # an internal location in your nginx.conf (see the provided nginx.conf)
+    "DOWNLOAD_ACCEL_REDIRECT": False,
     # Do you want to save complete response metadata per each pull?
     # If you disable, we still keep track of collection pull counts, but not specific versions
     "LOGGING_SAVE_RESPONSES": True,
@@ -68,6 +78,8 @@ STRING_DEFAULTS = {
     "API_VERSION": "v1",
     "API_ANON_THROTTLE_RATE": "100/day",
     "API_USER_THROTTLE_RATE": "1000/day",
+    # An internal nginx location with the same files as MEDIA_ROOT
+    "DOWNLOAD_ACCEL_REDIRECT_LOCATION": "/_images",
     "API_DEFAULT_SCHEMA_CLASS": "rest_framework.schemas.coreapi.AutoSchema",
     "API_DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.LimitOffsetPagination",
     "SOCIAL_AUTH_LOGIN_REDIRECT_URL": "http://127.0.0.1",
@@ -101,6 +113,10 @@ STRING_DEFAULTS = {
     "MINIO_REGION": "us-east-1",
     # The rate limit for each view, django-ratelimit, "50 per day per ipaddress)
     "VIEW_RATE_LIMIT": "50/1d",
+    # Library pulls (image lookups and downloads) and pushes are also limited
+    # per ip address and per user, with a token bucket in redis (empty to disable)
+    "LIBRARY_PULL_RATE_LIMIT": "1000/1h",
+    "LIBRARY_PUSH_RATE_LIMIT": "100/1h",
     "DJANGO_LOG_LEVEL": "WARNING",
     # An image url or one of the following: 'mm', 'identicon', 'monsterid', 'wavatar', 'retro'. Defaults to 'mm', and 'retro' here
     "GRAVATAR_DEFAULT_IMAGE": "retro",
@@ -178,14 +194,56 @@ INTEGER_DEFAULTS = {
     # Set this to be some size in MB to limit uploads.
     # Uploads > 2.5GB will not use memory, but the filesystem
     "DATA_UPLOAD_MAX_MEMORY_SIZE": None,
+    # The size (MB) of each chunk for resumable uploads from the web interface
+    "UPLOAD_CHUNK_SIZE_MB": 16,
+    # Uploads are moved to MEDIA_ROOT with a rename, or copied when they are on
+    # another filesystem. Copies of images of at least this size (MB) are run
+    # by the worker (0 to always copy in the request)
+    "UPLOAD_BACKGROUND_COPY_MB": 1024,
     # Limit users to N collections (None is unlimited)
     "USER_COLLECTION_LIMIT": 2,
-    # The number of collections to show on the /<domain>/collections page
+    # The number of collections to show on each /<domain>/collections page
     "COLLECTIONS_VIEW_PAGE_COUNT": 250,
+    # The number of collections per page of search results
+    "SEARCH_PAGE_SIZE": 50,
     # The maximum number of downloads allowed per container/collection, per week
     "CONTAINER_WEEKLY_GET_LIMIT": 100,
     "COLLECTION_WEEKLY_GET_LIMIT": 100,
     "MINIO_SIGNED_URL_EXPIRE_MINUTES": 5,
+    # Signed download urls are reused (per worker) until this many seconds
+    # before they expire. Set to MINIO_SIGNED_URL_EXPIRE_MINUTES * 60 to disable
+    "MINIO_SIGNED_URL_CACHE_MARGIN_SECONDS": 120,
+    # Multipart uploads are split into about this many parts (to upload in
+    # parallel), each at least MINIO_MULTIPART_MIN_PART_SIZE_MB
+    "MINIO_MULTIPART_TARGET_PARTS": 32,
+    "MINIO_MULTIPART_MIN_PART_SIZE_MB": 64,
+    # Minio (and boto3) clients keep up to this many connections open per
+    # server (and process), and retry failed requests this many times
+    "MINIO_MAX_POOL_CONNECTIONS": 10,
+    "MINIO_MAX_RETRIES": 3,
+    # The number of seconds to cache a resolved API token (and user) in redis.
+    # Set to 0 to always look up the token in the database.
+    "TOKEN_CACHE_SECONDS": 300,
+    # Resolved library containers are kept in an in-process LRU cache for this
+    # many seconds (and cleared on change), with at most CONTAINER_CACHE_SIZE entries
+    "CONTAINER_CACHE_SECONDS": 10,
+    "CONTAINER_CACHE_SIZE": 1024,
+    # Container downloads are counted in redis and written to the database
+    # in batches, at most this many seconds after a download
+    "DOWNLOAD_COUNT_FLUSH_SECONDS": 60,
+    # API request logs are queued in redis and saved in batches by the worker,
+    # at most this many seconds after a request. At most LOGGING_QUEUE_SIZE
+    # logs are kept in the queue (the oldest are dropped)
+    "LOGGING_FLUSH_SECONDS": 10,
+    "LOGGING_QUEUE_SIZE": 100000,
+    # Garbage collection (python manage.py gc) skips storage newer than
+    # GC_GRACE_HOURS (uploads in progress), checks GC_BATCH_SIZE items per
+    # query, and removes at most GC_DELETE_RATE items per second (0 no limit).
+    # The nightly run only shows what it would remove unless GC_ENABLED
+    "GC_ENABLED": False,
+    "GC_GRACE_HOURS": 24,
+    "GC_BATCH_SIZE": 1000,
+    "GC_DELETE_RATE": 20,
     # Google Build
     # To prevent denial of service attacks on Google Cloud Storage, you should set a reasonable limit for the number of active, concurrent builds.
     # This number should be based on your expected number of users, repositories, and recipes per repository.
@@ -544,7 +602,20 @@ SENDFILE_BACKEND = "sendfile.backends.development"
 PRIVATE_MEDIA_REDIRECT_HEADER = "X-Accel-Redirect"
 CRISPY_TEMPLATE_PACK = "bootstrap3"
 
-CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+# The cache (with the django-ratelimit counts) is shared by all workers in redis.
+# If redis isn't available, the cache is skipped and rate limited requests allowed
+if cfg.DISABLE_REDIS_CACHE:
+    CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "shub.apps.main.cache.FailOpenRedisCache",
+            "LOCATION": cfg.REDIS_URL,
+            "KEY_PREFIX": "sregistry:cache",
+            "OPTIONS": {"socket_connect_timeout": 1, "socket_timeout": 1},
+        }
+    }
+RATELIMIT_FAIL_OPEN = True
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.9/howto/static-files/
@@ -554,6 +625,7 @@ MEDIA_URL = "/images/"
 STATIC_ROOT = "/var/www/static"
 STATIC_URL = "/static/"
 UPLOAD_PATH = "%s/_upload" % MEDIA_ROOT
+IMAGE_BLOB_ROOT = "%s/_sha256" % MEDIA_ROOT
 
 
 RQ_QUEUES = {"default": {"URL": cfg.REDIS_URL}}